@@ -22,6 +22,7 @@ def filter_tokenizer_config(tokenizer_config: List[TokenizerConfigEntry],
                             excluded_vocabs: Optional[Set[str]] = None,
                             min_code_occurrence_count: Optional[int] = None,
                             keep_n_max_occurrence_codes: Optional[int] = None,
+                            min_code_patient_count: Optional[int] = None,
                             **kwargs) -> Tuple[List[TokenizerConfigEntry], List[TokenizerConfigEntry]]:
     """
         Given a set of filters, applies them to the `tokenizer_config`. 
@@ -29,6 +30,7 @@ def filter_tokenizer_config(tokenizer_config: List[TokenizerConfigEntry],
     """
     valid_entries: List[TokenizerConfigEntry] = []
     invalid_entries: List[TokenizerConfigEntry] = []
+    n_missing_count_patients: int = 0
     for entry in tokenizer_config:
         # Remove tokens from excluded vocabs
         if (
@@ -44,9 +46,21 @@ def filter_tokenizer_config(tokenizer_config: List[TokenizerConfigEntry],
         ):
             invalid_entries.append(entry.to_token())
             continue
+        # Remove tokens that occur in < `min_code_patient_count` unique patients in our dataset
+        # NOTE: Entries w/o a `count_patients` stat (e.g. configs built before patient counts existed) are kept, not treated as 0
+        if min_code_patient_count is not None:
+            count_patients_stat = entry.get_stat('count_patients', None)
+            if count_patients_stat is None:
+                n_missing_count_patients += 1
+            elif count_patients_stat.count < min_code_patient_count:
+                invalid_entries.append(entry.to_token())
+                continue
     
         # If we've made it here, then we want to keep this token
         valid_entries.append(entry)
+
+    if n_missing_count_patients > 0:
+        print(f"Skipped `min_code_patient_count={min_code_patient_count}` filter for {n_missing_count_patients} tokens w/o a `count_patients` stat")
     
     # Keep only the top `keep_n_max_occurrence_codes` tokens, sorted by occurrence count (if specified)
     if keep_n_max_occurrence_codes is not None:
@@ -415,6 +429,8 @@ class CookbookTokenizer(BaseCodeTokenizer):
                 - List of vocabs to exclude from the tokenizer. Determined by the first part of the code before the '/' (e.g. "STANFORD_OBS" in "STANFORD_OBS/1234")
             min_code_occurrence_count: Optional[int]
                 - Only keep tokens with >= `min_code_occurrence_count` total occurrences in our dataset
+            min_code_patient_count: Optional[int]
+                - Only keep tokens that occur in >= `min_code_patient_count` unique patients in our dataset
     """
     def __init__(self, 
                  path_to_tokenizer_config: str, 
@@ -462,12 +478,14 @@ class CookbookTokenizer(BaseCodeTokenizer):
         self.excluded_vocabs: Optional[Set[str]] = { x.lower() for x in metadata.get('excluded_vocabs', {}) } if metadata.get('excluded_vocabs', {}) else None # type: ignore
         self.min_code_occurrence_count: Optional[int] = metadata.get('min_code_occurrence_count', None)
         self.keep_n_max_occurrence_codes: Optional[int] = metadata.get('keep_n_max_occurrence_codes', None)
+        self.min_code_patient_count: Optional[int] = metadata.get('min_code_patient_count', None)
 
         # Apply filtering
         self.tokenizer_config, self.excluded_tokens = filter_tokenizer_config(self.tokenizer_config, 
                                                                               self.excluded_vocabs, 
                                                                               self.min_code_occurrence_count,
-                                                                              self.keep_n_max_occurrence_codes)
+                                                                              self.keep_n_max_occurrence_codes,
+                                                                              min_code_patient_count=self.min_code_patient_count)
         # Tokens
         self.code_2_token = {} # [key] = token; [val] = { 'type' : str, 'tokenization' : dict, 'token' : str }
         self.non_special_tokens: List[str] = []
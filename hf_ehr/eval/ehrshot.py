@@ -13,6 +13,7 @@ import argparse
 import collections
 import os
 import pickle
+import queue
 import numpy as np
 import torch
 import json
@@ -23,8 +24,10 @@ from typing import List, Dict, Tuple, Optional, Any, Set, Union
 from tqdm import tqdm
 from loguru import logger
 from femr.labelers import LabeledPatients, load_labeled_patients
-from hf_ehr.utils import load_config_from_path, load_tokenizer_from_path, load_model_from_path
+from hf_ehr.utils import load_config_from_path, load_tokenizer_from_path, load_model_from_path, load_tokenizer_from_config, CheckpointHandle
 from hf_ehr.config import Event
+from hf_ehr.models.hyena import hyena_forward
+from hf_ehr.models.cpu_inference import load_cpu_model_from_path, set_cpu_threads
 
 class CookbookModelWithClassificationHead(torch.nn.Module):
     def __init__(self, model: torch.nn.Module, aggregation_strat: str, n_classes: int):
@@ -105,6 +108,13 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--chunk_strat", type=str, help="Strategy used for condensing a timeline longer than context window C. Options: 'last' (only take last chunk), 'mean' (avg all chunks together).")
     parser.add_argument("--batch_size", type=int, default=16, help="Batch size")
     parser.add_argument("--device", type=str, default="cuda", help="Device to run inference on")
+    parser.add_argument("--is_cpu_optimized", action="store_true", default=False, help="If TRUE, run an int8-quantized SDPA version of the model on CPU (GPT/Llama/BERT only). Requires `--device cpu`")
+    parser.add_argument("--n_threads", type=int, default=None, help="If specified, # of CPU threads used by torch (only relevant if `--device cpu`)")
+    parser.add_argument("--is_compress_tokenized_timelines", action="store_true", default=False, help="If TRUE, save tokenized timelines as compressed .npz (smaller on disk, but must be decompressed before use). Otherwise, save as raw .npy which can be memory-mapped.")
+    # For pipelining
+    parser.add_argument("--n_tokenize_procs", type=int, default=0, help="If > 0, run the pipelined featurizer with this many CPU tokenization workers")
+    parser.add_argument("--devices", type=str, default=None, help="Comma-separated list of devices for the pipelined featurizer (e.g. 'cuda:0,cuda:1'). Defaults to `--device`")
+    parser.add_argument("--max_queued_batches", type=int, default=8, help="Max number of tokenized batches waiting per device in the pipelined featurizer")
     # For chunking
     parser.add_argument("--patient_idx_start", type=int, default=None, help="If specified, only process patients with idx >= this value (INCLUSIVE)")
     parser.add_argument("--patient_idx_end", type=int, default=None, help="If specified, only process patients with idx < this value (EXCLUSIVE)")
@@ -115,8 +125,73 @@ def get_ckpt_name(path_to_ckpt: str) -> str:
     file_name, _ = os.path.splitext(base_name)
     return file_name
 
+def load_tokenized_timelines(path_to_file: str) -> np.ndarray:
+    """Load a batch of tokenized timelines. Raw .npy files are memory-mapped (no copy), legacy .npz files are decompressed."""
+    if path_to_file.endswith('.npy'):
+        # NOTE: Copy-on-write mode gives a writeable view, so `torch.from_numpy()` can wrap it without a warning or a copy
+        return np.load(path_to_file, mmap_mode='c')
+    return np.load(path_to_file)['tokenized_timelines']
+
+def tokenize_timelines(database, patient_ids: List[int], label_times: List, tokenizer, max_length: int, 
+                       pad_token_id: int = 0, chunk_strat: str = 'last', is_show_progress: bool = True) -> np.ndarray:
+    """Tokenize each patient's timeline up to its label time. Returns a left-padded array of shape (len(patient_ids), max_length)."""
+    total_batch: int = len(patient_ids)
+
+    # Cache events for current batch of patients
+    batch_patient_id_2_events: Dict[str, List[Event]] = collections.defaultdict(list)
+    for pid in tqdm(patient_ids, desc='Caching patient events', total=total_batch, disable=not is_show_progress):
+        if pid not in batch_patient_id_2_events:
+            for e in database[pid].events:
+                batch_patient_id_2_events[pid].append(
+                    Event(code=e.code, value=e.value, unit=e.unit, 
+                          start=e.start, end=e.end, omop_table=e.omop_table)
+                )
+    
+    # Process each patient in the current batch
+    tokenized_timelines: np.ndarray = np.full((total_batch, max_length), pad_token_id, dtype=np.int32)
+    for idx, (pid, l_time) in enumerate(tqdm(zip(patient_ids, label_times), desc='Tokenizing timelines', total=total_batch, disable=not is_show_progress)):
+        # Create patient timeline
+        valid_events = [
+            e for e in batch_patient_id_2_events[pid]
+            if e.start <= l_time  # Ignore events after label time
+        ]
+        
+        # Tokenize timeline
+        timeline = tokenizer(valid_events, add_special_tokens=False)['input_ids'][0]
+        
+        # Apply chunking strategy
+        if chunk_strat == 'last':
+            timeline = timeline[-max_length:]
+        else:
+            raise ValueError(f"Chunk strategy `{chunk_strat}` not supported.")
+        
+        # PAD timeline to max_length
+        if len(timeline) > 0:
+            tokenized_timelines[idx, max_length - len(timeline):] = timeline # left padding
+    return tokenized_timelines
+
+def save_tokenized_timelines_batch(tokenized_timelines: np.ndarray, output_dir: str, run_name: str, batch_idx: int, 
+                                   batch_start: int, batch_end: int, is_compress: bool = False) -> Dict[str, Any]:
+    """Save one batch of tokenized timelines to disk. Returns the batch's entry for the metadata file."""
+    if is_compress:
+        batch_file = os.path.join(output_dir, f'{run_name}_{batch_idx}.npz')
+        np.savez_compressed(batch_file, 
+                          tokenized_timelines=tokenized_timelines,
+                          start_idx=batch_start,
+                          end_idx=batch_end)
+    else:
+        batch_file = os.path.join(output_dir, f'{run_name}_{batch_idx}.npy')
+        np.save(batch_file, tokenized_timelines)
+    return {
+        'batch_id': f'{batch_idx}',
+        'file': batch_file,
+        'start_idx': int(batch_start),
+        'end_idx': int(batch_end),
+        'num_patients': int(batch_end - batch_start)
+    }
+
 def process_in_batches(run_name, database, patient_ids, label_times, tokenizer, max_length, output_dir,
-                      batch_size=1000, pad_token_id=0, chunk_strat='last') -> Dict[str, Any]:
+                      batch_size=1000, pad_token_id=0, chunk_strat='last', is_compress: bool = False) -> Dict[str, Any]:
     """
     Process patient events and create tokenized timelines in batches, saving each batch separately.
     Returns the list of batch files and metadata instead of loading everything into memory.
@@ -131,6 +206,7 @@ def process_in_batches(run_name, database, patient_ids, label_times, tokenizer,
         batch_size: Number of patients to process in each batch
         pad_token_id: Token ID used for padding
         chunk_strat: Strategy for chunking long sequences
+        is_compress: If TRUE, save each batch as a compressed .npz. Otherwise, save as a raw .npy that can be memory-mapped
     
     Returns:
         dict: Contains 'batch_files' list and metadata about the batches
@@ -155,65 +231,19 @@ def process_in_batches(run_name, database, patient_ids, label_times, tokenizer,
     for batch_idx, batch_start in enumerate(tqdm(range(0, total_patients, batch_size), desc='Processing batches')):
         batch_end = min(batch_start + batch_size, total_patients)
         batch_patient_ids = patient_ids[batch_start:batch_end]
-        total_batch = len(batch_patient_ids)
         batch_label_times = label_times[batch_start:batch_end]
         
-        # Create batch-specific patient_id_2_events
-        batch_patient_id_2_events: Dict[str, List[Event]] = collections.defaultdict(list)
-        
-        # Cache events for current batch of patients
-        for pid in tqdm(batch_patient_ids, desc='Caching patient events', total=total_batch):
-            if pid not in batch_patient_id_2_events:
-                for e in database[pid].events:
-                    batch_patient_id_2_events[pid].append(
-                        Event(code=e.code, value=e.value, unit=e.unit, 
-                              start=e.start, end=e.end, omop_table=e.omop_table)
-                    )
-        
-        # Process each patient in the current batch
-        batch_tokenized_timelines = []
-        for pid, l_time in tqdm(zip(batch_patient_ids, batch_label_times), desc='Tokenizing timelines', total=total_batch):
-            # Create patient timeline
-            valid_events = [
-                e for e in batch_patient_id_2_events[pid]
-                if e.start <= l_time  # Ignore events after label time
-            ]
-            
-            # Tokenize timeline
-            timeline = tokenizer(valid_events, add_special_tokens=False)['input_ids'][0]
-            
-            # Apply chunking strategy
-            if chunk_strat == 'last':
-                timeline = timeline[-max_length:]
-            else:
-                raise ValueError(f"Chunk strategy `{chunk_strat}` not supported.")
-            
-            # PAD timeline to max_length
-            padded_timeline = [pad_token_id] * (max_length - len(timeline)) + timeline  # left padding
-            batch_tokenized_timelines.append(padded_timeline)
-        
-        # Convert batch results to numpy array
-        batch_tokenized_timelines = np.array(batch_tokenized_timelines)
+        batch_tokenized_timelines: np.ndarray = tokenize_timelines(database, batch_patient_ids, batch_label_times, tokenizer, max_length, pad_token_id, chunk_strat)
         
         # Save batch to file
-        batch_file = os.path.join(output_dir, f'{run_name}_{batch_idx}.npz')
-        np.savez_compressed(batch_file, 
-                          tokenized_timelines=batch_tokenized_timelines,
-                          start_idx=batch_start,
-                          end_idx=batch_end)
+        batch_dict: Dict[str, Any] = save_tokenized_timelines_batch(batch_tokenized_timelines, output_dir, run_name, batch_idx, batch_start, batch_end, is_compress)
+        batch_file: str = batch_dict['file']
         
         # Store batch metadata
-        batch_metadata['batches'].append({
-            'batch_id': f'{batch_idx}',
-            'file': batch_file,
-            'start_idx': int(batch_start),
-            'end_idx': int(batch_end),
-            'num_patients': int(batch_end - batch_start)
-        })
+        batch_metadata['batches'].append(batch_dict)
         batch_files.append(batch_file)
         
         # Clear batch-specific memory
-        del batch_patient_id_2_events
         del batch_tokenized_timelines
         
         logger.info(f"Saved batch {batch_idx} ({batch_start}-{batch_end}) to {batch_file}")
@@ -230,6 +260,29 @@ def process_in_batches(run_name, database, patient_ids, label_times, tokenizer,
     return batch_metadata
 
 
+def embed_batch(model, config, input_ids: Float[torch.Tensor, 'B L'], embed_strat: str, pad_token_id: int) -> Float[torch.Tensor, 'B H']:
+    """Run `model` on a batch of left-padded timelines and condense each timeline into a single embedding."""
+    attention_mask: Float[torch.Tensor, 'B L'] = (input_ids != pad_token_id).int()
+    batch = {
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+    }
+    if 'hyena' in config['model']['name']:
+        # Hyena's HF model ignores `attention_mask`, so use `hyena_forward()` to skip the left padding
+        results = hyena_forward(model.model, **batch, output_hidden_states=True, return_dict=True, is_compute_logits=False)
+    else:
+        results = model.model(**batch, output_hidden_states=True)
+    hidden_states: Float[torch.Tensor, 'B L H'] = results.hidden_states[-1]
+    assert torch.isnan(hidden_states).sum() == 0, f"Error - hidden_states contains NaNs"
+
+    if embed_strat == 'last':
+        return hidden_states[:, -1, :]
+    elif embed_strat == 'mean':
+        mask: Float[torch.Tensor, 'B L 1'] = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+    else:
+        raise ValueError(f"Embedding strategy `{embed_strat}` not supported.")
+
 def compute_feature_matrix(
     batch_metadata,
     config,
@@ -244,56 +297,208 @@ def compute_feature_matrix(
     with torch.no_grad():
         
         for id, batch_dict in enumerate(batch_metadata['batches']):
-            tokenized_timelines: List[List[int]] = np.load(batch_dict['file'])['tokenized_timelines'].tolist()
+            tokenized_timelines: np.ndarray = load_tokenized_timelines(batch_dict['file'])
 
             for batch_start in tqdm(range(0, len(tokenized_timelines), batch_size), desc=f"Generating patient representations: {id}/{len(batch_metadata['batches'])}", total=len(tokenized_timelines) // batch_size):
                 batch_end = min(len(tokenized_timelines), batch_start + batch_size)
-                pids = patient_ids[batch_start:batch_end]
-                batch_tokenized_timelines: List[List[int]] = tokenized_timelines[batch_start:batch_start + batch_size]
+                pids = patient_ids[batch_dict['start_idx'] + batch_start:batch_dict['start_idx'] + batch_end]
 
                 ########################
                 # Create batch
                 ########################
-                input_ids: Float[torch.Tensor, 'B max_timeline_length'] = torch.stack([torch.tensor(x, device=device) for x in batch_tokenized_timelines])
-                attention_mask: Float[torch.Tensor, 'B max_timeline_length'] = (input_ids != pad_token_id).int()
-                batch = {
-                    'input_ids': input_ids,
-                    'attention_mask': attention_mask if "hyena" not in config['model']['name'] else None
-                }
-                
-                if 'hyena' in config['model']['name']:
-                    batch.pop('attention_mask')
-
-                ########################
-                # Run model
-                ########################
-                results = model.model(**batch, output_hidden_states=True)
-                hidden_states = results.hidden_states[-1]
-                assert torch.isnan(hidden_states).sum() == 0, f"Error - hidden_states contains NaNs for batch_start={batch_start} | batch_end={batch_start + batch_size}"
+                # NOTE: `torch.from_numpy()` shares memory with the memory-mapped array, so the only copy is host -> device
+                input_ids: Float[torch.Tensor, 'B max_timeline_length'] = torch.from_numpy(tokenized_timelines[batch_start:batch_end]).to(device, non_blocking=True).long()
+                assert len(pids) == input_ids.shape[0], f"Error - got {input_ids.shape[0]} timelines for {len(pids)} patients in batch_start={batch_start} | batch_end={batch_end}"
 
                 ########################
-                # Save generated reprs
+                # Run model + save generated reprs
                 ########################
-                for idx in range(len(pids)):
-                    if embed_strat == 'last':
-                        try:
-                            patient_rep = hidden_states[idx, -1, :].cpu().numpy()
-                        except Exception as e:
-                            breakpoint()
-                    elif embed_strat == 'mean':
-                        mask = input_ids[idx] != pad_token_id
-                        patient_rep = hidden_states[idx, mask].mean(dim=0).cpu().numpy()
-                    else:
-                        raise ValueError(f"Embedding strategy `{embed_strat}` not supported.")
-                    feature_matrix.append(patient_rep)
+                patient_reps: Float[torch.Tensor, 'B H'] = embed_batch(model, config, input_ids, embed_strat, pad_token_id)
+                feature_matrix.extend(patient_reps.float().cpu().numpy())
     return feature_matrix
 
+####################################
+# Pipelined featurization
+####################################
+
+def _tokenize_worker(path_to_database: str, config, task_queue, batch_queue, result_queue,
+                     max_length: int, pad_token_id: int, chunk_strat: str, batch_size: int,
+                     output_dir: str, run_name: str, is_compress: bool):
+    """CPU worker: tokenizes (or loads cached) chunks of patients, then splits them into batches for the device workers."""
+    database = None
+    tokenizer = None
+    while True:
+        task: Optional[Dict[str, Any]] = task_queue.get()
+        if task is None:
+            break
+        chunk_start: int = task['start_idx']
+        if 'file' in task:
+            # Cache hit -- reuse previously tokenized timelines
+            tokenized_timelines: np.ndarray = load_tokenized_timelines(task['file'])
+        else:
+            # Lazily open DB + tokenizer so that workers which only read cached chunks stay lightweight
+            if database is None:
+                database = femr.datasets.PatientDatabase(path_to_database)
+                tokenizer = load_tokenizer_from_config(config)
+            tokenized_timelines: np.ndarray = tokenize_timelines(database, task['patient_ids'], task['label_times'], tokenizer, 
+                                                                 max_length, pad_token_id, chunk_strat, is_show_progress=False)
+            batch_dict: Dict[str, Any] = save_tokenized_timelines_batch(tokenized_timelines, output_dir, run_name, task['batch_idx'], 
+                                                                        chunk_start, task['end_idx'], is_compress)
+            result_queue.put(('batch_metadata', batch_dict))
+        # Each batch is keyed by the global index of its first patient, so results can be merged in order
+        for batch_start in range(0, tokenized_timelines.shape[0], batch_size):
+            batch_end: int = min(batch_start + batch_size, tokenized_timelines.shape[0])
+            batch_queue.put((chunk_start + batch_start, np.ascontiguousarray(tokenized_timelines[batch_start:batch_end])))
+    result_queue.put(('tokenize_done', None))
+
+def _featurize_worker(device: str, path_to_model: str, batch_queue, result_queue, embed_strat: str, pad_token_id: int):
+    """Device worker: consumes tokenized batches and emits (start_idx, patient reprs)."""
+    model = load_model_from_path(path_to_model)
+    model.to(device)
+    model.eval()
+    with torch.no_grad():
+        while True:
+            item: Optional[Tuple[int, np.ndarray]] = batch_queue.get()
+            if item is None:
+                break
+            start_idx, tokenized_timelines = item
+            input_ids: Float[torch.Tensor, 'B L'] = torch.from_numpy(tokenized_timelines).to(device, non_blocking=True).long()
+            patient_reps: Float[torch.Tensor, 'B H'] = embed_batch(model, model.config, input_ids, embed_strat, pad_token_id)
+            result_queue.put(('features', (start_idx, patient_reps.float().cpu().numpy())))
+    result_queue.put(('featurize_done', None))
+
+def run_pipelined_featurization(
+    path_to_database: str,
+    path_to_model: str,
+    config,
+    patient_ids: List[int],
+    label_times: List,
+    batch_metadata: Optional[Dict[str, Any]],
+    run_name: str,
+    output_dir: str,
+    max_length: int,
+    pad_token_id: int,
+    chunk_strat: str,
+    embed_strat: str,
+    batch_size: int,
+    devices: List[str],
+    n_tokenize_procs: int,
+    chunk_size: int = 8000,
+    max_queued_batches: int = 8,
+    is_compress: bool = False,
+) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """
+    Overlap tokenization and inference: `n_tokenize_procs` CPU workers tokenize chunks of patients and push 
+    batches onto a bounded queue, which is drained by one worker per entry in `devices` (e.g. 'cuda:0', 'cpu').
+    Results are written into a preallocated matrix by global patient index, so output order is identical to 
+    the serial path regardless of which worker finishes first.
+
+    If `batch_metadata` is given, its cached chunks are reused instead of re-tokenizing.
+
+    Returns:
+        feature_matrix: (len(patient_ids), H) array of patient reprs
+        batch_metadata: Metadata for the tokenized chunks (same format as `process_in_batches`)
+    """
+    ctx = torch.multiprocessing.get_context('spawn')
+    total_patients: int = len(patient_ids)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Queues
+    task_queue = ctx.Queue()
+    batch_queue = ctx.Queue(maxsize=max(1, max_queued_batches * len(devices)))
+    result_queue = ctx.Queue()
+    is_cache_hit: bool = batch_metadata is not None
+    if is_cache_hit:
+        tasks: List[Dict[str, Any]] = [ dict(batch_dict) for batch_dict in batch_metadata['batches'] ]
+    else:
+        tasks: List[Dict[str, Any]] = [
+            {
+                'batch_idx': batch_idx,
+                'start_idx': batch_start,
+                'end_idx': min(batch_start + chunk_size, total_patients),
+                'patient_ids': patient_ids[batch_start:batch_start + chunk_size],
+                'label_times': label_times[batch_start:batch_start + chunk_size],
+            }
+            for batch_idx, batch_start in enumerate(range(0, total_patients, chunk_size))
+        ]
+    for task in tasks:
+        task_queue.put(task)
+    for _ in range(n_tokenize_procs):
+        task_queue.put(None)
+
+    # Workers
+    tokenize_procs = [
+        ctx.Process(target=_tokenize_worker, args=(path_to_database, config, task_queue, batch_queue, result_queue,
+                                                   max_length, pad_token_id, chunk_strat, batch_size, 
+                                                   output_dir, run_name, is_compress), daemon=True)
+        for _ in range(n_tokenize_procs)
+    ]
+    featurize_procs = [
+        ctx.Process(target=_featurize_worker, args=(device, path_to_model, batch_queue, result_queue, embed_strat, pad_token_id), daemon=True)
+        for device in devices
+    ]
+    for p in featurize_procs + tokenize_procs:
+        p.start()
+    logger.info(f"Started {n_tokenize_procs} tokenization workers and {len(featurize_procs)} featurization workers on {devices}")
+
+    # Collect results
+    feature_matrix: Optional[np.ndarray] = None
+    new_batches: List[Dict[str, Any]] = []
+    n_tokenize_done: int = 0
+    n_featurize_done: int = 0
+    n_featurized: int = 0
+    pbar = tqdm(total=total_patients, desc='Generating patient representations')
+    while n_featurize_done < len(featurize_procs):
+        try:
+            msg_type, payload = result_queue.get(timeout=60)
+        except queue.Empty:
+            failed_procs = [ p for p in featurize_procs + tokenize_procs if p.exitcode not in [None, 0] ]
+            if len(failed_procs) > 0:
+                for p in featurize_procs + tokenize_procs:
+                    p.terminate()
+                raise RuntimeError(f"Featurization worker(s) exited unexpectedly with exit codes: {[ p.exitcode for p in failed_procs ]}")
+            continue
+        if msg_type == 'batch_metadata':
+            new_batches.append(payload)
+        elif msg_type == 'tokenize_done':
+            n_tokenize_done += 1
+            if n_tokenize_done == n_tokenize_procs:
+                # All batches have been queued, so tell each device worker to stop once it drains the queue
+                for _ in featurize_procs:
+                    batch_queue.put(None)
+        elif msg_type == 'features':
+            start_idx, patient_reps = payload
+            if feature_matrix is None:
+                feature_matrix = np.zeros((total_patients, patient_reps.shape[1]), dtype=patient_reps.dtype)
+            feature_matrix[start_idx:start_idx + patient_reps.shape[0]] = patient_reps
+            n_featurized += patient_reps.shape[0]
+            pbar.update(patient_reps.shape[0])
+        elif msg_type == 'featurize_done':
+            n_featurize_done += 1
+    pbar.close()
+    for p in featurize_procs + tokenize_procs:
+        p.join()
+    assert n_featurized == total_patients, f"Error -- featurized {n_featurized} patients, but expected {total_patients}"
+
+    # Save metadata file (sorted by `start_idx` so it matches the serial path)
+    if not is_cache_hit:
+        batch_metadata = {
+            'total_patients': total_patients,
+            'max_length': max_length,
+            'batch_size': chunk_size,
+            'batches': sorted(new_batches, key=lambda x: x['start_idx']),
+        }
+        metadata_file = os.path.join(output_dir, f'{run_name}.json')
+        with open(metadata_file, 'w') as f:
+            json.dump(batch_metadata, f, indent=2)
+            logger.critical(f"Saved metadata file in: {metadata_file}")
+    return feature_matrix, batch_metadata
+
 def save_tokenized_timelines(npz_files: List, path_to_combined_timelines: str):
-    # Load each .npz file and extract 'tokenized_timelines'
+    # Load each .npy/.npz file and extract 'tokenized_timelines'
     all_timelines = []
     for file in npz_files:
-        data = np.load(file)
-        all_timelines.append(data['tokenized_timelines'])
+        all_timelines.append(load_tokenized_timelines(file))
     # Concatenate all arrays along the first axis
     combined_timelines = np.concatenate(all_timelines, axis=0)
     # Save the combined array into a single .npz file
@@ -316,7 +521,7 @@ def main():
     device: str = args.device
     patient_idx_start: Optional[int] = args.patient_idx_start
     patient_idx_end: Optional[int] = args.patient_idx_end
-    model_signature: str = f'{MODEL}_{CKPT}_chunk:{CHUNK_STRAT}_embed:{EMBED_STRAT}'
+    model_signature: str = f'{MODEL}_{CKPT}_chunk:{CHUNK_STRAT}_embed:{EMBED_STRAT}' + ('_cpu_int8' if args.is_cpu_optimized else '')
     PATH_TO_OUTPUT_FILE: str = os.path.join(PATH_TO_FEATURES_DIR, model_signature)
     os.makedirs(os.path.dirname(PATH_TO_OUTPUT_FILE), exist_ok=True)
     assert os.path.exists(PATH_TO_MODEL), f"No model exists @ `{PATH_TO_MODEL}`"
@@ -326,19 +531,30 @@ def main():
     logger.info(f"Loading LabeledPatients from `{PATH_TO_LABELED_PATIENTS}`")
     labeled_patients: LabeledPatients = load_labeled_patients(PATH_TO_LABELED_PATIENTS)
     
-    logger.info(f"Loading PatientDatabase from `{PATH_TO_PATIENT_DATABASE}`")
-    database = femr.datasets.PatientDatabase(PATH_TO_PATIENT_DATABASE, read_all=True)
+    # NOTE: The ckpt is read once, then config + tokenizer + model are all served from this handle
+    ckpt_handle = CheckpointHandle(PATH_TO_MODEL)
     logger.info(f"Loading Config from `{PATH_TO_MODEL}`")
-    config = load_config_from_path(PATH_TO_MODEL)
+    config = load_config_from_path(ckpt_handle)
     logger.info(config)
     
 
     logger.info(f"Loading Tokenizer from `{PATH_TO_MODEL}")
-    tokenizer = load_tokenizer_from_path(PATH_TO_MODEL)
-    logger.info(f"Loading Model from `{PATH_TO_MODEL}`")
-    model = load_model_from_path(PATH_TO_MODEL)
-    model.to(device)
-    model.eval()  # Set the model to evalevaluation mode
+    tokenizer = load_tokenizer_from_path(ckpt_handle)
+    is_pipeline: bool = args.n_tokenize_procs > 0
+    if args.is_cpu_optimized:
+        assert device == 'cpu', f"Error -- `--is_cpu_optimized` requires `--device cpu`, not `{device}`"
+        assert not is_pipeline, f"Error -- `--is_cpu_optimized` is not supported by the pipelined featurizer"
+    if device == 'cpu':
+        set_cpu_threads(args.n_threads)
+    if not is_pipeline:
+        # NOTE: In pipelined mode, each device worker loads its own copy of the model
+        logger.info(f"Loading Model from `{PATH_TO_MODEL}`")
+        if args.is_cpu_optimized:
+            model = load_cpu_model_from_path(ckpt_handle, is_quantize=True)
+        else:
+            model = load_model_from_path(ckpt_handle)
+            model.to(device)
+        model.eval()  # Set the model to evalevaluation mode
     # Filter patients by index (if specified)
     logger.info(f"Filtering patients by index: [{patient_idx_start}, {patient_idx_end})")
     allowed_pids = list(labeled_patients.keys())
@@ -363,41 +579,70 @@ def main():
             label_times.append(label.time)
     logger.info(f"Total patient ids: {len(patient_ids)}")
     # Generate patient representations
-    max_length: int = model.config.data.dataloader.max_length
+    max_length: int = config.data.dataloader.max_length
     pad_token_id: int = tokenizer.token_2_idx['[PAD]']
     
     
     # Cache tokenized timelines for this sequence length
     run_name = f"chunk_strat={CHUNK_STRAT},max_length={max_length}_{config.data.tokenizer.name}" + (f'--start_idx={patient_idx_start}' if patient_idx_start else '') + (f'--end_idx={patient_idx_end}' if patient_idx_end else '') + "_tokenized_timelines"
     path_to_tokenized_timelines_metadata_file: str = os.path.join(PATH_TO_TOKENIZED_TIMELINES_DIR, f'{run_name}.json')
+    batch_metadata: Optional[Dict[str, Any]] = None
     if os.path.exists(path_to_tokenized_timelines_metadata_file):
         # Cache hit
         logger.success(f"Loading tokenized timelines from cache dir @ `{path_to_tokenized_timelines_metadata_file}`")
         with open(path_to_tokenized_timelines_metadata_file, 'r') as f:
             batch_metadata = json.load(f)
-    else:
-        batch_metadata = process_in_batches(
-            database=database,
+
+    if is_pipeline:
+        devices: List[str] = args.devices.split(',') if args.devices not in [None, ''] else [ device ]
+        feature_matrix, batch_metadata = run_pipelined_featurization(
+            path_to_database=PATH_TO_PATIENT_DATABASE,
+            path_to_model=PATH_TO_MODEL,
+            config=config,
             patient_ids=patient_ids,
             label_times=label_times,
-            tokenizer=tokenizer,
-            max_length=max_length,
-            output_dir=PATH_TO_TOKENIZED_TIMELINES_DIR,
+            batch_metadata=batch_metadata,
             run_name=run_name,
+            output_dir=PATH_TO_TOKENIZED_TIMELINES_DIR,
+            max_length=max_length,
             pad_token_id=pad_token_id,
-            batch_size=8000
+            chunk_strat=CHUNK_STRAT,
+            embed_strat=EMBED_STRAT,
+            batch_size=batch_size,
+            devices=devices,
+            n_tokenize_procs=args.n_tokenize_procs,
+            chunk_size=8000,
+            max_queued_batches=args.max_queued_batches,
+            is_compress=args.is_compress_tokenized_timelines,
         )
+    else:
+        if batch_metadata is None:
+            # NOTE: Only opened here (i.e. on a cache miss w/o pipelining), since pipelined tokenize workers each open their own copy
+            logger.info(f"Loading PatientDatabase from `{PATH_TO_PATIENT_DATABASE}`")
+            database = femr.datasets.PatientDatabase(PATH_TO_PATIENT_DATABASE, read_all=True)
+            batch_metadata = process_in_batches(
+                database=database,
+                patient_ids=patient_ids,
+                label_times=label_times,
+                tokenizer=tokenizer,
+                max_length=max_length,
+                output_dir=PATH_TO_TOKENIZED_TIMELINES_DIR,
+                run_name=run_name,
+                pad_token_id=pad_token_id,
+                batch_size=8000,
+                is_compress=args.is_compress_tokenized_timelines,
+            )
     
-    feature_matrix = compute_feature_matrix(
-        batch_metadata,
-        config,
-        model,
-        patient_ids,
-        batch_size,
-        EMBED_STRAT,
-        pad_token_id,
-        device
-    )
+        feature_matrix = compute_feature_matrix(
+            batch_metadata,
+            config,
+            model,
+            patient_ids,
+            batch_size,
+            EMBED_STRAT,
+            pad_token_id,
+            device
+        )
 
     # Associate this featurization with its wandb run id + model path
     ## Save wandb run id of ckpt
@@ -5,10 +5,11 @@ import numpy as np
 import os
 import time
 from hf_ehr.models.modules import BaseModel
+from hf_ehr.models.hyena import hyena_forward
 import torch
 from argparse import ArgumentParser, Namespace
 from omegaconf import DictConfig, OmegaConf
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Tuple, Optional
 from typing import Dict
 from tqdm import tqdm
 from jaxtyping import Float
@@ -16,10 +17,12 @@ from torch.utils.data import DataLoader
 import datetime
 import traceback
 import pandas as pd
-from hf_ehr.config import H100_BASE_DIR, A100_BASE_DIR, V100_BASE_DIR, GPU_BASE_DIR, PATH_TO_FEMR_EXTRACT_v8, PATH_TO_FEMR_EXTRACT_MIMIC4
+import pyarrow as pa
+import pyarrow.parquet as pq
+from hf_ehr.config import H100_BASE_DIR, A100_BASE_DIR, V100_BASE_DIR, GPU_BASE_DIR, PATH_TO_FEMR_EXTRACT_v8, PATH_TO_FEMR_EXTRACT_MIMIC4, PPLTCEStat, TokenizerConfigEntry, load_tokenizer_config_and_metadata_from_path, save_tokenizer_config_to_path
 from hf_ehr.data.datasets import AllTokensFEMRDataset, FEMRDataset
-from hf_ehr.data.tokenization import BaseTokenizer, collate_femr_timelines
-from hf_ehr.utils import load_config_from_ckpt, load_tokenizer_from_config, load_model_from_path, load_ckpt
+from hf_ehr.data.tokenization import BaseTokenizer, BaseCodeTokenizer, collate_femr_timelines
+from hf_ehr.utils import load_config_from_ckpt, load_tokenizer_from_config, load_model_from_path, CheckpointHandle
 from loguru import logger
 
 def parse_args() -> Namespace:
@@ -31,9 +34,12 @@ def parse_args() -> Namespace:
     parser.add_argument('--dataset', type=str, default="FEMRDataset", help='Type of dataset -- AllTokensFEMRDataset or AllTokensDataset')
     parser.add_argument('--datasource', type=str, default="starr", help='Source of data')
     parser.add_argument('--stride', type=int, default=32, help='Stride')
+    parser.add_argument('--is_batched', action='store_true', default=False, help='If TRUE, batch windows across patients (see `eval_batched()`)')
+    parser.add_argument('--max_tokens', type=int, default=32_768, help='Max tokens per batch (incl. PAD) if `--is_batched`')
     parser.add_argument('--n_patients', type=int, default=20_000, help='# of val patients')
     parser.add_argument('--is_debug', action='store_true', default=False, help='Debug setting')
     parser.add_argument('--is_load_from_config', action='store_true', default=False,  help='If TRUE, load dataset based on config')
+    parser.add_argument('--is_write_token_ppl_stats', action='store_true', default=False, help='If TRUE, write per-token PPL into the tokenizer config as `PPLTCEStat`s')
     return parser.parse_args()
 
 def patch_config(config: DictConfig) -> None:
@@ -73,6 +79,153 @@ def calc_weighted_average(values: List[float], weights: List[float]) -> float:
     
     return weighted_avg
 
+class TokenResultsWriter:
+    """Buffers per-token results in preallocated numpy columns, and flushes them to parquet shards every `shard_size` tokens."""
+    dtypes: Dict[str, Any] = {
+        'pid' : np.int64,
+        'n_events' : np.int64,
+        'n_tokens' : np.int64,
+        'token_idx' : np.int64, # position of the context's last token (i.e. `label` is the token @ `token_idx + 1`)
+        'label' : np.int64, # what the model is supposed to predict....
+        'label_log_prob' : np.float32,
+        'label_rank' : np.int64, # 0 if `label` is the model's top prediction
+        'argmax_label' : np.int64, # what the model actually wants to predict....
+        'argmax_log_prob' : np.float32,
+    }
+
+    def __init__(self, path_to_shards_dir: str, shard_size: int = 1_000_000) -> None:
+        self.path_to_shards_dir: str = path_to_shards_dir
+        self.shard_size: int = shard_size
+        self.buffers: Dict[str, np.ndarray] = { key: np.empty(shard_size, dtype=dtype) for key, dtype in self.dtypes.items() }
+        self.n_buffered: int = 0
+        self.paths_to_shards: List[str] = []
+        self.label_log_probs: List[np.ndarray] = [] # kept in memory for summary stats
+        os.makedirs(path_to_shards_dir, exist_ok=True)
+        for file in os.listdir(path_to_shards_dir):
+            # Remove stale shards from a previous run
+            if file.startswith('shard_') and file.endswith('.parquet'):
+                os.remove(os.path.join(path_to_shards_dir, file))
+
+    def add(self, **columns: Any) -> None:
+        """Append a block of tokens. Each kwarg is either an array (one value per token) or a scalar (shared by all tokens)."""
+        n_tokens: int = len(columns['label'])
+        offset: int = 0
+        while offset < n_tokens:
+            n_to_copy: int = min(n_tokens - offset, self.shard_size - self.n_buffered)
+            for key, buffer in self.buffers.items():
+                value = columns[key]
+                buffer[self.n_buffered:self.n_buffered + n_to_copy] = value if np.ndim(value) == 0 else value[offset:offset + n_to_copy]
+            self.n_buffered += n_to_copy
+            offset += n_to_copy
+            if self.n_buffered == self.shard_size:
+                self.flush()
+        self.label_log_probs.append(np.asarray(columns['label_log_prob'], dtype=np.float32))
+
+    def flush(self) -> None:
+        """Write buffered tokens to a new parquet shard."""
+        if self.n_buffered == 0:
+            return
+        path_to_shard: str = os.path.join(self.path_to_shards_dir, f'shard_{len(self.paths_to_shards)}.parquet')
+        pd.DataFrame({ key: buffer[:self.n_buffered] for key, buffer in self.buffers.items() }).to_parquet(path_to_shard, index=False)
+        self.paths_to_shards.append(path_to_shard)
+        self.n_buffered = 0
+
+    def close(self) -> List[str]:
+        """Flush any remaining tokens. Returns paths to all shards."""
+        self.flush()
+        return self.paths_to_shards
+
+class TokenPPLAggregator:
+    """
+        Streaming per-token PPL. Accumulates the sum of label log probs and the # of times each token was a label
+        into dense arrays indexed by token ID, so memory is O(vocab size) regardless of how many tokens are scored.
+
+        Updates stay on `device` (no host sync per batch). Call `all_reduce()` to merge across ranks before reading results.
+    """
+
+    def __init__(self, vocab_size: int, device: str = "cuda") -> None:
+        self.vocab_size: int = vocab_size
+        self.sum_log_probs: Float[torch.Tensor, 'V'] = torch.zeros(vocab_size, dtype=torch.float64, device=device)
+        self.counts: Float[torch.Tensor, 'V'] = torch.zeros(vocab_size, dtype=torch.int64, device=device)
+
+    def add(self, labels: Float[torch.Tensor, 'T'], label_log_probs: Float[torch.Tensor, 'T']) -> None:
+        """Add a batch of (label, log prob of label) pairs."""
+        labels = labels.reshape(-1).to(self.counts.device)
+        self.sum_log_probs.index_add_(0, labels, label_log_probs.reshape(-1).to(self.sum_log_probs.device, dtype=torch.float64))
+        self.counts.index_add_(0, labels, torch.ones_like(labels, dtype=torch.int64))
+
+    def merge(self, other: 'TokenPPLAggregator') -> 'TokenPPLAggregator':
+        """Merge `other` into this aggregator (in place). Returns `self`."""
+        assert self.vocab_size == other.vocab_size, f"Error -- Can't merge aggregators with different vocab sizes ({self.vocab_size} != {other.vocab_size})"
+        self.sum_log_probs += other.sum_log_probs.to(self.sum_log_probs.device)
+        self.counts += other.counts.to(self.counts.device)
+        return self
+
+    def all_reduce(self) -> None:
+        """Sum arrays across all ranks (no-op if `torch.distributed` isn't initialized)."""
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.sum_log_probs, op=torch.distributed.ReduceOp.SUM)
+            torch.distributed.all_reduce(self.counts, op=torch.distributed.ReduceOp.SUM)
+
+    def get_ppls(self) -> np.ndarray:
+        """PPL of each token ID when it is the label, i.e. exp(-mean log prob). NaN for tokens never seen as a label."""
+        sum_log_probs: np.ndarray = self.sum_log_probs.cpu().numpy()
+        counts: np.ndarray = self.counts.cpu().numpy()
+        ppls: np.ndarray = np.full(self.vocab_size, np.nan, dtype=np.float64)
+        is_seen: np.ndarray = counts > 0
+        ppls[is_seen] = np.exp(-sum_log_probs[is_seen] / counts[is_seen])
+        return ppls
+
+    def save(self, path_to_file: str) -> None:
+        """Save (sum_log_probs, counts, ppls) arrays to a .npz file."""
+        np.savez(path_to_file, sum_log_probs=self.sum_log_probs.cpu().numpy(), counts=self.counts.cpu().numpy(), ppls=self.get_ppls())
+
+def write_token_ppl_stats_to_tokenizer_config(aggregator: TokenPPLAggregator, 
+                                              tokenizer: BaseTokenizer, 
+                                              dataset: str, 
+                                              split: str, 
+                                              model: str) -> int:
+    """
+        Write each token's PPL into its tokenizer config entry as a `PPLTCEStat`, in one load + save of the config.
+        Replaces any existing PPL stat for the same (dataset, split, model). Returns the # of entries updated.
+    """
+    if not isinstance(tokenizer, BaseCodeTokenizer):
+        raise ValueError(f"Per-token PPL stats require a tokenizer with one token per config entry, not `{type(tokenizer).__name__}`")
+    ppls: np.ndarray = aggregator.get_ppls()
+    token_2_idx: Dict[str, int] = tokenizer.get_vocab()
+    tokenizer_config, metadata = load_tokenizer_config_and_metadata_from_path(tokenizer.path_to_tokenizer_config)
+    n_updated: int = 0
+    for entry in tokenizer_config:
+        idx: Optional[int] = token_2_idx.get(entry.to_token())
+        if idx is None or np.isnan(ppls[idx]):
+            continue
+        entry.stats = [ 
+            s for s in entry.stats 
+            if not (s.type == 'ppl' and s.dataset == dataset and s.split == split and s.model == model)
+        ] + [ PPLTCEStat(dataset=dataset, split=split, model=model, ppl=float(ppls[idx])) ]
+        n_updated += 1
+    if 'is_already_run' not in metadata: metadata['is_already_run'] = {}
+    metadata['is_already_run'][f'add_ppl_to_codes--{dataset}--{split}--{model}'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    save_tokenizer_config_to_path(tokenizer.path_to_tokenizer_config, tokenizer_config, metadata)
+    return n_updated
+
+def calc_summary_stats(writer: TokenResultsWriter, n_batches: int) -> Dict[str, Any]:
+    """Aggregate per-token log probs into PPL stats."""
+    label_log_probs: np.ndarray = np.concatenate(writer.label_log_probs).astype(np.float64) if len(writer.label_log_probs) > 0 else np.zeros(0)
+    label_ppls: np.ndarray = np.exp(label_log_probs)
+    mean_loss_per_token: float = float(np.mean(label_log_probs))
+    return {
+        "mean_loss_per_token" : mean_loss_per_token,
+        "median_loss_per_token" : float(np.median(label_log_probs)),
+        "std_loss_per_token" : float(np.std(label_log_probs)),
+        "mean_ppl_per_token" : float(np.mean(label_ppls)),
+        "median_ppl_per_token" : float(np.median(label_ppls)),
+        "std_ppl_per_token" : float(np.std(label_ppls)),
+        "ppl": float(np.exp(-mean_loss_per_token)),
+        "n_tokens": int(label_log_probs.shape[0]),
+        "n_batches" : n_batches,
+        "paths_to_shards" : writer.close(),
+    }
 
 def eval(model: BaseModel,
             dataset,
@@ -81,16 +234,21 @@ def eval(model: BaseModel,
             p_idxs: List[int],
             stride: int,
             config: Dict[str, Any],
+            path_to_shards_dir: str,
             device: str = "cuda",
-            is_debug: bool = False) -> Dict[str, Any]:
-    """Calculate average perplexity for a dataset split."""
-    results = []
+            is_debug: bool = False,
+            aggregator: Optional[TokenPPLAggregator] = None) -> Dict[str, Any]:
+    """
+    Calculate average perplexity for a dataset split. Per-token results are written to parquet shards in `path_to_shards_dir`.
+    If `aggregator` is given, it is also updated with every scored label.
+    """
+    writer = TokenResultsWriter(path_to_shards_dir)
 
     model.eval()
     model.to(device)
     with torch.no_grad():
         for p_idx in tqdm(p_idxs, total=len(p_idxs), desc='eval() | Iterating over patients...'):
-            results_for_pid = []
+            token_idxs_for_pid: List[np.ndarray] = []
             # Tokenize this patients timeline
             pid, events = dataset[p_idx]
             tokens: Dict[str, Float[torch.Tensor, 'B max_length']] = tokenizer([ events ], 
@@ -152,57 +310,168 @@ def eval(model: BaseModel,
                     assert log_probs_for_labels.shape[0] == min(seq_len, max_length) - 1, f"Error -- log_probs_for_labels.shape[0]={log_probs_for_labels.shape[0]} must equal min(seq_len, max_length) - 1={min(seq_len, max_length) - 1}"
                     assert trg_len-1 == log_probs_for_labels.shape[0], f"Error -- trg_len-1={trg_len-1} must equal log_probs_for_labels.shape[0]={log_probs_for_labels.shape[0]}"
                         
-                results_for_pid += [ {
-                    'pid' : pid,
-                    'n_events' : len(events),
-                    'n_tokens' : seq_len,
-                    'token_idx' : prev_end_idx + token_idx + (-1 if start_idx > 0 else 0), # account for shift by 1
-                    # what the model is supposed to predict....
-                    'label' : shift_labels[token_idx].item(),
-                    'label_log_prob' : log_prob,
-                    # what the model actually wants to predict....
-                    'argmax_label' : shift_logits[token_idx].argmax().item(),
-                    'argmax_log_prob' : log_probs[token_idx].max().item(),
-                } for token_idx, log_prob in enumerate(log_probs_for_labels.detach().cpu().numpy().tolist()) ]
-                # print(f"pid={pid} | n_events={len(events)} | n_tokens={seq_len} | start={start_idx} | end={end_idx} | n_tokens_for_ppl_calc={log_probs_for_labels.shape[0]} | ppl={np.exp(-log_probs_for_labels.detach().cpu().numpy().mean())}")
+                label_ranks: Float[torch.Tensor, 'L-1'] = (shift_logits > shift_logits.gather(dim=-1, index=shift_labels.unsqueeze(-1))).sum(dim=-1)
+                argmax_log_probs, argmax_labels = log_probs.max(dim=-1)
+                token_idxs: np.ndarray = np.arange(log_probs_for_labels.shape[0]) + prev_end_idx + (-1 if start_idx > 0 else 0) # account for shift by 1
+                writer.add(
+                    pid=pid,
+                    n_events=len(events),
+                    n_tokens=seq_len,
+                    token_idx=token_idxs,
+                    label=shift_labels.cpu().numpy(),
+                    label_log_prob=log_probs_for_labels.cpu().numpy(),
+                    label_rank=label_ranks.cpu().numpy(),
+                    argmax_label=argmax_labels.cpu().numpy(),
+                    argmax_log_prob=argmax_log_probs.cpu().numpy(),
+                )
+                if aggregator is not None:
+                    aggregator.add(shift_labels, log_probs_for_labels)
+                token_idxs_for_pid.append(token_idxs)
 
                 prev_end_idx = end_idx
                 if end_idx >= seq_len:
                     break
 
             # Sanity checks
-            assert len(results_for_pid) == seq_len - 1, f"Error -- len(results_for_pid)={len(results_for_pid)} must equal seq_len-1={seq_len - 1}"
-            assert results_for_pid[0]['token_idx'] == 0, f"Error -- first token_idx={results_for_pid[0]['token_idx']} must equal 0"
-            assert results_for_pid[-1]['token_idx'] == seq_len - 2, f"Error -- last token_idx{results_for_pid[-1]['token_idx']} must equal seq_len-2={seq_len - 2}"
-            assert len(set([ x['token_idx'] for x in results_for_pid ])) == len(results_for_pid), f"Error -- duplicate token_idx's found in results_for_pid"
-            assert [ int(x['token_idx']) for x in results_for_pid ] == list(range(seq_len - 1)), f"Error -- token_idx's not contiguous in results_for_pid"
-
-            # Save results
-            results += results_for_pid
+            token_idxs_for_pid: np.ndarray = np.concatenate(token_idxs_for_pid)
+            assert token_idxs_for_pid.shape[0] == seq_len - 1, f"Error -- len(token_idxs_for_pid)={token_idxs_for_pid.shape[0]} must equal seq_len-1={seq_len - 1}"
+            assert np.array_equal(token_idxs_for_pid, np.arange(seq_len - 1)), f"Error -- token_idx's not contiguous in token_idxs_for_pid"
+
             if is_debug and p_idx > 10:
                 break
 
-    mean_loss_per_token: float = np.mean([ x['label_log_prob'] for x in results ])
-    median_loss_per_token: float = np.median([ x['label_log_prob'] for x in results ])
-    std_loss_per_token: float = np.std([ x['label_log_prob'] for x in results ])
-    mean_ppl_per_token: float = np.mean([ np.exp(x['label_log_prob']) for x in results ])
-    median_ppl_per_token: float = np.median([ np.exp(x['label_log_prob']) for x in results ])
-    std_ppl_per_token: float = np.std([ np.exp(x['label_log_prob']) for x in results ])
-    n_tokens: int = len(results)
-    ppl: float = float(np.exp(-mean_loss_per_token))
+    return calc_summary_stats(writer, len(p_idxs))
 
-    return {
-        "mean_loss_per_token" : mean_loss_per_token,
-        "median_loss_per_token" : median_loss_per_token,
-        "std_loss_per_token" : std_loss_per_token,
-        "mean_ppl_per_token" : mean_ppl_per_token,
-        "median_ppl_per_token" : median_ppl_per_token,
-        "std_ppl_per_token" : std_ppl_per_token,
-        "ppl": ppl,
-        "n_tokens": n_tokens,
-        "n_batches" : len(p_idxs),
-        "results" : results,
-    }
+def get_windows(seq_len: int, max_length: int, stride: int) -> List[Tuple[int, int, int]]:
+    """
+    Split a timeline of `seq_len` tokens into windows of at most `max_length` tokens, advancing by `stride` tokens.
+    Returns a list of (start_idx, end_idx, first_label_idx) s.t. every label idx in [0, seq_len - 2] is scored 
+    by exactly one window, where label idx `j` means predicting token `j + 1` from tokens [start_idx, j].
+
+    NOTE: A window of `max_length` tokens has `max_length - 1` predictions, so `stride` is capped at `max_length - 1`.
+        Passing `stride == max_length` therefore gives non-overlapping windows (plus one token of shared context).
+    """
+    stride = min(stride, max_length - 1)
+    end_idx: int = min(max_length, seq_len)
+    windows: List[Tuple[int, int, int]] = [ (0, end_idx, 0) ]
+    while end_idx < seq_len:
+        prev_end_idx: int = end_idx
+        end_idx = min(prev_end_idx + stride, seq_len)
+        start_idx: int = max(0, end_idx - max_length)
+        windows.append((start_idx, end_idx, prev_end_idx - 1))
+    return windows
+
+def eval_batched(model: BaseModel,
+                    dataset,
+                    tokenizer,
+                    max_length: int,
+                    p_idxs: List[int],
+                    stride: int,
+                    config: Dict[str, Any],
+                    path_to_shards_dir: str,
+                    device: str = "cuda",
+                    max_tokens: int = 32_768,
+                    is_debug: bool = False,
+                    aggregator: Optional[TokenPPLAggregator] = None) -> Dict[str, Any]:
+    """
+    Same as `eval()`, but batches windows across patients s.t. each batch has at most `max_tokens` (incl. PAD) tokens.
+    Only the log prob of each target token is computed (via a logsumexp + gather on the logits of the scored positions),
+    so the full `log_softmax` over the vocab is never materialized.
+    """
+    assert max_tokens >= max_length, f"Error -- max_tokens={max_tokens} must be >= max_length={max_length}"
+    pad_token_id: int = tokenizer.pad_token_id
+    is_hyena: bool = 'hyena' in config['model']['name']
+    writer = TokenResultsWriter(path_to_shards_dir)
+
+    def run_batch(windows: List[Dict[str, Any]]) -> None:
+        """Run model on a batch of (right-padded) windows and save the results for their scored labels."""
+        # NOTE: Right padding is safe for causal models, as PAD tokens only come after the positions we score
+        max_window_len: int = max([ len(w['input_ids']) for w in windows ])
+        input_ids: Float[torch.Tensor, 'B L'] = torch.full((len(windows), max_window_len), pad_token_id, dtype=torch.long)
+        attention_mask: Float[torch.Tensor, 'B L'] = torch.zeros((len(windows), max_window_len), dtype=torch.long)
+        for b, w in enumerate(windows):
+            input_ids[b, :len(w['input_ids'])] = w['input_ids']
+            attention_mask[b, :len(w['input_ids'])] = 1
+        input_ids = input_ids.to(device, non_blocking=True)
+        attention_mask = attention_mask.to(device, non_blocking=True)
+        if is_hyena:
+            # Hyena's HF model ignores `attention_mask`, so use `hyena_forward()` to skip the padding
+            outputs = hyena_forward(model.model, input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+        else:
+            outputs = model.model(input_ids=input_ids, attention_mask=attention_mask)
+        logits: Float[torch.Tensor, 'B L V'] = outputs.logits
+
+        # Gather logits only for scored positions (i.e. labels not scored by a previous window)
+        batch_idxs: List[int] = []
+        pos_idxs: List[int] = []
+        for b, w in enumerate(windows):
+            pos: np.ndarray = np.arange(w['first_label_idx'], w['end_idx'] - 1) - w['start_idx']
+            batch_idxs.extend([ b ] * len(pos))
+            pos_idxs.extend(pos.tolist())
+        batch_idxs: Float[torch.Tensor, 'T'] = torch.tensor(batch_idxs, device=device)
+        pos_idxs: Float[torch.Tensor, 'T'] = torch.tensor(pos_idxs, device=device)
+        scored_logits: Float[torch.Tensor, 'T V'] = logits[batch_idxs, pos_idxs].float()
+        labels: Float[torch.Tensor, 'T'] = input_ids[batch_idxs, pos_idxs + 1]
+        log_z: Float[torch.Tensor, 'T'] = torch.logsumexp(scored_logits, dim=-1)
+        label_logits: Float[torch.Tensor, 'T'] = scored_logits.gather(dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+        label_ranks: Float[torch.Tensor, 'T'] = (scored_logits > label_logits.unsqueeze(-1)).sum(dim=-1)
+        argmax_logits, argmax_labels = scored_logits.max(dim=-1)
+        label_log_probs: Float[torch.Tensor, 'T'] = label_logits - log_z
+        if aggregator is not None:
+            aggregator.add(labels, label_log_probs)
+
+        # Save results
+        n_labels: np.ndarray = np.array([ w['end_idx'] - 1 - w['first_label_idx'] for w in windows ])
+        writer.add(
+            pid=np.repeat([ w['pid'] for w in windows ], n_labels),
+            n_events=np.repeat([ w['n_events'] for w in windows ], n_labels),
+            n_tokens=np.repeat([ w['n_tokens'] for w in windows ], n_labels),
+            token_idx=np.concatenate([ np.arange(w['first_label_idx'], w['end_idx'] - 1) for w in windows ]),
+            label=labels.cpu().numpy(),
+            label_log_prob=label_log_probs.cpu().numpy(),
+            label_rank=label_ranks.cpu().numpy(),
+            argmax_label=argmax_labels.cpu().numpy(),
+            argmax_log_prob=(argmax_logits - log_z).cpu().numpy(),
+        )
+
+    model.eval()
+    model.to(device)
+    with torch.no_grad():
+        pending_windows: List[Dict[str, Any]] = []
+        for p_idx in tqdm(p_idxs, total=len(p_idxs), desc='eval_batched() | Iterating over patients...'):
+            # Tokenize this patients timeline
+            pid, events = dataset[p_idx]
+            input_ids: Float[torch.Tensor, 'L'] = tokenizer([ events ], 
+                                                            truncation=False, 
+                                                            padding=False, 
+                                                            max_length=max_length,
+                                                            is_truncation_random=False,
+                                                            add_special_tokens=False,
+                                                            return_tensors='pt')['input_ids'][0]
+            seq_len: int = input_ids.shape[0]
+            if seq_len < 2:
+                # Need at least 2 tokens to calculate PPL
+                continue
+
+            for (start_idx, end_idx, first_label_idx) in get_windows(seq_len, max_length, stride):
+                if (len(pending_windows) + 1) * max_length > max_tokens:
+                    run_batch(pending_windows)
+                    pending_windows = []
+                pending_windows.append({
+                    'pid' : pid,
+                    'n_events' : len(events),
+                    'n_tokens' : seq_len,
+                    'start_idx' : start_idx,
+                    'end_idx' : end_idx,
+                    'first_label_idx' : first_label_idx,
+                    'input_ids' : input_ids[start_idx:end_idx],
+                })
+            if is_debug and p_idx > 10:
+                break
+        if len(pending_windows) > 0:
+            run_batch(pending_windows)
+
+    return calc_summary_stats(writer, len(p_idxs))
 
 def map_datasource_to_femr_extract(datasource: str) -> str:
     """Maps data source name (e.g. 'mimic4') to the proper path to FEMR extract"""
@@ -215,26 +484,43 @@ def map_datasource_to_femr_extract(datasource: str) -> str:
     else:
         raise ValueError(f"Unknown datasource: {datasource}")
 
-def add_calcs_to_df(df: pd.DataFrame, datasource: str, tokenizer) -> pd.DataFrame:
+def load_token_descriptions(tokenizer, datasource: str) -> pd.DataFrame:
+    """Returns a table mapping each token idx -> (token, text description of its code). Cached in the tokenizer's version dir."""
+    path_to_cache_file: str = os.path.join(tokenizer.path_to_tokenizer_version_dir, f'token_descriptions_{datasource}.parquet')
+    if os.path.exists(path_to_cache_file):
+        return pd.read_parquet(path_to_cache_file)
+
     import femr.datasets
     femr_db = femr.datasets.PatientDatabase(map_datasource_to_femr_extract(datasource))
-    def safe_get_description(x):
+    ontology = femr_db.get_ontology()
+    tokens: List[str] = [ tokenizer.idx_2_token[idx] for idx in range(len(tokenizer.idx_2_token)) ]
+    code_2_desc: Dict[str, str] = {}
+    for code in set([ token.split(" || ")[0] for token in tokens ]):
         try:
-            return femr_db.get_ontology().get_text_description(x.split(" || ")[0])
+            code_2_desc[code] = str(ontology.get_text_description(code))
         except Exception as e:
-            return None  # or return some other default value
-    df['label_ppl'] = np.exp(-df['label_log_prob']).astype(float)
-    df['label_as_token'] = df['label'].apply(lambda x: tokenizer.idx_2_token[x]).astype(str)
-    df['label_as_token_desc'] = df['label_as_token'].apply(lambda x: safe_get_description(x)).astype(str)
-    df['argmax_ppl'] = np.exp(-df['argmax_log_prob']).astype(float)
-    df['argmax_as_token'] = df['argmax_label'].apply(lambda x: tokenizer.idx_2_token[x]).astype(str)
-    df['argmax_as_token_desc'] = df['argmax_as_token'].apply(lambda x: safe_get_description(x)).astype(str)
-    df['pid'] = df['pid'].astype(int)
-    df['token_idx'] = df['token_idx'].astype(int)
-    df['n_events'] = df['n_events'].astype(int)
-    df['n_tokens'] = df['n_tokens'].astype(int)
-    df['label'] = df['label'].astype(int)
-    df['argmax_label'] = df['argmax_label'].astype(int)
+            code_2_desc[code] = str(None)
+    df = pd.DataFrame({
+        'token_idx' : np.arange(len(tokens)),
+        'token' : tokens,
+        'description' : [ code_2_desc[token.split(" || ")[0]] for token in tokens ],
+    })
+    df.to_parquet(path_to_cache_file, index=False)
+    logger.info(f"Saved token descriptions to `{path_to_cache_file}`")
+    return df
+
+def add_calcs_to_df(df: pd.DataFrame, datasource: str, tokenizer, token_descriptions: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """Add token strings + descriptions for `label` and `argmax_label` via a lookup into the (cached) token description table."""
+    if token_descriptions is None:
+        token_descriptions = load_token_descriptions(tokenizer, datasource)
+    idx_2_token: np.ndarray = token_descriptions['token'].to_numpy(dtype=object)
+    idx_2_desc: np.ndarray = token_descriptions['description'].to_numpy(dtype=object)
+    df['label_ppl'] = np.exp(-df['label_log_prob'].to_numpy(dtype=np.float64))
+    df['label_as_token'] = idx_2_token[df['label'].to_numpy()]
+    df['label_as_token_desc'] = idx_2_desc[df['label'].to_numpy()]
+    df['argmax_ppl'] = np.exp(-df['argmax_log_prob'].to_numpy(dtype=np.float64))
+    df['argmax_as_token'] = idx_2_token[df['argmax_label'].to_numpy()]
+    df['argmax_as_token_desc'] = idx_2_desc[df['argmax_label'].to_numpy()]
     return df
 
 def get_path_to_output_dir(path_to_ckpt_dir: str, split: str, dataset: str) -> str:
@@ -252,15 +538,20 @@ def run_ckpt(path_to_ckpt: str,
              stride: int,
              device: str, 
              is_load_from_config: bool, 
-             is_eval_debug: bool = False) -> None:
+             is_eval_debug: bool = False,
+             is_batched: bool = False,
+             max_tokens: int = 32_768,
+             is_write_token_ppl_stats: bool = False) -> None:
     """Load ckpt and run eval() on it"""
     initial_start = time.time()
     # Load model, tokenizer, config
-    ckpt: Dict[str, Any] = load_ckpt(path_to_ckpt)
-    model: BaseModel = load_model_from_path(path_to_ckpt)
-    config: Dict[str, Any] = load_config(ckpt)
-    tokenizer: BaseTokenizer = load_tokenizer_from_config(config)
+    # NOTE: The ckpt is read once (memory-mapped), then config + tokenizer + model are all served from this handle
+    ckpt_handle = CheckpointHandle(path_to_ckpt)
+    config: Dict[str, Any] = load_config(ckpt_handle.ckpt)
+    tokenizer: BaseTokenizer = ckpt_handle.tokenizer
+    model: BaseModel = load_model_from_path(ckpt_handle)
     logger.info(f"Model config: {config}")
+    max_length: int = config.data.dataloader.max_length
     
     if is_load_from_config:
         # Load dataset/dataloader for this split exactly as loaded during training based on `config`
@@ -276,7 +567,6 @@ def run_ckpt(path_to_ckpt: str,
         logger.info("Start | Loading dataset")
         start = time.time()
         path_to_femr_extract: str = map_datasource_to_femr_extract(datasource)
-        max_length: int = config.data.dataloader.max_length
         is_debug: bool = getattr(config.data.dataset, 'is_debug', False)
         seed: int = config.main.seed
         if dataset_name == 'FEMRDataset':
@@ -294,7 +584,13 @@ def run_ckpt(path_to_ckpt: str,
     random.seed(0)
     p_idxs: List[int] = random.sample(range(len(dataset)), n_patients)
     assert len(p_idxs) == n_patients, f"Error -- len(p_idxs)={len(p_idxs)} must equal n_patients={n_patients}"
-    raw_results = eval(model, dataset, tokenizer, max_length, p_idxs, stride, config, device, is_debug=is_eval_debug)
+    path_to_shards_dir: str = path_to_output + '_shards/'
+    aggregator = TokenPPLAggregator(len(tokenizer.get_vocab()), device=device)
+    if is_batched:
+        raw_results = eval_batched(model, dataset, tokenizer, max_length, p_idxs, stride, config, path_to_shards_dir, device, max_tokens=max_tokens, is_debug=is_eval_debug, aggregator=aggregator)
+    else:
+        raw_results = eval(model, dataset, tokenizer, max_length, p_idxs, stride, config, path_to_shards_dir, device, is_debug=is_eval_debug, aggregator=aggregator)
+    aggregator.all_reduce()
     logger.info(f"PPL: {raw_results['ppl']}")
     logger.info(f"Total tokens: {raw_results['n_tokens']}")
     logger.info(f"Finish | Calculating average perplexity | t={time.time() - start}")
@@ -306,6 +602,7 @@ def run_ckpt(path_to_ckpt: str,
         'split' : split,
         'dataset' : 'FEMRDataset',
         'stride' : stride,
+        'is_batched' : is_batched,
         'path_to_ckpt' : path_to_ckpt,
         'config' : OmegaConf.to_container(config, resolve=True),
         'is_debug' : is_eval_debug,
@@ -324,11 +621,26 @@ def run_ckpt(path_to_ckpt: str,
     with open(path_to_output + ".json", 'w') as f:
         json.dump(results, f, indent=2)
     logger.warning(f"Saved results to `{path_to_output}.json`")
-    # Save .parquet with token-level ppl's
-    df = pd.DataFrame(raw_results['results'])
-    df = add_calcs_to_df(df, datasource, tokenizer)
-    df.to_parquet(path_to_output + '.parquet', index=False)
+    # Save .parquet with token-level ppl's (one shard at a time, so memory stays bounded)
+    token_descriptions: pd.DataFrame = load_token_descriptions(tokenizer, datasource)
+    parquet_writer: Optional[pq.ParquetWriter] = None
+    for path_to_shard in raw_results['paths_to_shards']:
+        df = add_calcs_to_df(pd.read_parquet(path_to_shard), datasource, tokenizer, token_descriptions)
+        table: pa.Table = pa.Table.from_pandas(df, preserve_index=False)
+        if parquet_writer is None:
+            parquet_writer = pq.ParquetWriter(path_to_output + '.parquet', table.schema)
+        parquet_writer.write_table(table)
+    if parquet_writer is not None:
+        parquet_writer.close()
     logger.warning(f"Saved results to `{path_to_output}.parquet`")
+    # Save per-token PPL arrays (indexed by token ID)
+    aggregator.save(path_to_output + '_token_ppl.npz')
+    logger.warning(f"Saved results to `{path_to_output}_token_ppl.npz`")
+    if is_write_token_ppl_stats:
+        # NOTE: Model is identified by its run directory (i.e. the parent of `ckpts/`) + ckpt filename
+        model_name: str = f"{os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(path_to_ckpt))))}/{os.path.basename(path_to_ckpt).replace('.ckpt', '')}"
+        n_updated: int = write_token_ppl_stats_to_tokenizer_config(aggregator, tokenizer, datasource, split, model_name)
+        logger.warning(f"Wrote PPL stats for {n_updated} tokens to `{tokenizer.path_to_tokenizer_config}`")
 
 def main() -> None:
     args = parse_args()
@@ -349,6 +661,9 @@ def main() -> None:
     n_patients: int = args.n_patients
     is_load_from_config: bool = args.is_load_from_config
     is_debug: bool = args.is_debug
+    is_batched: bool = args.is_batched
+    max_tokens: int = args.max_tokens
+    is_write_token_ppl_stats: bool = args.is_write_token_ppl_stats
     path_to_output_dir: str = get_path_to_output_dir(path_to_ckpt_dir, f"{datasource}/{split}", f"dataset={dataset}-stride={stride}-n_patients={n_patients}-is_config={is_load_from_config}")
     logger.critical(f"Output directory: {path_to_output_dir}")
 
@@ -377,7 +692,7 @@ def main() -> None:
         logger.info("#"* 50)
         logger.info(f"Start | Processing model ckpt @ `{path_to_ckpt}`")
         try:
-            run_ckpt(path_to_ckpt, path_to_output, datasource, dataset, split, n_patients, stride, device, is_load_from_config, is_debug)
+            run_ckpt(path_to_ckpt, path_to_output, datasource, dataset, split, n_patients, stride, device, is_load_from_config, is_debug, is_batched=is_batched, max_tokens=max_tokens, is_write_token_ppl_stats=is_write_token_ppl_stats)
         except Exception as e:
             logger.critical(f"Error processing checkpoint @ `{path_to_ckpt}`: {e}")
             traceback.print_exc()
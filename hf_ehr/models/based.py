@@ -39,6 +39,11 @@ class BasedLanguageModel(BaseModel):
         # Run any post-init handlers from super()
         self.post_init()
     
+    def compute_loss(self, tokens: Dict[str, Any]) -> torch.Tensor:
+        # NOTE: Based doesn't return loss, so manually calculate
+        hidden_states: Float[torch.Tensor, 'B L H'] = self.model.transformer(tokens['input_ids'])
+        return self.lm_loss(hidden_states, tokens['input_ids'], self.model.lm_head)
+
     def training_step(self, 
                       batch: Dict[str, Any],
                       batch_idx: int) -> Optional[torch.Tensor]:
@@ -46,17 +51,7 @@ class BasedLanguageModel(BaseModel):
         tokens: Dict[str, Float[torch.Tensor, 'B L']] = batch['tokens']
         B: int = tokens['input_ids'].shape[0]
         
-        outputs = self.model(**tokens)
-        logits: Float[torch.Tensor, 'B L V'] = outputs.logits  # shape: [batch_size, seq_len, vocab_size]
-
-        # NOTE: Based doesn't return loss, so manually calculate
-        labels: Float[torch.Tensor, 'B L-1'] = tokens['input_ids'][:, 1:]  # shape: [batch_size, seq_len-1]
-        shift_logits: Float[torch.Tensor, 'B L-1 V'] = logits[:, :-1, :]  # shape: [batch_size, seq_len-1, vocab_size]
-        loss = torch.nn.functional.cross_entropy(
-            shift_logits.reshape(-1, shift_logits.size(-1)),  # shape: [batch_size * (seq_len-1), vocab_size]
-            labels.reshape(-1),  # shape: [batch_size * (seq_len-1)]
-            ignore_index=self.pad_token_id  # ignore padding tokens in loss calculation
-        )
+        loss: torch.Tensor = self.compute_loss(tokens)
         
         # Check if loss is NaN and synchronize this information across processes
         if torch.isnan(loss).any():
@@ -1,35 +1,68 @@
+import math
 import torch
 from transformers import AutoModelForMaskedLM, AutoConfig
 from jaxtyping import Float
-from typing import Dict, Any, Optional, Union
+from typing import Dict, Any, Optional, Tuple, Union
 from torch import nn
 from omegaconf import DictConfig
 from transformers.models.bert.modeling_bert import BertSelfAttention
 from hf_ehr.models.modules import BaseModel
 
+try:
+    # Fused rotary kernel (optional)
+    from flash_attn.layers.rotary import apply_rotary_emb as flash_apply_rotary_emb
+except ImportError:
+    flash_apply_rotary_emb = None
+
 # Custom Bert Self Attention Layer with RoPE
 class RoPEBertSelfAttention(BertSelfAttention):
-    def __init__(self, config):
+    """
+        NOTE: The cos/sin tables are computed once up to `config.max_position_embeddings` and cached as (non-persistent) buffers,
+        so they move with the module and are never saved into ckpts. Casts to the activation dtype are cached per (dtype, device).
+    """
+    def __init__(self, config, base: int = 10000):
         super().__init__(config)
+        dim: int = self.attention_head_size
+        inv_freq: torch.Tensor = 1.0 / (base ** (torch.arange(0, dim, 2).float() / dim))
+        self.register_buffer('inv_freq', inv_freq, persistent=False)
+        self.build_rope_cache(config.max_position_embeddings)
         print("Initialized RoPEBertSelfAttention with RoPE enabled.")
 
-    def apply_rope(self, q, k):
-        seq_len = q.shape[2]
-        dim = q.shape[-1]
-        inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2).float() / dim))
-
-        sinusoid_inp = torch.einsum("i,d->id", torch.arange(seq_len).float(), inv_freq)
-        sin = torch.sin(sinusoid_inp)
-        cos = torch.cos(sinusoid_inp)
-        sin, cos = sin.to(q.device), cos.to(q.device)
+    def build_rope_cache(self, max_seq_len: int, device: Optional[torch.device] = None):
+        t: torch.Tensor = torch.arange(max_seq_len, device=device if device is not None else self.inv_freq.device).float()
+        sinusoid_inp: torch.Tensor = torch.outer(t, self.inv_freq.to(t.device))
+        self.register_buffer('cos_cached', torch.cos(sinusoid_inp), persistent=False)
+        self.register_buffer('sin_cached', torch.sin(sinusoid_inp), persistent=False)
+        self.max_seq_len_cached: int = max_seq_len
+        self.cos_sin_cached_by_dtype: Dict[Any, Tuple[torch.Tensor, torch.Tensor]] = {}
+
+    def get_cos_sin(self, seq_len: int, dtype: torch.dtype, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        if seq_len > self.max_seq_len_cached:
+            # Only happens if inputs are longer than `max_position_embeddings`
+            self.build_rope_cache(seq_len, device=device)
+        key = (dtype, device)
+        if key not in self.cos_sin_cached_by_dtype:
+            self.cos_sin_cached_by_dtype[key] = (self.cos_cached.to(device=device, dtype=dtype), self.sin_cached.to(device=device, dtype=dtype))
+        cos, sin = self.cos_sin_cached_by_dtype[key]
+        return cos[:seq_len], sin[:seq_len]
 
-        print(f"RoPE is being applied: Sequence Length = {seq_len}, Dim = {dim}")
+    def apply_rope(self, q, k):
+        """
+            q, k: (B, H, L, D)
+            NOTE: The fused kernel keeps rotated pairs interleaved, while the fallback returns [even | odd] halves.
+            Both apply the same permutation to `q` and `k`, so `q @ k^T` (the only place they're used) is identical.
+        """
+        seq_len: int = q.shape[2]
+        cos, sin = self.get_cos_sin(seq_len, q.dtype, q.device)
+        if flash_apply_rotary_emb is not None and q.is_cuda:
+            # flash-attn expects (B, L, H, D)
+            q_rot = flash_apply_rotary_emb(q.transpose(1, 2), cos, sin, interleaved=True).transpose(1, 2)
+            k_rot = flash_apply_rotary_emb(k.transpose(1, 2), cos, sin, interleaved=True).transpose(1, 2)
+            return q_rot, k_rot
         q_sin_cos = torch.cat([q[..., ::2] * cos - q[..., 1::2] * sin,
                                q[..., ::2] * sin + q[..., 1::2] * cos], dim=-1)
         k_sin_cos = torch.cat([k[..., ::2] * cos - k[..., 1::2] * sin,
                                k[..., ::2] * sin + k[..., 1::2] * cos], dim=-1)
-
-        print(f"q shape after RoPE: {q_sin_cos.shape}, k shape after RoPE: {k_sin_cos.shape}")
         return q_sin_cos, k_sin_cos
 
     def forward(self, hidden_states, attention_mask=None, head_mask=None, encoder_hidden_states=None, encoder_attention_mask=None, past_key_value=None, output_attentions=False):
@@ -47,8 +80,18 @@ class RoPEBertSelfAttention(BertSelfAttention):
 
         query_layer, key_layer = self.apply_rope(query_layer, key_layer)
 
+        if not output_attentions and head_mask is None:
+            # Fused SDPA kernel (flash / memory-efficient on GPU, fused on CPU), w/ the same additive mask + scale as below
+            context_layer = torch.nn.functional.scaled_dot_product_attention(query_layer, 
+                                                                             key_layer, 
+                                                                             value_layer, 
+                                                                             attn_mask=attention_mask.to(query_layer.dtype) if attention_mask is not None else None, 
+                                                                             dropout_p=self.dropout.p if self.training else 0.0)
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            return (context_layer.view(*context_layer.size()[:-2], self.all_head_size),)
+
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / torch.sqrt(torch.tensor(self.attention_head_size, dtype=torch.float32))
+        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
 
         if attention_mask is not None:
             attention_scores = attention_scores + attention_mask
@@ -97,15 +140,20 @@ class BERTLanguageModel(BaseModel):
         for layer in self.model.bert.encoder.layer:
             layer.attention.self = RoPEBertSelfAttention(self.model.config)
 
+    def compute_loss(self, tokens: Dict[str, Any]) -> torch.Tensor:
+        # NOTE: Masked LM, so no shift -- unmasked positions have label -100
+        hidden_states: Float[torch.Tensor, 'B L H'] = self.model.bert(input_ids=tokens['input_ids'], 
+                                                                      attention_mask=tokens.get('attention_mask'), 
+                                                                      token_type_ids=tokens.get('token_type_ids')).last_hidden_state
+        return self.lm_loss(hidden_states, tokens['labels'], self.model.cls, is_shift=False)
+
     def training_step(self, 
                       batch: Dict[str, Any],
                       batch_idx: int) -> Optional[torch.Tensor]:
         tokens: Dict[str, Float[torch.Tensor, 'B L']] = batch['tokens']
         B: int = tokens['input_ids'].shape[0]
 
-        outputs = self.model(**tokens)
-        loss: torch.Tensor = outputs.loss
-        ppl: torch.Tensor = torch.exp(loss).detach()
+        loss: torch.Tensor = self.compute_loss(tokens)
         
         # Learning rate scheduler
         lr: float = self.trainer.lr_scheduler_configs[0].scheduler.optimizer.param_groups[0]["lr"]
@@ -0,0 +1,191 @@
+"""
+CPU-optimized inference for GPT / Llama / BERT checkpoints.
+
+Converts a model loaded via `load_model_from_path()` into a CPU-friendly copy:
+    1. fp32 weights on CPU (ckpts trained w/ flash attention are stored in bf16)
+    2. PyTorch SDPA attention (instead of flash attention / eager attention), by rebuilding the HF model w/ `attn_implementation='sdpa'`
+    3. GPT-2's `Conv1D` projections swapped for equivalent `nn.Linear` layers (so they can be quantized)
+    4. Dynamic int8 quantization of all `nn.Linear` layers (weights are int8, activations are quantized on the fly)
+
+Usage:
+    set_cpu_threads(n_threads=16)
+    model = load_cpu_model_from_path(path_to_ckpt, is_quantize=True)
+    logits = model.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+See `hf_ehr/scripts/eval/cpu_inference.py` for a harness that checks logits + EHRSHOT features against the fp32 model.
+"""
+import copy
+import torch
+from typing import Dict, Any, Optional, Union
+from jaxtyping import Float
+from loguru import logger
+
+from hf_ehr.utils import CheckpointHandle, load_model_from_path
+
+# Model families whose HF modules are pure PyTorch (i.e. no custom CUDA kernels), so they can run on CPU
+CPU_SUPPORTED_MODELS = [ 'gpt', 'llama', 'bert' ]
+
+def set_cpu_threads(n_threads: Optional[int] = None, n_interop_threads: Optional[int] = None) -> None:
+    """Set # of threads used within an op (`n_threads`) and across independent ops (`n_interop_threads`). None => leave as is."""
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    if n_interop_threads is not None:
+        # NOTE: Can only be set once, before any inter-op parallel work has started
+        try:
+            torch.set_num_interop_threads(n_interop_threads)
+        except RuntimeError as e:
+            logger.warning(f"Could not set # of inter-op threads to {n_interop_threads}: {e}")
+    logger.info(f"CPU threads | intra-op={torch.get_num_threads()} | inter-op={torch.get_num_interop_threads()}")
+
+def is_cpu_supported(model_name: str) -> bool:
+    return any(x in model_name.lower() for x in CPU_SUPPORTED_MODELS)
+
+def convert_conv1d_to_linear(module: torch.nn.Module) -> torch.nn.Module:
+    """
+        Replace every HF `Conv1D` (used by GPT-2 for its attention/MLP projections) with an equivalent `nn.Linear`, in place.
+        `Conv1D` stores its weight as (in, out), so it is transposed. Needed b/c `quantize_dynamic()` only quantizes `nn.Linear`.
+    """
+    from transformers.pytorch_utils import Conv1D
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features, bias=child.bias is not None, device=child.weight.device, dtype=child.weight.dtype)
+            with torch.no_grad():
+                linear.weight.copy_(child.weight.t())
+                if child.bias is not None:
+                    linear.bias.copy_(child.bias)
+            setattr(module, name, linear)
+        else:
+            convert_conv1d_to_linear(child)
+    return module
+
+def set_attn_implementation(module: torch.nn.Module, attn_implementation: str) -> torch.nn.Module:
+    """
+        Set the attention implementation (e.g. 'sdpa', 'eager') of every HF config in `module`, in place.
+
+        NOTE: Recent versions of `transformers` pick the attention function at forward time from `config._attn_implementation`,
+        so flipping the (shared) config is enough. Older versions pick the attention class at init, in which case the model
+        must be built on a CPU-only host (where our wrappers don't request flash attention and HF defaults to SDPA).
+    """
+    for submodule in module.modules():
+        config = getattr(submodule, 'config', None)
+        if config is not None and hasattr(config, '_attn_implementation'):
+            config._attn_implementation = attn_implementation
+    return module
+
+def rebuild_with_attn_implementation(model: torch.nn.Module, attn_implementation: str) -> torch.nn.Module:
+    """
+        Rebuild the HF model of `model` (a `BaseModel`) from its config with `attn_implementation`, then load its weights back in, in place.
+
+        NOTE: HF picks the attention class of some models (e.g. BERT, and GPT-2 / Llama ckpts built w/ flash attention on a GPU host)
+        when the model is constructed, so flipping `config._attn_implementation` on an existing model isn't enough.
+    """
+    hf_model: torch.nn.Module = model.model
+    hf_config = copy.deepcopy(hf_model.config)
+    hf_config.torch_dtype = torch.float32
+    state_dict: Dict[str, torch.Tensor] = hf_model.state_dict()
+    model.model = type(hf_model)._from_config(hf_config, attn_implementation=attn_implementation, torch_dtype=torch.float32)
+    if getattr(model, 'is_use_rope', False):
+        # RoPE BERT swaps in its own self-attention layers (which call SDPA directly, see `RoPEBertSelfAttention`)
+        model._replace_attention_with_rope()
+    model.model.load_state_dict(state_dict)
+    model.model.to(device='cpu', dtype=torch.float32)
+    return model
+
+def use_sdpa_attention(model: torch.nn.Module) -> torch.nn.Module:
+    """Route attention of `model` (a `BaseModel`) through `torch.nn.functional.scaled_dot_product_attention`, in place."""
+    return rebuild_with_attn_implementation(model, 'sdpa')
+
+def get_attention_module_types(module: torch.nn.Module) -> Dict[str, str]:
+    """
+        Map each innermost attention module in `module` (i.e. w/o a child attention module) to the attention it runs, e.g. 
+        `GPT2SdpaAttention` => 'sdpa'. Modules that dispatch on `config._attn_implementation` at forward time report that instead.
+    """
+    import sys
+    from hf_ehr.models.bert import RoPEBertSelfAttention
+    results: Dict[str, str] = {}
+    for name, submodule in module.named_modules():
+        class_name: str = type(submodule).__name__
+        if not class_name.endswith('Attention') or any(type(child).__name__.endswith('Attention') for child in submodule.children()):
+            continue
+        if isinstance(submodule, RoPEBertSelfAttention) or 'Sdpa' in class_name:
+            results[name] = 'sdpa'
+        elif 'Flash' in class_name:
+            results[name] = 'flash_attention_2'
+        elif hasattr(sys.modules[type(submodule).__module__], 'ALL_ATTENTION_FUNCTIONS') and getattr(submodule, 'config', None) is not None:
+            results[name] = submodule.config._attn_implementation
+        else:
+            results[name] = 'eager'
+    return results
+
+def check_sdpa_attention(module: torch.nn.Module) -> None:
+    """Raise if any attention module in `module` doesn't run through SDPA."""
+    attention_module_types: Dict[str, str] = get_attention_module_types(module)
+    assert len(attention_module_types) > 0, "Error -- No attention modules found"
+    non_sdpa: Dict[str, str] = { name : attn for name, attn in attention_module_types.items() if attn != 'sdpa' }
+    assert len(non_sdpa) == 0, f"Error -- {len(non_sdpa)} / {len(attention_module_types)} attention modules don't use SDPA, e.g.: {list(non_sdpa.items())[:3]}"
+
+def quantize_linear_layers(module: torch.nn.Module, dtype: torch.dtype = torch.qint8) -> torch.nn.Module:
+    """Dynamic int8 quantization of every `nn.Linear` in `module`. Returns a new module (the input is left unchanged)."""
+    return torch.ao.quantization.quantize_dynamic(module, { torch.nn.Linear }, dtype=dtype, inplace=False)
+
+def optimize_model_for_cpu(model: torch.nn.Module, is_quantize: bool = True, is_copy: bool = True) -> torch.nn.Module:
+    """
+        Returns a CPU-optimized version of `model` (a `BaseModel`, i.e. the HF model lives in `model.model`).
+        If `is_copy`, then `model` itself is left untouched (useful for comparing against the fp32 model).
+    """
+    model_name: str = model.config['model']['name'] if hasattr(model, 'config') else type(model).__name__
+    if not is_cpu_supported(model_name):
+        raise ValueError(f"CPU inference is only supported for {CPU_SUPPORTED_MODELS}, not `{model_name}`")
+    if is_copy:
+        model = copy.deepcopy(model)
+    model = model.to(device='cpu', dtype=torch.float32)
+    use_sdpa_attention(model)
+    model.eval()
+    convert_conv1d_to_linear(model.model)
+    if is_quantize:
+        model.model = quantize_linear_layers(model.model)
+    return model
+
+def load_cpu_model_from_path(path_to_ckpt: Union[str, CheckpointHandle], is_quantize: bool = True) -> torch.nn.Module:
+    """Load a model ckpt (or safetensors export) directly into its CPU-optimized form."""
+    model: torch.nn.Module = load_model_from_path(path_to_ckpt, device='cpu')
+    return optimize_model_for_cpu(model, is_quantize=is_quantize, is_copy=False)
+
+def get_model_size_bytes(model: torch.nn.Module) -> int:
+    """Size of `model`'s serialized state dict (counts packed int8 weights of quantized layers, unlike `.parameters()`)."""
+    import io
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+def compare_logits(logits_ref: Float[torch.Tensor, 'B L V'],
+                   logits: Float[torch.Tensor, 'B L V'],
+                   attention_mask: Optional[Float[torch.Tensor, 'B L']] = None) -> Dict[str, Any]:
+    """Agreement between reference (fp32) logits and optimized logits, over non-PAD positions."""
+    logits_ref, logits = logits_ref.float(), logits.float()
+    is_valid: torch.Tensor = attention_mask.bool() if attention_mask is not None else torch.ones(logits.shape[:2], dtype=torch.bool)
+    logits_ref, logits = logits_ref[is_valid], logits[is_valid]
+    log_probs_ref: Float[torch.Tensor, 'T V'] = torch.log_softmax(logits_ref, dim=-1)
+    log_probs: Float[torch.Tensor, 'T V'] = torch.log_softmax(logits, dim=-1)
+    kl: Float[torch.Tensor, 'T'] = (log_probs_ref.exp() * (log_probs_ref - log_probs)).sum(dim=-1)
+    return {
+        'max_abs_diff_logits' : float((logits_ref - logits).abs().max()),
+        'mean_abs_diff_logits' : float((logits_ref - logits).abs().mean()),
+        'mean_kl_div' : float(kl.mean()),
+        'max_kl_div' : float(kl.max()),
+        'top1_agreement' : float((logits_ref.argmax(dim=-1) == logits.argmax(dim=-1)).float().mean()),
+        'n_tokens' : int(is_valid.sum()),
+    }
+
+def compare_embeddings(embeds_ref: Float[torch.Tensor, 'B H'], embeds: Float[torch.Tensor, 'B H']) -> Dict[str, Any]:
+    """Agreement between reference (fp32) patient embeddings and optimized embeddings."""
+    embeds_ref, embeds = embeds_ref.float(), embeds.float()
+    cos_sim: Float[torch.Tensor, 'B'] = torch.nn.functional.cosine_similarity(embeds_ref, embeds, dim=-1)
+    return {
+        'mean_cosine_sim' : float(cos_sim.mean()),
+        'min_cosine_sim' : float(cos_sim.min()),
+        'max_abs_diff' : float((embeds_ref - embeds).abs().max()),
+        'mean_rel_l2_error' : float(((embeds_ref - embeds).norm(dim=-1) / embeds_ref.norm(dim=-1).clamp(min=1e-12)).mean()),
+        'n_patients' : int(embeds.shape[0]),
+    }
@@ -0,0 +1,227 @@
+"""
+Export GPT / Llama / BERT / T5 checkpoints to ONNX or TorchScript, for serving with optimized runtimes (e.g. onnxruntime).
+
+Each export directory contains:
+    model.onnx | model.pt   -- the exported graph, with dynamic batch + sequence axes
+    tokenizer_config.json   -- copy of the ckpt's tokenizer config (so the export is self-contained)
+    config.yaml             -- the ckpt's Hydra config
+    export_metadata.json    -- format, input/output names, vocab size, PAD id, etc.
+
+Inputs are `input_ids` and `attention_mask` (both int64, shape B x L). Outputs are:
+    Causal LMs (GPT, Llama) + BERT:  `logits` (B x L x V), `last_hidden_state` (B x L x H)
+    T5:                              `last_hidden_state` (B x L x H) of the encoder
+
+Usage:
+    export_ckpt(path_to_ckpt, path_to_output_dir, format='onnx')
+    model = load_exported_model(path_to_output_dir)
+    outputs = model(input_ids, attention_mask) # dict of numpy arrays
+"""
+import os
+import json
+import shutil
+import torch
+import numpy as np
+from typing import Dict, Any, List, Optional, Tuple, Union, Callable
+from jaxtyping import Float
+from loguru import logger
+
+from hf_ehr.utils import CheckpointHandle, get_ckpt_handle
+from hf_ehr.models.cpu_inference import set_attn_implementation, convert_conv1d_to_linear
+
+EXPORT_SUPPORTED_MODELS = [ 'gpt', 'llama', 'bert', 't5' ]
+EXPORT_FORMATS = [ 'onnx', 'torchscript' ]
+EXPORT_MODEL_FILES: Dict[str, str] = { 'onnx' : 'model.onnx', 'torchscript' : 'model.pt' }
+EXPORT_TOKENIZER_CONFIG_FILE: str = 'tokenizer_config.json'
+EXPORT_CONFIG_FILE: str = 'config.yaml'
+EXPORT_METADATA_FILE: str = 'export_metadata.json'
+EXPORT_INPUT_NAMES: List[str] = [ 'input_ids', 'attention_mask' ]
+
+class ExportWrapper(torch.nn.Module):
+    """Wraps a HF model so that it takes positional (input_ids, attention_mask) and returns a tuple of tensors (as tracing requires)."""
+
+    def __init__(self, model: torch.nn.Module) -> None:
+        super().__init__()
+        self.model = model
+        self.is_encoder_decoder: bool = getattr(model.config, 'is_encoder_decoder', False)
+        self.output_names: List[str] = [ 'last_hidden_state' ] if self.is_encoder_decoder else [ 'logits', 'last_hidden_state' ]
+
+    def forward(self, input_ids: Float[torch.Tensor, 'B L'], attention_mask: Float[torch.Tensor, 'B L']) -> Tuple[torch.Tensor, ...]:
+        if self.is_encoder_decoder:
+            # NOTE: Only the encoder is exported (i.e. what is used for featurization)
+            return (self.model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state,)
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True, return_dict=True)
+        return (outputs.logits, outputs.hidden_states[-1])
+
+def is_export_supported(model_name: str) -> bool:
+    return any(x in model_name.lower() for x in EXPORT_SUPPORTED_MODELS)
+
+def prepare_model_for_export(model: torch.nn.Module) -> ExportWrapper:
+    """
+        Convert a `BaseModel` into a traceable fp32 CPU module, in place.
+        Attention is switched to 'eager', since flash attention can't be traced and eager attention is supported by every runtime.
+    """
+    model_name: str = model.config['model']['name'] if hasattr(model, 'config') else type(model).__name__
+    if not is_export_supported(model_name):
+        raise ValueError(f"Export is only supported for {EXPORT_SUPPORTED_MODELS}, not `{model_name}`")
+    model = model.to(device='cpu', dtype=torch.float32)
+    model.eval()
+    hf_model: torch.nn.Module = model.model
+    set_attn_implementation(hf_model, 'eager')
+    convert_conv1d_to_linear(hf_model)
+    if hasattr(hf_model.config, 'use_cache'):
+        # Don't return past key values
+        hf_model.config.use_cache = False
+    return ExportWrapper(hf_model).eval()
+
+def make_example_inputs(batch_size: int, seq_length: int, vocab_size: int, pad_token_id: int, seed: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Random (input_ids, attention_mask) where every row after the first is left-padded by a different amount."""
+    generator = torch.Generator().manual_seed(seed)
+    input_ids: Float[torch.Tensor, 'B L'] = torch.randint(0, vocab_size, (batch_size, seq_length), generator=generator)
+    input_ids[input_ids == pad_token_id] = (pad_token_id + 1) % vocab_size
+    for b in range(1, batch_size):
+        input_ids[b, :min(b * seq_length // (2 * batch_size), seq_length - 1)] = pad_token_id
+    attention_mask: Float[torch.Tensor, 'B L'] = (input_ids != pad_token_id).long()
+    return input_ids, attention_mask
+
+def export_to_onnx(wrapper: ExportWrapper, path_to_file: str, example_inputs: Tuple[torch.Tensor, torch.Tensor], opset_version: int = 17) -> str:
+    """Export `wrapper` to ONNX with dynamic batch + sequence axes on all inputs/outputs."""
+    dynamic_axes: Dict[str, Dict[int, str]] = { name : { 0 : 'batch', 1 : 'sequence' } for name in EXPORT_INPUT_NAMES + wrapper.output_names }
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            example_inputs,
+            path_to_file,
+            input_names=EXPORT_INPUT_NAMES,
+            output_names=wrapper.output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    return path_to_file
+
+def export_to_torchscript(wrapper: ExportWrapper, path_to_file: str, example_inputs: Tuple[torch.Tensor, torch.Tensor]) -> str:
+    """Trace `wrapper` to TorchScript. Shapes stay dynamic, since HF models don't branch on the batch/sequence length at trace time."""
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, example_inputs, strict=False, check_trace=False)
+    traced.save(path_to_file)
+    return path_to_file
+
+class ExportedModel:
+    """Runs an export directory created by `export_ckpt()`. Called with int64 numpy arrays / tensors; returns a dict of numpy arrays."""
+
+    def __init__(self, path_to_dir: str, providers: Optional[List[str]] = None) -> None:
+        self.path_to_dir: str = path_to_dir
+        with open(os.path.join(path_to_dir, EXPORT_METADATA_FILE), 'r') as f:
+            self.metadata: Dict[str, Any] = json.load(f)
+        self.format: str = self.metadata['format']
+        self.output_names: List[str] = self.metadata['output_names']
+        path_to_model: str = os.path.join(path_to_dir, EXPORT_MODEL_FILES[self.format])
+        if self.format == 'onnx':
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(path_to_model, providers=providers if providers is not None else [ 'CPUExecutionProvider' ])
+        elif self.format == 'torchscript':
+            self.module = torch.jit.load(path_to_model, map_location='cpu')
+            self.module.eval()
+        else:
+            raise ValueError(f"Unknown export format: {self.format}")
+
+    def __call__(self, input_ids: Union[np.ndarray, torch.Tensor], attention_mask: Union[np.ndarray, torch.Tensor]) -> Dict[str, np.ndarray]:
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        attention_mask = np.asarray(attention_mask, dtype=np.int64)
+        if self.format == 'onnx':
+            outputs = self.session.run(self.output_names, { 'input_ids' : input_ids, 'attention_mask' : attention_mask })
+        else:
+            with torch.no_grad():
+                outputs = [ x.numpy() for x in self.module(torch.from_numpy(input_ids), torch.from_numpy(attention_mask)) ]
+        return dict(zip(self.output_names, outputs))
+
+def load_exported_model(path_to_dir: str, providers: Optional[List[str]] = None) -> ExportedModel:
+    return ExportedModel(path_to_dir, providers=providers)
+
+def check_export_parity(wrapper: ExportWrapper,
+                        exported_model: Callable[..., Dict[str, np.ndarray]],
+                        inputs: List[Tuple[torch.Tensor, torch.Tensor]],
+                        atol: float = 1e-3) -> Dict[str, Any]:
+    """
+        Compare eager outputs of `wrapper` against `exported_model` on each (input_ids, attention_mask) in `inputs`.
+        Only non-PAD positions are compared (PAD positions are never read downstream).
+        Returns the max abs diff per output, and whether all outputs are within `atol`.
+    """
+    max_abs_diffs: Dict[str, float] = { name : 0.0 for name in wrapper.output_names }
+    for input_ids, attention_mask in inputs:
+        with torch.no_grad():
+            outputs_eager: Dict[str, np.ndarray] = { name : x.numpy() for name, x in zip(wrapper.output_names, wrapper(input_ids, attention_mask)) }
+        outputs_export: Dict[str, np.ndarray] = exported_model(input_ids.numpy(), attention_mask.numpy())
+        is_valid: np.ndarray = attention_mask.numpy().astype(bool)
+        for name in wrapper.output_names:
+            assert outputs_eager[name].shape == outputs_export[name].shape, f"Error -- `{name}` has shape {outputs_export[name].shape} in export, but {outputs_eager[name].shape} in eager for input of shape {tuple(input_ids.shape)}"
+            diff: float = float(np.abs(outputs_eager[name][is_valid] - outputs_export[name][is_valid]).max())
+            max_abs_diffs[name] = max(max_abs_diffs[name], diff)
+    return {
+        'max_abs_diffs' : max_abs_diffs,
+        'atol' : atol,
+        'shapes' : [ list(input_ids.shape) for input_ids, _ in inputs ],
+        'is_match' : all(diff <= atol for diff in max_abs_diffs.values()),
+    }
+
+def export_ckpt(path_to_ckpt: Union[str, CheckpointHandle],
+                path_to_output_dir: str,
+                format: str = 'onnx',
+                opset_version: int = 17,
+                is_check_parity: bool = True,
+                atol: float = 1e-3) -> Dict[str, Any]:
+    """
+        Export a ckpt (or safetensors export) to `path_to_output_dir` as ONNX or TorchScript, alongside its config + tokenizer config.
+        If `is_check_parity`, the export is reloaded and compared against eager outputs on shapes that differ from the traced example.
+        Returns the export metadata (incl. parity results).
+    """
+    from omegaconf import OmegaConf
+    assert format in EXPORT_FORMATS, f"Error -- format={format} must be one of {EXPORT_FORMATS}"
+    ckpt_handle: CheckpointHandle = get_ckpt_handle(path_to_ckpt)
+    config = ckpt_handle.config
+    tokenizer = ckpt_handle.tokenizer
+    vocab_size: int = tokenizer.vocab_size
+    pad_token_id: int = tokenizer.pad_token_id
+    max_length: int = config.data.dataloader.max_length
+    os.makedirs(path_to_output_dir, exist_ok=True)
+
+    # Export
+    wrapper: ExportWrapper = prepare_model_for_export(ckpt_handle.load_model(device='cpu'))
+    example_inputs: Tuple[torch.Tensor, torch.Tensor] = make_example_inputs(2, min(16, max_length), vocab_size, pad_token_id)
+    path_to_model: str = os.path.join(path_to_output_dir, EXPORT_MODEL_FILES[format])
+    logger.info(f"Exporting `{config.model.name}` to {format} @ `{path_to_model}`")
+    if format == 'onnx':
+        export_to_onnx(wrapper, path_to_model, example_inputs, opset_version=opset_version)
+    else:
+        export_to_torchscript(wrapper, path_to_model, example_inputs)
+
+    # Save config + tokenizer + metadata
+    OmegaConf.save(config=config, f=os.path.join(path_to_output_dir, EXPORT_CONFIG_FILE))
+    shutil.copy(tokenizer.path_to_tokenizer_config, os.path.join(path_to_output_dir, EXPORT_TOKENIZER_CONFIG_FILE))
+    metadata: Dict[str, Any] = {
+        'format' : format,
+        'model_name' : config.model.name,
+        'input_names' : EXPORT_INPUT_NAMES,
+        'output_names' : wrapper.output_names,
+        'vocab_size' : vocab_size,
+        'pad_token_id' : pad_token_id,
+        'max_length' : max_length,
+        'opset_version' : opset_version if format == 'onnx' else None,
+        'torch_version' : torch.__version__,
+        'path_to_ckpt' : os.path.abspath(ckpt_handle.path_to_ckpt),
+    }
+    with open(os.path.join(path_to_output_dir, EXPORT_METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    # Parity check on shapes that differ from the traced example (so dynamic axes are exercised)
+    if is_check_parity:
+        parity_inputs: List[Tuple[torch.Tensor, torch.Tensor]] = [
+            make_example_inputs(1, min(7, max_length), vocab_size, pad_token_id, seed=1),
+            make_example_inputs(3, min(64, max_length), vocab_size, pad_token_id, seed=2),
+        ]
+        metadata['parity'] = check_export_parity(wrapper, load_exported_model(path_to_output_dir), parity_inputs, atol=atol)
+        with open(os.path.join(path_to_output_dir, EXPORT_METADATA_FILE), 'w') as f:
+            json.dump(metadata, f, indent=2)
+        if not metadata['parity']['is_match']:
+            logger.warning(f"Exported model differs from eager model by more than atol={atol}: {metadata['parity']['max_abs_diffs']}")
+    return metadata
@@ -20,7 +20,7 @@ class GPTLanguageModel(BaseModel):
         super(GPTLanguageModel, self).__init__(config, vocab_size, pad_token_id)
 
         # Enable flash attention
-        if torch.cuda.get_device_capability('cuda')[0] >= 8:
+        if torch.cuda.is_available() and torch.cuda.get_device_capability('cuda')[0] >= 8:
             kwargs = {
                 'attn_implementation': 'flash_attention_2',
                 'torch_dtype': torch.bfloat16,
@@ -50,6 +50,10 @@ class GPTLanguageModel(BaseModel):
         # Run any post-init handlers from super()
         self.post_init()
     
+    def compute_loss(self, tokens: Dict[str, Any]) -> torch.Tensor:
+        hidden_states: Float[torch.Tensor, 'B L H'] = self.model.transformer(input_ids=tokens['input_ids'], attention_mask=tokens.get('attention_mask')).last_hidden_state
+        return self.lm_loss(hidden_states, tokens['labels'], self.model.lm_head)
+
     def training_step(self, 
                       batch: Dict[str, Any],
                       batch_idx: int) -> Optional[torch.Tensor]:
@@ -57,8 +61,7 @@ class GPTLanguageModel(BaseModel):
         tokens: Dict[str, Float[torch.Tensor, 'B L']] = batch['tokens']
         B: int = tokens['input_ids'].shape[0]
 
-        outputs = self.model(**tokens)
-        loss: torch.Tensor = outputs.loss
+        loss: torch.Tensor = self.compute_loss(tokens)
 
         # Check if loss is NaN and handle accordingly
         if torch.isnan(loss).any():
@@ -1,12 +1,30 @@
 import torch
-import torch.nn as nn
 from transformers import AutoConfig, AutoModelForCausalLM
 from transformers.modeling_outputs import CausalLMOutput
 from omegaconf import DictConfig
 from typing import Dict, Any, Optional, Tuple, Union
 from jaxtyping import Float
 
-from hf_ehr.models.modules import BaseModel
+from hf_ehr.models.modules import BaseModel, padding_aware_cross_entropy
+
+def left_align_by_mask(attention_mask: Float[torch.Tensor, 'B L']) -> Tuple[Float[torch.Tensor, 'B L'], int]:
+    """
+        Returns `order` such that `x.gather(1, order)` moves each row's real (i.e. non-PAD) tokens to the front while keeping 
+        their relative order (i.e. makes every row right-padded), and the length of the longest row.
+    """
+    order: Float[torch.Tensor, 'B L'] = torch.sort((attention_mask == 0).to(torch.int8), dim=1, stable=True).indices
+    max_len: int = int(attention_mask.sum(dim=1).max().item())
+    return order, max(max_len, 1)
+
+def gather_by_order(x: Float[torch.Tensor, 'B L ...'], order: Float[torch.Tensor, 'B T']) -> Float[torch.Tensor, 'B T ...']:
+    if x.dim() == 2:
+        return x.gather(1, order)
+    return x.gather(1, order.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+
+def scatter_by_order(x: Float[torch.Tensor, 'B T H'], order: Float[torch.Tensor, 'B T'], mask: Float[torch.Tensor, 'B T'], seq_len: int) -> Float[torch.Tensor, 'B L H']:
+    """Inverse of `gather_by_order()` -- puts each row back in its original (padded) positions, with zeros at PAD positions."""
+    out: Float[torch.Tensor, 'B L H'] = x.new_zeros((x.shape[0], seq_len, x.shape[-1]))
+    return out.scatter(1, order.unsqueeze(-1).expand(-1, -1, x.shape[-1]), x * mask.unsqueeze(-1).to(x.dtype))
 
 def hyena_forward(
     self: AutoModelForCausalLM,
@@ -16,46 +34,63 @@ def hyena_forward(
     output_hidden_states: Optional[bool] = None,
     return_dict: Optional[bool] = None,
     pad_token_id: Optional[int] = None,
+    attention_mask: Optional[torch.Tensor] = None,
+    is_compute_logits: bool = True,
 ) -> Union[Tuple, CausalLMOutput]:
+    """
+        NOTE: Hyena itself has no notion of padding, so if `attention_mask` is given, then each row's real tokens are 
+        left-aligned (i.e. the batch becomes right-padded) and the batch is trimmed to its longest row before running the model.
+        Since Hyena is causal, trailing PADs can't affect real tokens, and compute scales with real tokens rather than padded length.
+        Outputs are scattered back to the original positions (with zeros at PAD positions).
 
+        If not `is_compute_logits`, then `lm_head` is skipped and `logits` is None, so callers that only need hidden states 
+        (e.g. embeddings) never allocate the (B, L, V) fp32 logits.
+    """
     output_hidden_states = (
         output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
     )
     return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+    order: Optional[torch.Tensor] = None
+    if attention_mask is not None:
+        seq_len: int = attention_mask.shape[1]
+        order, max_len = left_align_by_mask(attention_mask)
+        order = order[:, :max_len]
+        aligned_mask: Float[torch.Tensor, 'B T'] = attention_mask.gather(1, order)
+        input_ids = gather_by_order(input_ids, order) if input_ids is not None else None
+        inputs_embeds = gather_by_order(inputs_embeds, order) if inputs_embeds is not None else None
+        labels = gather_by_order(labels, order).masked_fill(aligned_mask == 0, -100) if labels is not None else None
+
     # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
     outputs = self.hyena(
         input_ids=input_ids,
         inputs_embeds=inputs_embeds,
         output_hidden_states=output_hidden_states,
-        return_dict=return_dict,
+        return_dict=True,
     )
 
     hidden_states = outputs[0]
-    logits = self.lm_head(hidden_states)
-    logits = logits.float()
+    all_hidden_states = outputs.hidden_states
+    logits = self.lm_head(hidden_states).float() if is_compute_logits else None
 
     loss = None
     if labels is not None:
-        # Shift so that tokens < n predict n
-        shift_logits = logits[..., :-1, :].contiguous()
-        shift_labels = labels[..., 1:].contiguous()
-        # Add the ignore_index flag to the CrossEntropyLoss initialization
-        loss_fct = nn.CrossEntropyLoss()  # Use pad_token_id for ignore_index - ignore_index=pad_token_id
-        shift_logits = shift_logits.view(-1, self.vocab_size)
-        shift_labels = shift_labels.view(-1)
-        # Enable model parallelism
-        shift_labels = shift_labels.to(shift_logits.device)
-        loss = loss_fct(shift_logits, shift_labels)
+        # Shift so that tokens < n predict n (skipping PAD targets)
+        loss = padding_aware_cross_entropy(hidden_states, labels.to(hidden_states.device), self.lm_head, pad_token_id=pad_token_id)
+
+    if order is not None:
+        logits = scatter_by_order(logits, order, aligned_mask, seq_len) if logits is not None else None
+        if all_hidden_states is not None:
+            all_hidden_states = tuple(scatter_by_order(h, order, aligned_mask, seq_len) for h in all_hidden_states)
 
     if not return_dict:
-        output = (logits,) + outputs[1:]
+        output = ((logits,) if logits is not None else ()) + ((all_hidden_states,) if all_hidden_states is not None else ())
         return (loss,) + output if loss is not None else output
 
     return CausalLMOutput(
         loss=loss,
         logits=logits,
-        hidden_states=outputs.hidden_states,
+        hidden_states=all_hidden_states,
     )
     
 class HyenaLanguageModel(BaseModel):
@@ -82,7 +117,7 @@ class HyenaLanguageModel(BaseModel):
         # Run any post-init handlers from super()
         self.post_init()
     
-    def forward(self, input_ids=None, inputs_embeds=None, labels=None, output_hidden_states=None, return_dict=None):
+    def forward(self, input_ids=None, inputs_embeds=None, labels=None, output_hidden_states=None, return_dict=None, attention_mask=None, is_compute_logits=True):
         return hyena_forward(
             self.model,
             input_ids=input_ids,
@@ -90,9 +125,23 @@ class HyenaLanguageModel(BaseModel):
             labels=labels,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
-            pad_token_id=self.pad_token_id
+            pad_token_id=self.pad_token_id,
+            attention_mask=attention_mask,
+            is_compute_logits=is_compute_logits,
         )
     
+    def compute_loss(self, tokens: Dict[str, Any]) -> torch.Tensor:
+        input_ids: Float[torch.Tensor, 'B L'] = tokens['input_ids']
+        labels: Float[torch.Tensor, 'B L'] = tokens['labels']
+        if tokens.get('attention_mask') is not None:
+            # Left-align real tokens + trim to longest row, so no compute is spent on PADs (see `hyena_forward()`)
+            order, max_len = left_align_by_mask(tokens['attention_mask'])
+            order = order[:, :max_len]
+            input_ids = gather_by_order(input_ids, order)
+            labels = gather_by_order(labels, order).masked_fill(gather_by_order(tokens['attention_mask'], order) == 0, -100)
+        hidden_states: Float[torch.Tensor, 'B T H'] = self.model.hyena(input_ids=input_ids)[0]
+        return self.lm_loss(hidden_states, labels, self.model.lm_head)
+
     def training_step(self, 
                       batch: Dict[str, Any],
                       batch_idx: int) -> Optional[torch.Tensor]:
@@ -100,11 +149,9 @@ class HyenaLanguageModel(BaseModel):
         B: int = tokens['input_ids'].shape[0]
         
         # Need to adjust for Hyena
-        tokens.pop("attention_mask", None)
         tokens.pop("token_type_ids", None)
         
-        outputs = hyena_forward(self.model, **tokens, pad_token_id=self.pad_token_id)
-        loss: torch.Tensor = outputs.loss
+        loss: torch.Tensor = self.compute_loss(tokens)
         
         # Learning rate scheduler
         lr: float = self.trainer.lr_scheduler_configs[0].scheduler.optimizer.param_groups[0]["lr"]
@@ -120,12 +167,10 @@ class HyenaLanguageModel(BaseModel):
         tokens: Dict[str, Float[torch.Tensor, 'B L']] = batch['tokens']
         B: int = tokens['input_ids'].shape[0]
         
-        tokens.pop("attention_mask", None)
         tokens.pop("token_type_ids", None)
         
         # Forward pass
-        outputs = hyena_forward(self.model, **tokens, pad_token_id=self.pad_token_id)
-        loss: torch.Tensor = outputs.loss
+        loss: torch.Tensor = self.compute_loss(tokens)
 
         # Logging
         self.log_validation_step(loss.detach(), tokens)  # Pass both loss and tokens
@@ -16,7 +16,7 @@ class LlamaLanguageModel(BaseModel):
         super(LlamaLanguageModel, self).__init__(config, vocab_size, pad_token_id)
         
         # Enable flash attention
-        if torch.cuda.get_device_capability('cuda')[0] >= 8:
+        if torch.cuda.is_available() and torch.cuda.get_device_capability('cuda')[0] >= 8:
             kwargs = {
                 'attn_implementation': 'flash_attention_2',
                 'torch_dtype': torch.bfloat16,
@@ -39,6 +39,10 @@ class LlamaLanguageModel(BaseModel):
         # Run any post-init handlers from super()
         self.post_init()
 
+    def compute_loss(self, tokens: Dict[str, Any]) -> torch.Tensor:
+        hidden_states: Float[torch.Tensor, 'B L H'] = self.model.model(input_ids=tokens['input_ids'], attention_mask=tokens.get('attention_mask')).last_hidden_state
+        return self.lm_loss(hidden_states, tokens['labels'], self.model.lm_head)
+
     def training_step(self, 
                       batch: Dict[str, Any],
                       batch_idx: int) -> Optional[torch.Tensor]:
@@ -47,8 +51,7 @@ class LlamaLanguageModel(BaseModel):
 
         tokens.pop("token_type_ids", None)
 
-        outputs = self.model(**tokens)
-        loss: torch.Tensor = outputs.loss
+        loss: torch.Tensor = self.compute_loss(tokens)
         
         # Learning rate scheduler
         lr: float = self.trainer.lr_scheduler_configs[0].scheduler.optimizer.param_groups[0]["lr"]
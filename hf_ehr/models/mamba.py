@@ -16,7 +16,7 @@ class MambaLanguageModel(BaseModel):
         super(MambaLanguageModel, self).__init__(config, vocab_size, pad_token_id)
         
         # Enable faster inference
-        if torch.cuda.get_device_capability('cuda')[0] >= 8:
+        if torch.cuda.is_available() and torch.cuda.get_device_capability('cuda')[0] >= 8:
             print("!!!! USING CACHE !!!!")
             kwargs = {
                 'torch_dtype': torch.float16,
@@ -39,14 +39,17 @@ class MambaLanguageModel(BaseModel):
         # Run any post-init handlers from super()
         self.post_init()
 
+    def compute_loss(self, tokens: Dict[str, Any]) -> torch.Tensor:
+        hidden_states: Float[torch.Tensor, 'B L H'] = self.model.backbone(input_ids=tokens['input_ids']).last_hidden_state
+        return self.lm_loss(hidden_states, tokens['labels'], self.model.lm_head)
+
     def training_step(self, 
                       batch: Dict[str, Any],
                       batch_idx: int) -> Optional[torch.Tensor]:
         tokens: Dict[str, Float[torch.Tensor, 'B L']] = batch['tokens']
         B: int = tokens['input_ids'].shape[0]
 
-        outputs = self.model(**tokens)
-        loss: torch.Tensor = outputs.loss
+        loss: torch.Tensor = self.compute_loss(tokens)
         
         # Learning rate scheduler
         lr: float = self.trainer.lr_scheduler_configs[0].scheduler.optimizer.param_groups[0]["lr"]
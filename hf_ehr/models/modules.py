@@ -1,21 +1,216 @@
+import math
+import time
+from collections.abc import Mapping
 import torch
 from torch import optim
+from torch.utils.checkpoint import checkpoint
 import lightning as L
 import torch.distributed as dist
 from tqdm import tqdm
 from omegaconf import DictConfig
 from torchmetrics.aggregation import SumMetric, CatMetric
 from jaxtyping import Float
-from typing import Dict, List, Any, Optional, Union
+from typing import Dict, List, Any, Optional, Union, Callable
 import wandb
 from lightning.pytorch.utilities import rank_zero_only
 from hf_ehr.utils import lr_warmup_with_constant_plateau
+from hf_ehr.trainer.memory_probe import MemoryProbe
 from loguru import logger
 
-def calculate_flops_per_token(model, vocab_size: int) -> int:
-    """Returns FLOPs per token for model."""
-    # TODO - remove; needs to be done on input size level
-    return 0
+####################################
+# FLOPs accounting
+#
+# NOTE: All counts below are *forward* FLOPs per token (1 multiply-accumulate = 2 FLOPs), following
+# the conventions of Kaplan et al. 2020 / Hoffmann et al. 2022: attention scores are charged against the
+# full context length (no causal halving), and norms / activations / biases / embedding lookups are ignored.
+# Training FLOPs are taken to be 3x forward FLOPs (i.e. backward ~= 2x forward).
+
+# Peak dense bf16/fp16 tensor core FLOPs/sec per GPU, matched against `torch.cuda.get_device_name()`.
+# NOTE: Order matters -- more specific names must come before their prefixes (e.g. 'L40S' before 'L40')
+PEAK_FLOPS_PER_GPU: List = [
+    ('H100 PCIe', 756e12),
+    ('H100', 989e12),
+    ('A100', 312e12),
+    ('L40S', 362e12),
+    ('L40', 181e12),
+    ('A6000', 154.8e12),
+    ('A40', 149.7e12),
+    ('A10G', 70e12),
+    ('V100', 125e12),
+    ('T4', 65e12),
+]
+
+def _get_config_attr(model_config: Any, keys: List[str], default: Any = None) -> Any:
+    """Return the first of `keys` that is set on `model_config` (HF configs name the same thing differently across architectures)."""
+    for key in keys:
+        val = model_config.get(key, None) if isinstance(model_config, Mapping) else getattr(model_config, key, None)
+        if val is not None:
+            return val
+    return default
+
+def _transformer_layer_flops(d_model: int, d_attn: int, d_kv: int, d_ff: int, n_ffn_mats: int, context_length: int) -> int:
+    """Forward FLOPs per token for one (self-attention + FFN) transformer block."""
+    qkv_proj: int = 2 * d_model * (d_attn + 2 * d_kv)
+    attn_scores: int = 2 * 2 * context_length * d_attn # QK^T + AV
+    out_proj: int = 2 * d_attn * d_model
+    ffn: int = 2 * n_ffn_mats * d_model * d_ff
+    return qkv_proj + attn_scores + out_proj + ffn
+
+def calculate_forward_flops_per_token(model_config: Any, model_name: str, context_length: int, vocab_size: int) -> int:
+    """Returns forward FLOPs per token for `model_name` with HF config `model_config` at sequence length `context_length`."""
+    V: int = vocab_size
+    if 'gpt2' in model_name:
+        d: int = model_config.n_embd
+        d_ff: int = _get_config_attr(model_config, ['n_inner'], 4 * d)
+        layer: int = _transformer_layer_flops(d, d, d, d_ff, 2, context_length)
+        return model_config.n_layer * layer + 2 * d * V
+    elif 'llama' in model_name:
+        d: int = model_config.hidden_size
+        n_heads: int = model_config.num_attention_heads
+        n_kv_heads: int = _get_config_attr(model_config, ['num_key_value_heads'], n_heads)
+        d_kv: int = n_kv_heads * (d // n_heads)
+        layer: int = _transformer_layer_flops(d, d, d_kv, model_config.intermediate_size, 3, context_length) # SwiGLU => 3 matrices
+        return model_config.num_hidden_layers * layer + 2 * d * V
+    elif 'bert' in model_name:
+        d: int = model_config.hidden_size
+        d_ff: int = _get_config_attr(model_config, ['intermediate_size'], 4 * d)
+        layer: int = _transformer_layer_flops(d, d, d, d_ff, 2, context_length)
+        return model_config.num_hidden_layers * layer + 2 * d * d + 2 * d * V # MLM head = dense transform + decoder
+    elif 't5' in model_name:
+        d: int = model_config.d_model
+        d_attn: int = model_config.num_heads * model_config.d_kv
+        n_ffn_mats: int = 3 if _get_config_attr(model_config, ['is_gated_act'], False) else 2
+        n_enc_layers: int = model_config.num_layers
+        n_dec_layers: int = _get_config_attr(model_config, ['num_decoder_layers'], n_enc_layers)
+        enc_layer: int = _transformer_layer_flops(d, d_attn, d_attn, model_config.d_ff, n_ffn_mats, context_length)
+        cross_attn: int = 2 * d * d_attn + 2 * 2 * d * d_attn + 2 * 2 * context_length * d_attn + 2 * d_attn * d # Q + K/V of encoder output + scores + out
+        dec_layer: int = enc_layer + cross_attn
+        return n_enc_layers * enc_layer + n_dec_layers * dec_layer + 2 * d * V
+    elif 'mamba' in model_name:
+        d: int = _get_config_attr(model_config, ['hidden_size', 'd_model'])
+        N: int = _get_config_attr(model_config, ['state_size'], 16)
+        d_inner: int = _get_config_attr(model_config, ['intermediate_size'], _get_config_attr(model_config, ['expand'], 2) * d)
+        dt_rank = _get_config_attr(model_config, ['time_step_rank'], 'auto')
+        dt_rank: int = math.ceil(d / 16) if dt_rank == 'auto' else dt_rank
+        d_conv: int = _get_config_attr(model_config, ['conv_kernel', 'd_conv'], 4)
+        layer: int = (
+            2 * d * 2 * d_inner # in_proj (x, z)
+            + 2 * d_inner * d_conv # depthwise conv1d
+            + 2 * d_inner * (dt_rank + 2 * N) # x_proj (dt, B, C)
+            + 2 * dt_rank * d_inner # dt_proj
+            + 9 * d_inner * N # selective scan (Gu & Dao 2023, Appendix E)
+            + 2 * d_inner * d # out_proj
+        )
+        return _get_config_attr(model_config, ['num_hidden_layers', 'n_layer']) * layer + 2 * d * V
+    elif 'hyena' in model_name:
+        d: int = model_config.d_model
+        d_inner: int = _get_config_attr(model_config, ['d_inner'], 4 * d)
+        order: int = _get_config_attr(model_config, ['hyena_order'], 2)
+        short_filter_order: int = _get_config_attr(model_config, ['short_filter_order'], 3)
+        layer: int = (
+            2 * d * (order + 1) * d # in_proj
+            + 2 * (order + 1) * d * short_filter_order # short depthwise conv
+            + (order - 1) * d * 30 * math.ceil(math.log2(2 * context_length)) # long conv via FFT of length 2L (3 FFTs @ ~5 N log2 N each, amortized per token)
+            + 2 * d * d # out_proj
+            + 2 * 2 * d * d_inner # MLP
+        )
+        return model_config.n_layer * layer + 2 * d * V
+    elif 'based' in model_name:
+        d: int = model_config.n_embd
+        d_ff: int = _get_config_attr(model_config, ['n_inner'], 4 * d)
+        n_ffn_mats: int = 3 if 'glu' in str(_get_config_attr(model_config, ['activation_function'], '')) else 2
+        alt_mixer_layers: List[int] = list(_get_config_attr(model_config, ['alt_mixer_layers'], []))
+        alt_mixer_2_layers: List[int] = list(_get_config_attr(model_config, ['alt_mixer_2_layers'], [])) if _get_config_attr(model_config, ['alt_mixer_2']) is not None else []
+        # Gated short convolution (default mixer)
+        mixer = _get_config_attr(model_config, ['mixer'], {})
+        expand_proj: int = _get_config_attr(mixer, ['expand_proj'], 4)
+        conv_mixer: int = 2 * d * expand_proj * d + 2 * expand_proj * d * _get_config_attr(mixer, ['kernel_sizes'], 3) + 2 * expand_proj * d * d
+        # Taylor-approximated linear attention (alt mixer)
+        alt_mixer = _get_config_attr(model_config, ['alt_mixer'], {})
+        n_heads: int = _get_config_attr(alt_mixer, ['num_heads'], 16)
+        feature_dim: int = _get_config_attr(alt_mixer, ['feature_dim'], 16)
+        expanded_feature_dim: int = 1 + feature_dim + feature_dim ** 2
+        linear_attn_mixer: int = 2 * d * 2 * n_heads * feature_dim + 2 * d * d + 2 * 2 * n_heads * expanded_feature_dim * (d // n_heads) + 2 * d * d # QK + V + state update/readout + out
+        # Sliding window attention (alt mixer 2)
+        window_size: int = _get_config_attr(_get_config_attr(model_config, ['alt_mixer_2'], {}), ['window_size'], context_length)
+        sliding_attn_mixer: int = 2 * d * 3 * d + 2 * 2 * min(window_size, context_length) * d + 2 * d * d
+        flops: int = 0
+        for layer_idx in range(model_config.n_layer):
+            if layer_idx in alt_mixer_layers:
+                flops += linear_attn_mixer
+            elif layer_idx in alt_mixer_2_layers:
+                flops += sliding_attn_mixer
+            else:
+                flops += conv_mixer
+            flops += 2 * n_ffn_mats * d * d_ff
+        return flops + 2 * d * V
+    else:
+        raise ValueError(f"FLOPs calculation not supported for model `{model_name}`")
+
+def calculate_flops_per_token(model_config: Any, model_name: str, context_length: int, vocab_size: int) -> int:
+    """Returns training (forward + backward) FLOPs per token, i.e. 3x forward FLOPs."""
+    return 3 * calculate_forward_flops_per_token(model_config, model_name, context_length, vocab_size)
+
+def get_peak_flops_per_gpu(config: DictConfig, device: torch.device) -> Optional[float]:
+    """Returns peak FLOPs/sec of a single GPU, used as the denominator of MFU. 
+    Can be overridden with `config.logging.peak_flops_per_gpu` (e.g. for GPUs not in `PEAK_FLOPS_PER_GPU`)."""
+    peak_flops: Optional[float] = getattr(config.logging, 'peak_flops_per_gpu', None)
+    if peak_flops not in [None, "None"]:
+        return float(peak_flops)
+    if device.type != 'cuda':
+        return None
+    device_name: str = torch.cuda.get_device_name(device)
+    for name, flops in PEAK_FLOPS_PER_GPU:
+        if name in device_name:
+            return flops
+    return None
+
+####################################
+# Loss
+
+def _chunk_cross_entropy_sum(hidden_states: Float[torch.Tensor, 'N H'], labels: Float[torch.Tensor, 'N'], lm_head: Callable[[torch.Tensor], torch.Tensor], ignore_index: int = -100) -> torch.Tensor:
+    return torch.nn.functional.cross_entropy(lm_head(hidden_states).float(), labels, ignore_index=ignore_index, reduction='sum')
+
+def padding_aware_cross_entropy(hidden_states: Float[torch.Tensor, 'B L H'],
+                                labels: Float[torch.Tensor, 'B L'],
+                                lm_head: Callable[[torch.Tensor], torch.Tensor],
+                                pad_token_id: Optional[int] = None,
+                                ignore_index: int = -100,
+                                is_shift: bool = True,
+                                chunk_size: int = 2048) -> torch.Tensor:
+    """
+        Mean cross-entropy over all targets that aren't PAD (or `ignore_index`), without ever materializing the full (B x L x V) fp32 logits.
+        `lm_head` + CE run over chunks of `chunk_size` positions, with PAD targets set to `ignore_index`.
+        Each chunk is activation-checkpointed, so only one chunk's logits are alive at a time (incl. during the backward pass).
+
+        NOTE: All shapes are static and the # of scored targets stays on device, so this never forces a GPU->CPU sync.
+        Every chunk goes through `lm_head`, so it is always part of the graph (even if no target is scored) and DDP sees no unused params.
+
+        is_shift: If TRUE, then position `i` predicts `labels[i+1]` (causal LM); else it predicts `labels[i]` (masked LM)
+    """
+    if is_shift:
+        hidden_states = hidden_states[:, :-1, :]
+        labels = labels[:, 1:]
+    hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+    labels = labels.reshape(-1)
+    is_scored: torch.Tensor = labels != ignore_index
+    if pad_token_id is not None:
+        is_scored &= labels != pad_token_id
+    labels = labels.masked_fill(~is_scored, ignore_index)
+    n_scored: torch.Tensor = is_scored.sum().clamp(min=1)
+    n_positions: int = labels.shape[0]
+    if n_positions == 0:
+        # Zero-weighted `lm_head` call, so the head stays in the graph
+        return lm_head(hidden_states).float().sum() * 0.0
+    loss_sum = 0.0
+    for start in range(0, n_positions, chunk_size):
+        chunk_hidden_states = hidden_states[start:start + chunk_size]
+        chunk_labels = labels[start:start + chunk_size]
+        if torch.is_grad_enabled() and chunk_hidden_states.requires_grad:
+            loss_sum = loss_sum + checkpoint(_chunk_cross_entropy_sum, chunk_hidden_states, chunk_labels, lm_head, ignore_index, use_reentrant=False)
+        else:
+            loss_sum = loss_sum + _chunk_cross_entropy_sum(chunk_hidden_states, chunk_labels, lm_head, ignore_index)
+    return loss_sum / n_scored
 
 class BaseModel(L.LightningModule):
     """
@@ -29,6 +224,7 @@ class BaseModel(L.LightningModule):
     vocab_size: int
     pad_token_id: int
     flops_per_token: Optional[int] = None
+    peak_flops_per_gpu: Optional[float] = None
 
     def __init__(self, config: DictConfig, vocab_size, pad_token_id) -> None:
         super().__init__()
@@ -38,23 +234,51 @@ class BaseModel(L.LightningModule):
         self.vocab_size: int = vocab_size
         self.pad_token_id: int = pad_token_id
         self.flops_per_token = None
+        self.peak_flops_per_gpu = None
+        # Number of positions per chunk in `padding_aware_cross_entropy()`
+        self.loss_chunk_size: int = getattr(config.trainer, 'loss_chunk_size', 2048)
         
         # Metrics
         self.sum_metrics: Dict[str, SumMetric] = torch.nn.ModuleDict({
             'train_total_examples': SumMetric(),
             'train_total_tokens_PAD': SumMetric(),
             'train_total_tokens_nonPAD': SumMetric(),
+            'train_total_flops': SumMetric().set_dtype(torch.float64), # NOTE: float32 stops accumulating once total >> per-batch FLOPs
         })
         self.cat_metrics: Dict[str, CatMetric] = torch.nn.ModuleDict({
             'val_batch_loss': CatMetric(),
             'val_batch_tokens_nonPAD': CatMetric(),
+            'val_batch_n_nonfinite': CatMetric(),
         })
     
     def post_init(self):
         """Post-initialization method to be called by subclass."""
-        self.flops_per_token = 0
+        # FLOPs per token at the max context length (actual batches are charged at their own length in `get_flops_per_token()`)
+        self.flops_per_token_cache: Dict[int, int] = {}
+        self.flops_per_token = self.get_flops_per_token(self.config.data.dataloader.max_length)
         # Track batch_idx
         self.batch_idx: int = 0
+        # Training metrics are accumulated on-device and flushed every N steps (see `log_training_step()`)
+        self.flush_every_n_steps: int = getattr(self.config.logging, 'flush_every_n_steps', 1)
+        self.flushed_train_metrics: Dict[str, float] = {}
+        self.reset_training_window()
+        self.reset_validation_window()
+
+    def get_flops_per_token(self, context_length: int) -> int:
+        """Training FLOPs per token for a sequence of length `context_length`."""
+        if context_length not in self.flops_per_token_cache:
+            self.flops_per_token_cache[context_length] = calculate_flops_per_token(self.model.config, self.model_name, context_length, self.vocab_size)
+        return self.flops_per_token_cache[context_length]
+
+    def compute_loss(self, tokens: Dict[str, Any]) -> torch.Tensor:
+        """
+            Mean loss over non-PAD targets for a batch of `tokens`. Wrappers override this to run `padding_aware_cross_entropy()`
+            on their final hidden states (see `lm_loss()`); by default, falls back to the HF model's built-in loss.
+        """
+        return self.model(**tokens).loss
+
+    def lm_loss(self, hidden_states: Float[torch.Tensor, 'B L H'], labels: Float[torch.Tensor, 'B L'], lm_head: Callable, is_shift: bool = True) -> torch.Tensor:
+        return padding_aware_cross_entropy(hidden_states, labels, lm_head, pad_token_id=self.pad_token_id, is_shift=is_shift, chunk_size=self.loss_chunk_size)
 
     def parameters(self) -> List:
         params = []
@@ -89,6 +313,8 @@ class BaseModel(L.LightningModule):
     
     def on_save_checkpoint(self, checkpoint):
         """Save each metric's state in the checkpoint."""
+        # Make sure metrics accumulated since the last flush are included
+        self.flush_training_window(is_log=False)
         for key, metric in self.sum_metrics.items():
             checkpoint[key] = metric.compute()
         for key, metric in self.cat_metrics.items():
@@ -101,10 +327,17 @@ class BaseModel(L.LightningModule):
         super().on_load_checkpoint(checkpoint)
         # Sum Metrics
         for key, metric in self.sum_metrics.items():
+            if key not in checkpoint:
+                # NOTE: Older ckpts may predate this metric (e.g. `train_total_flops`), so start it from 0
+                logger.warning(f"Metric `{key}` not found in checkpoint, so starting it from 0")
+                continue
             self.sum_metrics[key].update(checkpoint[key])
             logger.info(f"Loaded metric `{key}` from checkpoint with value: `{self.sum_metrics[key].cuda().compute()}`")
         # Cat Metrics
         for key, metric in self.cat_metrics.items():
+            if key not in checkpoint:
+                logger.warning(f"Metric `{key}` not found in checkpoint, so leaving it empty")
+                continue
             self.cat_metrics[key].update(checkpoint[key])
             logger.info(f"Loaded metric `{key}` from checkpoint with value: `{self.cat_metrics[key].cuda().compute()}`")
         self.batch_idx: int = checkpoint.get('batch_idx', 0)
@@ -120,21 +353,11 @@ class BaseModel(L.LightningModule):
             tokens.pop("token_type_ids", None)
         
         # Forward pass
-        outputs = self.model(**tokens)
-        loss: torch.Tensor = outputs.loss
-                
-        if torch.isnan(loss).any():
-            nan_detected = torch.tensor([1.0], device=self.device)
-        else:
-            nan_detected = torch.tensor([0.0], device=self.device)
-
-        dist.all_reduce(nan_detected, op=dist.ReduceOp.MAX)
-        if nan_detected.item() == 1:
-            print("NaN detected in loss, skipping this batch across all processes.")
-            return  # Skip this batch on all processes
+        loss: torch.Tensor = self.compute_loss(tokens)
 
         # Logging
-        self.log_validation_step(loss, tokens) # ! NOTE: I'm assuming this loss is averaged over all non-PAD tokens for this function call
+        # NOTE: NaN/Inf losses are masked out on-device in `log_validation_step()` and only reduced across ranks once per epoch
+        self.log_validation_step(loss.detach(), tokens) # ! NOTE: I'm assuming this loss is averaged over all non-PAD tokens for this function call
 
         return loss
 
@@ -147,31 +370,19 @@ class BaseModel(L.LightningModule):
             wandb.run.summary["tokenizer_vocab_size"] = self.vocab_size
             wandb.run.summary["tokenizer_pad_token_id"] = self.pad_token_id
             wandb.run.summary["model_parameter_count"] = self.get_param_count()
+            wandb.run.summary["model_flops_per_token"] = self.flops_per_token
+
+        # Peak FLOPs/sec of this GPU, for MFU logging
+        self.peak_flops_per_gpu = get_peak_flops_per_gpu(self.config, self.device)
+        if self.peak_flops_per_gpu is None:
+            logger.warning(f"Unknown peak FLOPs for device `{self.device}`, so skipping MFU logging. Set `logging.peak_flops_per_gpu` to enable it.")
 
         ############################
         # Start of OOM detection
-        # Create a fake full batch and pass through model for early detection of OOM
-        if self.config.data.dataloader.mode == 'approx':
-            fake_batch = {
-                'input_ids' : torch.ones((self.config.data.dataloader.approx_batch_sampler.max_tokens // self.config.data.dataloader.max_length, self.config.data.dataloader.max_length)).long().to(self.device),
-                'attention_mask' : torch.ones((self.config.data.dataloader.approx_batch_sampler.max_tokens // self.config.data.dataloader.max_length, self.config.data.dataloader.max_length)).to(self.device),
-                'labels' : torch.ones((self.config.data.dataloader.approx_batch_sampler.max_tokens // self.config.data.dataloader.max_length, self.config.data.dataloader.max_length)).long().to(self.device),
-            }
-        elif self.config.data.dataloader.mode == 'batch':
-            fake_batch = {
-                'input_ids' : torch.ones((self.config.data.dataloader.batch_size, self.config.data.dataloader.max_length)).long().to(self.device),
-                'attention_mask' : torch.ones((self.config.data.dataloader.batch_size,self.config.data.dataloader.max_length)).to(self.device),
-                'labels' : torch.ones((self.config.data.dataloader.batch_size,self.config.data.dataloader.max_length)).long().to(self.device),
-            }
-        else:
-            raise ValueError(f"Unsupported config.data.dataloader.mode: `{self.config.data.dataloader.mode}`")
-        assert fake_batch['input_ids'].numel() <= self.config.data.dataloader.approx_batch_sampler.max_tokens, f"Fake batch size is larger than max_tokens: {fake_batch['input_ids'].numel()} > {self.config.data.dataloader.approx_batch_sampler.max_tokens}"
-        if 'hyena' in self.model_name:
-            # Hyena doesn't support `attention_mask` in the input, so remove it
-            fake_batch.pop('attention_mask')
-        outputs = self.model(**fake_batch)
-        del outputs
-        del fake_batch
+        # Run a fake full batch through model for early detection of OOM (skipped if an identical setup already passed)
+        memory_probe_config = getattr(self.config.trainer, 'memory_probe', None)
+        if memory_probe_config is None or memory_probe_config.is_enabled:
+            self.run_memory_probe()
         # End of OOM detection
         ############################
 
@@ -184,13 +395,72 @@ class BaseModel(L.LightningModule):
                 self.trainer.train_dataloader.batch_sampler.start_batch_idx = self.batch_idx if self.batch_idx > 0 else self.trainer.global_step
                 logger.success(f"We are resuming from a checkpoint that used `ApproxBatchSampler`, so set: `epoch={self.trainer.current_epoch}` and `start_batch_idx={self.trainer.train_dataloader.batch_sampler.start_batch_idx}`")
         torch.distributed.barrier()
+        self.reset_training_window()
+
+    def run_memory_probe(self):
+        """
+            Check that a max-size batch fits in memory, using cached probe results if this exact setup has been 
+            probed before (see `hf_ehr/trainer/memory_probe.py`). Otherwise, binary search for the largest `max_tokens` that fits.
+        """
+        dataloader_config = self.config.data.dataloader
+        max_length: int = dataloader_config.max_length
+        if dataloader_config.mode == 'approx':
+            max_tokens: int = (dataloader_config.approx_batch_sampler.max_tokens // max_length) * max_length
+        elif dataloader_config.mode == 'batch':
+            max_tokens: int = dataloader_config.batch_size * max_length
+        else:
+            raise ValueError(f"Unsupported config.data.dataloader.mode: `{dataloader_config.mode}`")
+        assert max_tokens >= max_length, f"Error -- Fake batch is empty b/c max_tokens < max_length: {max_tokens} < {max_length}"
+        
+        memory_probe_config = getattr(self.config.trainer, 'memory_probe', None)
+        probe = MemoryProbe(self, 
+                            self.config, 
+                            self.vocab_size, 
+                            precision=self.trainer.precision, 
+                            device=self.device, 
+                            path_to_cache=getattr(memory_probe_config, 'path_to_cache', None) if memory_probe_config is not None else None)
+        if probe.is_known_to_fit(max_tokens):
+            logger.info(f"Skipping memory probe b/c cached probe for this setup (signature=`{probe.signature_key}`) already fit max_tokens={max_tokens}")
+            max_safe_max_tokens: Optional[int] = max_tokens
+        else:
+            max_safe_max_tokens: Optional[int] = probe.search_max_safe_max_tokens(list(range(max_length, max_tokens + 1, max_length)))
+            if rank_zero_only.rank == 0:
+                probe.save()
+        # NOTE: Take the min across ranks, so that every rank raises together (instead of one rank raising and leaving the rest blocked at the next collective)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            decision: torch.Tensor = torch.tensor(max_safe_max_tokens or 0, dtype=torch.long, device=self.device)
+            torch.distributed.all_reduce(decision, op=torch.distributed.ReduceOp.MIN)
+            max_safe_max_tokens = int(decision.item()) or None
+        if max_safe_max_tokens != max_tokens:
+            raise ValueError(f"Memory probe OOM'd at max_tokens={max_tokens} on at least one rank (signature=`{probe.signature_key}`). "
+                             f"Largest max_tokens that fits is {max_safe_max_tokens}, so set `data.dataloader.approx_batch_sampler.max_tokens` (or `data.dataloader.batch_size`) accordingly.")
 
     def on_validation_start(self):
         # When we restart validation, reset # of tokens that have gone into the val loss calculation to 0
         self.cat_metrics['val_batch_loss'].reset()
         self.cat_metrics['val_batch_tokens_nonPAD'].reset()
+        self.cat_metrics['val_batch_n_nonfinite'].reset()
+        self.reset_validation_window()
+
+    def on_validation_end(self):
+        # Don't count time spent in validation towards training throughput (window was flushed in `on_validation_epoch_end()`)
+        self.train_window['start_time'] = time.perf_counter()
 
     def on_validation_epoch_end(self):
+        # Make sure training metrics accumulated since the last flush are included in `val/tokens/*`
+        self.flush_training_window(is_log=False)
+
+        # Move this rank's on-device validation sums into the cat metrics (once per epoch), 
+        # so that all ranks' values are gathered by the metrics' own `compute()` below
+        window: Dict[str, torch.Tensor] = self.val_window
+        self.cat_metrics['val_batch_loss'].update(window['loss_sum'] / window['tokens_nonPAD'].clamp(min=1))
+        self.cat_metrics['val_batch_tokens_nonPAD'].update(window['tokens_nonPAD'])
+        self.cat_metrics['val_batch_n_nonfinite'].update(window['n_nonfinite'])
+        n_nonfinite: int = int(self.cat_metrics['val_batch_n_nonfinite'].compute().sum().item())
+        if n_nonfinite > 0:
+            logger.warning(f"NaN/Inf detected in val loss for {n_nonfinite} batches across all processes; these batches were excluded from `val/loss`.")
+        self.log('val/n_nonfinite_batches', float(n_nonfinite), on_step=False, on_epoch=True)
+
         # Calculate per-token val loss and perplexity
         val_batch_loss: torch.Tensor = self.cat_metrics['val_batch_loss'].compute()  # Loss/token across all validation batches
         val_batch_tokens_nonPAD: torch.Tensor = self.cat_metrics['val_batch_tokens_nonPAD'].compute()  # Tokens/batch across all validation batches
@@ -213,43 +483,140 @@ class BaseModel(L.LightningModule):
         self.log('val/tokens/total_nonPAD', self.sum_metrics['train_total_tokens_nonPAD'].compute().to(torch.float32), on_step=False, on_epoch=True, sync_dist=True)
 
     def log_validation_step(self, loss: torch.Tensor, tokens: Dict[str, Any]):
-        # NOTE: Assumes `loss` has been scaled per-token already
-        val_batch_tokens_nonPAD: int = (tokens['input_ids'] != self.pad_token_id).sum().detach().cpu().item()
-        self.cat_metrics['val_batch_loss'].update(loss)  # Corrected to use cat_metrics
-        self.cat_metrics['val_batch_tokens_nonPAD'].update(val_batch_tokens_nonPAD)
+        """
+            NOTE: Assumes `loss` has been scaled per-token already
+            NOTE: Everything stays on device (no `.item()` / collectives per batch) -- non-finite losses are masked out
+            by zeroing their token weight, and counted so they can be reported once per epoch in `on_validation_epoch_end()`
+        """
+        loss = loss.detach().float()
+        is_finite: torch.Tensor = torch.isfinite(loss)
+        val_batch_tokens_nonPAD: torch.Tensor = (tokens['input_ids'] != self.pad_token_id).sum() * is_finite
+        window: Dict[str, torch.Tensor] = self.val_window
+        window['loss_sum'] += torch.where(is_finite, loss, torch.zeros_like(loss)) * val_batch_tokens_nonPAD
+        window['tokens_nonPAD'] += val_batch_tokens_nonPAD
+        window['n_nonfinite'] += ~is_finite
+
+    def reset_validation_window(self):
+        self.val_window: Dict[str, torch.Tensor] = {
+            'loss_sum' : torch.zeros((), dtype=torch.float64, device=self.device),
+            'tokens_nonPAD' : torch.zeros((), dtype=torch.float64, device=self.device),
+            'n_nonfinite' : torch.zeros((), dtype=torch.float64, device=self.device),
+        }
 
     def log_training_step(self, loss: torch.Tensor, B: int, tokens: Dict[str, Any], lr: float):
         """
             B: batch size
+
+            NOTE: To avoid a GPU->CPU sync on every step, metrics are accumulated on-device in `self.train_window`
+            and only flushed to the logger every `config.logging.flush_every_n_steps` steps (see `flush_training_window()`)
         """
         loss = loss.detach()
-        ppl: torch.Tensor = torch.exp(loss)
-
-        # Metrics
-        train_batch_examples: int = B
-        self.sum_metrics['train_total_examples'].update(train_batch_examples)
-        self.log('optim/lr', lr)
-        self.log('train/loss', loss, prog_bar=True)
-        self.log('train/ppl', torch.clamp(ppl, max=100).to(torch.float32))  # artificially cap to 100 so that charts look prettier
-        self.log('train/examples/batch', torch.tensor(B, dtype=torch.float32))
-        self.log('train/examples/total', self.sum_metrics['train_total_examples'].compute().to(torch.float32), sync_dist=True)
-
-        if 'hyena' in self.model_name:
-            # Hyena doesn't have `attention_mask` in the input, so manually calculate number of PAD tokens
-            pad_token_id = self.pad_token_id
-            input_ids = tokens['input_ids']
-            train_batch_tokens_PAD = (input_ids == pad_token_id).sum()
-            train_batch_tokens_nonPAD = (input_ids != pad_token_id).sum()
+        if tokens.get('attention_mask') is None:
+            # No `attention_mask` in the input, so manually calculate number of PAD tokens
+            train_batch_tokens_nonPAD: torch.Tensor = (tokens['input_ids'] != self.pad_token_id).sum()
         else:
-            train_batch_tokens_PAD: torch.Tensor = (1 - tokens['attention_mask']).sum()
             train_batch_tokens_nonPAD: torch.Tensor = tokens['attention_mask'].sum()
+        
+        # FLOPs -- every position in the batch (incl. PAD) goes through the model, so charge for all B x L tokens
+        L: int = tokens['input_ids'].shape[1]
+        train_batch_tokens_all: int = B * L
+        train_batch_flops: int = self.get_flops_per_token(L) * train_batch_tokens_all
+
+        # Accumulate -- device tensors stay on device, everything else is a Python number
+        window: Dict[str, Any] = self.train_window
+        window['loss_sum'] = loss.double() if window['loss_sum'] is None else window['loss_sum'] + loss.double()
+        window['tokens_nonPAD'] = train_batch_tokens_nonPAD.double() if window['tokens_nonPAD'] is None else window['tokens_nonPAD'] + train_batch_tokens_nonPAD.double()
+        window['n_steps'] += 1
+        window['n_loss_steps'] += 1
+        window['examples'] += B
+        window['tokens_all'] += train_batch_tokens_all
+        window['flops'] += train_batch_flops
+        window['lr'] = lr
+
+        if window['n_steps'] >= self.flush_every_n_steps:
+            self.flush_training_window(is_log=True)
+
+    def log_grad_norm(self, grad_norm: torch.Tensor):
+        """Accumulate an on-device grad norm (see `GradNormCallback`); logged as the mean over the window on the next flush."""
+        window: Dict[str, Any] = self.train_window
+        window['grad_norm_sum'] = grad_norm.double() if window['grad_norm_sum'] is None else window['grad_norm_sum'] + grad_norm.double()
+        window['n_grad_norms'] += 1
+
+    def reset_training_window(self, carry: Optional[Dict[str, Any]] = None):
+        """Start a new training window. If `carry` is given, its (not yet logged) loss + grad norm sums are carried into the new window."""
+        carry = carry if carry is not None else {}
+        self.train_window: Dict[str, Any] = {
+            # On device
+            'loss_sum' : carry.get('loss_sum'),
+            'tokens_nonPAD' : None,
+            'grad_norm_sum' : carry.get('grad_norm_sum'),
+            # On host
+            'n_steps' : 0,
+            'n_loss_steps' : carry.get('n_loss_steps', 0), # may include steps carried over from an unlogged window
+            'n_grad_norms' : carry.get('n_grad_norms', 0),
+            'examples' : 0,
+            'tokens_all' : 0,
+            'flops' : 0,
+            'lr' : carry.get('lr'),
+            'start_time' : time.perf_counter(),
+        }
+
+    def flush_training_window(self, is_log: bool = True):
+        """Move the accumulated training window into `self.sum_metrics` with a single GPU->CPU sync, then (optionally) log it.
+        If not `is_log`, only the cumulative counters are moved, and the loss + grad norm sums are carried into the next window
+        (so they are logged on the next flush instead of being dropped).
+        Must be called on all ranks at the same step, since `SumMetric.compute()` syncs across ranks."""
+        window: Dict[str, Any] = self.train_window
+        if window['n_steps'] == 0:
+            return
+        
+        # Single GPU->CPU sync for all on-device values
+        device_keys: List[str] = [ key for key in ['loss_sum', 'tokens_nonPAD', 'grad_norm_sum'] if window[key] is not None ]
+        device_vals: Dict[str, float] = dict(zip(device_keys, torch.stack([ window[key] for key in device_keys ]).tolist()))
+        n_steps: int = window['n_steps']
+        tokens_nonPAD: float = device_vals['tokens_nonPAD']
+        tokens_PAD: float = window['tokens_all'] - tokens_nonPAD
+        window_time: Optional[float] = time.perf_counter() - window['start_time'] if window['start_time'] is not None else None
 
         # Update cumulative metrics
-        self.sum_metrics['train_total_tokens_PAD'].update(train_batch_tokens_PAD)
-        self.sum_metrics['train_total_tokens_nonPAD'].update(train_batch_tokens_nonPAD)
-        self.log('train/tokens/batch_all', (train_batch_tokens_PAD + train_batch_tokens_nonPAD).to(torch.float32))
-        self.log('train/tokens/batch_PAD', train_batch_tokens_PAD.to(torch.float32))
-        self.log('train/tokens/batch_nonPAD', train_batch_tokens_nonPAD.to(torch.float32))
-        self.log('train/tokens/total_all', (self.sum_metrics['train_total_tokens_PAD'].compute() + self.sum_metrics['train_total_tokens_nonPAD'].compute()).to(torch.float32))
-        self.log('train/tokens/total_PAD', self.sum_metrics['train_total_tokens_PAD'].compute().to(torch.float32))
-        self.log('train/tokens/total_nonPAD', self.sum_metrics['train_total_tokens_nonPAD'].compute().to(torch.float32))
\ No newline at end of file
+        self.sum_metrics['train_total_examples'].update(window['examples'])
+        self.sum_metrics['train_total_tokens_PAD'].update(tokens_PAD)
+        self.sum_metrics['train_total_tokens_nonPAD'].update(tokens_nonPAD)
+        self.sum_metrics['train_total_flops'].update(window['flops'])
+
+        if not is_log:
+            self.reset_training_window(carry=window)
+            return
+        self.reset_training_window()
+
+        # NOTE: Sum metrics are synced across ranks by `compute()`, so convert to Python numbers once here
+        totals: Dict[str, float] = { key: metric.compute().item() for key, metric in self.sum_metrics.items() }
+        loss: float = device_vals['loss_sum'] / window['n_loss_steps']
+        metrics: Dict[str, float] = {
+            'optim/lr' : window['lr'],
+            'train/loss' : loss,
+            'train/ppl' : min(math.exp(min(loss, 100)), 100), # artificially cap to 100 so that charts look prettier
+            'train/examples/batch' : window['examples'] / n_steps,
+            'train/examples/total' : totals['train_total_examples'],
+            'train/tokens/batch_all' : window['tokens_all'] / n_steps,
+            'train/tokens/batch_PAD' : tokens_PAD / n_steps,
+            'train/tokens/batch_nonPAD' : tokens_nonPAD / n_steps,
+            'train/tokens/total_all' : totals['train_total_tokens_PAD'] + totals['train_total_tokens_nonPAD'],
+            'train/tokens/total_PAD' : totals['train_total_tokens_PAD'],
+            'train/tokens/total_nonPAD' : totals['train_total_tokens_nonPAD'],
+            'train/flops/batch' : window['flops'] / n_steps,
+            'train/total_flops' : totals['train_total_flops'],
+        }
+        if 'grad_norm_sum' in device_vals:
+            metrics['optim/grad_norm_raw'] = device_vals['grad_norm_sum'] / window['n_grad_norms']
+
+        # Throughput (per GPU) + model FLOPs utilization (MFU), averaged over the window
+        if window_time is not None and window_time > 0:
+            metrics['train/throughput/tokens_per_sec_per_gpu'] = window['tokens_all'] / window_time
+            metrics['train/throughput/flops_per_sec_per_gpu'] = window['flops'] / window_time
+            if self.peak_flops_per_gpu:
+                metrics['train/throughput/mfu'] = window['flops'] / window_time / self.peak_flops_per_gpu
+
+        # Keep a host-side copy so that callbacks (e.g. `MetricBasedCheckpoint`) can read these without touching the GPU
+        self.flushed_train_metrics = metrics
+        self.log_dict(metrics)
@@ -57,6 +57,6 @@ class T5LanguageModel(BaseModel):
         loss: torch.Tensor = outputs.loss
 
         # Logging
-        self.log_validation_step(loss.detach())
+        self.log_validation_step(loss.detach(), tokens)
 
         return loss
@@ -33,6 +33,7 @@ def parse_args():
     parser.add_argument("--is_force_refresh", action="store_true", help="Flag to force refresh")
     parser.add_argument("--is_skip_base", action="store_true", help="Flag to skip calling `source base.sh` at start of script")
     parser.add_argument("--is_run_local", action="store_true", help="Flag to run locally as `python run.py` instead of as a SLURM `sbatch` command")
+    parser.add_argument("--is_autotune_max_tokens", action="store_true", help="Flag to have run.py find the largest `max_tokens` that fits in GPU memory (cached per model/GPU), instead of using `map_model_partition_to_batch_size()`")
     return parser.parse_args()
 
 def map_model_partition_to_batch_size(partitions: str, model: str, size: int, context_length: int) -> Tuple[int, int]:
@@ -295,6 +296,9 @@ def main():
     # Force max_tokens to be at least as large as context_length
     max_tokens = max(args.context_length, max_tokens)
     print(f"Stats: Adjusted max_tokens={max_tokens}")
+    if args.is_autotune_max_tokens:
+        max_tokens = 'auto'
+        print(f"Stats: Autotuning max_tokens in run.py")
 
     # Construct Python command
     command = [
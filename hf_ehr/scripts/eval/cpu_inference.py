@@ -0,0 +1,142 @@
+"""
+Usage:
+    python cpu_inference.py \
+        --path_to_ckpt /share/pi/nigam/suhana/hf_ehr/cache/runs_backup/gpt-base-1024--clmbr/ckpts/train-tokens-total_nonPAD-ckpt_val=2000000000-persist.ckpt \
+        --path_to_tokenized_timelines /share/pi/nigam/mwornow/ehrshot-benchmark/EHRSHOT_ASSETS/tokenized_timelines/chunk_strat=last,max_length=1024_clmbr_tokenized_timelines_batch_0.npy \
+        --n_threads 16
+
+Purpose:
+    Validate + benchmark the CPU-optimized (SDPA + dynamic int8) version of a model against the fp32 model, both on CPU.
+    Compares next-token logits and EHRSHOT patient features (via `embed_batch()`), and reports throughput + model size.
+    If `--path_to_tokenized_timelines` isn't given, then synthetic left-padded timelines are used instead.
+"""
+
+import os
+import collections
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from typing import Dict, Any, List
+from jaxtyping import Float
+from loguru import logger
+from hf_ehr.utils import CheckpointHandle, load_model_from_path
+from hf_ehr.models.cpu_inference import optimize_model_for_cpu, set_cpu_threads, compare_logits, compare_embeddings, get_model_size_bytes, check_sdpa_attention, get_attention_module_types
+from hf_ehr.eval.ehrshot import embed_batch, load_tokenized_timelines
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare a CPU-optimized model against its fp32 version")
+    parser.add_argument("--path_to_ckpt", required=True, type=str, help="Path to model .ckpt (or safetensors export)")
+    parser.add_argument("--path_to_tokenized_timelines", type=str, default=None, help="Path to .npy/.npz of left-padded tokenized timelines (e.g. from `ehrshot.py`). If not specified, use synthetic timelines")
+    parser.add_argument("--path_to_output", type=str, default=None, help="If specified, save results as JSON here")
+    parser.add_argument("--n_patients", type=int, default=64, help="# of timelines to compare")
+    parser.add_argument("--seq_length", type=int, default=None, help="Max length of each timeline (defaults to the model's `max_length`)")
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size")
+    parser.add_argument("--embed_strat", type=str, default="last", help="Embedding strategy passed to `embed_batch()` -- 'last' or 'mean'")
+    parser.add_argument("--n_threads", type=int, default=None, help="# of CPU threads used by torch")
+    parser.add_argument("--is_skip_quantize", action="store_true", default=False, help="If TRUE, only apply the SDPA + fp32 conversions (no int8)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic timelines")
+    return parser.parse_args()
+
+def make_synthetic_timelines(n_patients: int, seq_length: int, vocab_size: int, pad_token_id: int, seed: int = 0) -> np.ndarray:
+    """Random left-padded timelines with lengths uniform in [seq_length / 4, seq_length]."""
+    rng = np.random.default_rng(seed)
+    timelines: np.ndarray = np.full((n_patients, seq_length), pad_token_id, dtype=np.int64)
+    for i in range(n_patients):
+        length: int = int(rng.integers(max(2, seq_length // 4), seq_length + 1))
+        tokens: np.ndarray = rng.integers(0, vocab_size, size=length)
+        tokens[tokens == pad_token_id] = (pad_token_id + 1) % vocab_size
+        timelines[i, -length:] = tokens
+    return timelines
+
+def summarize(results: List[Dict[str, Any]], weight_key: str) -> Dict[str, Any]:
+    """Merge per-batch comparisons -- max/min over `max_*`/`min_*` keys, otherwise a mean weighted by `weight_key`."""
+    weights: np.ndarray = np.array([ r[weight_key] for r in results ], dtype=np.float64)
+    summary: Dict[str, Any] = { weight_key : int(weights.sum()) }
+    for key in results[0].keys():
+        if key == weight_key:
+            continue
+        values: np.ndarray = np.array([ r[key] for r in results ], dtype=np.float64)
+        if key.startswith('max_'):
+            summary[key] = float(values.max())
+        elif key.startswith('min_'):
+            summary[key] = float(values.min())
+        else:
+            summary[key] = float(np.sum(values * weights) / weights.sum())
+    return summary
+
+def main():
+    args = parse_args()
+    set_cpu_threads(args.n_threads)
+    torch.manual_seed(args.seed)
+
+    # Load models
+    ckpt_handle = CheckpointHandle(args.path_to_ckpt)
+    config = ckpt_handle.config
+    tokenizer = ckpt_handle.tokenizer
+    pad_token_id: int = tokenizer.pad_token_id
+    seq_length: int = args.seq_length if args.seq_length is not None else config.data.dataloader.max_length
+    logger.info(f"Loading fp32 model from `{args.path_to_ckpt}`")
+    model_ref = load_model_from_path(ckpt_handle, device='cpu').float()
+    model_ref.eval()
+    logger.info(f"Creating CPU-optimized model | is_quantize={not args.is_skip_quantize}")
+    model_opt = optimize_model_for_cpu(model_ref, is_quantize=not args.is_skip_quantize, is_copy=True)
+    check_sdpa_attention(model_opt.model)
+    logger.info(f"Attention modules: {collections.Counter(get_attention_module_types(model_opt.model).values())}")
+
+    # Load timelines
+    if args.path_to_tokenized_timelines is not None:
+        timelines: np.ndarray = np.asarray(load_tokenized_timelines(args.path_to_tokenized_timelines)[:args.n_patients, -seq_length:], dtype=np.int64)
+    else:
+        timelines: np.ndarray = make_synthetic_timelines(args.n_patients, seq_length, tokenizer.vocab_size, pad_token_id, seed=args.seed)
+    logger.info(f"Comparing on {timelines.shape[0]} timelines of length {timelines.shape[1]}")
+
+    # Run comparisons
+    logits_results: List[Dict[str, Any]] = []
+    embeds_results: List[Dict[str, Any]] = []
+    times: Dict[str, float] = { 'fp32' : 0.0, 'optimized' : 0.0 }
+    n_tokens: int = 0
+    with torch.inference_mode():
+        for batch_start in range(0, timelines.shape[0], args.batch_size):
+            input_ids: Float[torch.Tensor, 'B L'] = torch.from_numpy(timelines[batch_start:batch_start + args.batch_size])
+            attention_mask: Float[torch.Tensor, 'B L'] = (input_ids != pad_token_id).int()
+            n_tokens += int(attention_mask.sum())
+
+            # Features (timed, since this is the featurization path)
+            start = time.perf_counter()
+            embeds_ref: Float[torch.Tensor, 'B H'] = embed_batch(model_ref, config, input_ids, args.embed_strat, pad_token_id)
+            times['fp32'] += time.perf_counter() - start
+            start = time.perf_counter()
+            embeds_opt: Float[torch.Tensor, 'B H'] = embed_batch(model_opt, config, input_ids, args.embed_strat, pad_token_id)
+            times['optimized'] += time.perf_counter() - start
+            embeds_results.append(compare_embeddings(embeds_ref, embeds_opt))
+
+            # Logits
+            logits_ref: Float[torch.Tensor, 'B L V'] = model_ref.model(input_ids=input_ids, attention_mask=attention_mask).logits
+            logits_opt: Float[torch.Tensor, 'B L V'] = model_opt.model(input_ids=input_ids, attention_mask=attention_mask).logits
+            logits_results.append(compare_logits(logits_ref, logits_opt, attention_mask))
+
+    results: Dict[str, Any] = {
+        'path_to_ckpt' : args.path_to_ckpt,
+        'model_name' : config.model.name,
+        'is_quantize' : not args.is_skip_quantize,
+        'n_threads' : torch.get_num_threads(),
+        'batch_size' : args.batch_size,
+        'seq_length' : int(timelines.shape[1]),
+        'is_synthetic' : args.path_to_tokenized_timelines is None,
+        'model_size_bytes' : { 'fp32' : get_model_size_bytes(model_ref), 'optimized' : get_model_size_bytes(model_opt) },
+        'tokens_per_second' : { key : n_tokens / val for key, val in times.items() },
+        'speedup' : times['fp32'] / times['optimized'],
+        'logits' : summarize(logits_results, 'n_tokens'),
+        'features' : summarize(embeds_results, 'n_patients'),
+    }
+    logger.info(json.dumps(results, indent=2))
+    if args.path_to_output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.path_to_output)), exist_ok=True)
+        with open(args.path_to_output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.success(f"Saved results to `{args.path_to_output}`")
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,14 @@ import torch
 import time
 import pandas as pd
 from tqdm import tqdm
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Union
 from hf_ehr.utils import (
-    load_config_from_ckpt,
+    CheckpointHandle,
+    load_config_from_path,
     load_model_from_path,
     load_tokenizer_from_path
 )
+from hf_ehr.models.cpu_inference import optimize_model_for_cpu, set_cpu_threads
 import numpy as np
 import argparse
 import random
@@ -25,16 +27,22 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--model', type=str, default=None, help='If specified, limit to model')
+    parser.add_argument('--is_cpu_optimized', action='store_true', default=False, help='If TRUE, benchmark the int8-quantized SDPA version of each model on CPU')
+    parser.add_argument('--n_threads', type=int, default=None, help='If specified, # of CPU threads used by torch')
     return parser.parse_args()
 
-def process_checkpoint(ckpt_path: str, device: str, batch_size: int, n_trials: int = 3) -> Dict[str, Any]:
-    ckpt = torch.load(ckpt_path, map_location='cpu', weights_only=False)
-    config = load_config_from_ckpt(ckpt)
+def synchronize(device: str) -> None:
+    if 'cuda' in str(device):
+        torch.cuda.synchronize()
+
+def process_checkpoint(ckpt_path: Union[str, CheckpointHandle], device: str, batch_size: int, n_trials: int = 3, is_cpu_optimized: bool = False) -> Dict[str, Any]:
+    config = load_config_from_path(ckpt_path)
     tokenizer = load_tokenizer_from_path(ckpt_path)
-    model = load_model_from_path(ckpt_path)
+    model = load_model_from_path(ckpt_path, device=device)
+    if is_cpu_optimized:
+        model = optimize_model_for_cpu(model, is_quantize=True, is_copy=False)
     model = model.model
     model.eval()  # Set the model to evaluation mode
-    model.to(device)
 
     model_name = config['model']['name'].lower()
     model_max_length = config['data']['dataloader']['max_length']
@@ -50,7 +58,9 @@ def process_checkpoint(ckpt_path: str, device: str, batch_size: int, n_trials: i
     print(f"input_ids.shape = {input_ids.shape} | context length = {prompt_length}")
 
     # Warmup model
-    model = torch.compile(model)
+    if not is_cpu_optimized:
+        # NOTE: Dynamically quantized layers don't compile, so the CPU-optimized model runs eagerly
+        model = torch.compile(model)
     if 'mamba' in model_name:
         output = model.generate(
             input_ids=input_ids[:1],
@@ -71,7 +81,7 @@ def process_checkpoint(ckpt_path: str, device: str, batch_size: int, n_trials: i
     del output
     
     # Run benchmark
-    torch.cuda.synchronize()
+    synchronize(device)
     start_time = time.time()
     for run in range(1, n_trials + 1):
         print(f"[{model_uuid}] Run {run} / {n_trials}")
@@ -95,7 +105,7 @@ def process_checkpoint(ckpt_path: str, device: str, batch_size: int, n_trials: i
                 pad_token_id=4,
             )
         del output
-    torch.cuda.synchronize()
+    synchronize(device)
         
     # End timing
     end_time = time.time()
@@ -110,6 +120,8 @@ def process_checkpoint(ckpt_path: str, device: str, batch_size: int, n_trials: i
         'n_trials': n_trials,
         'mean_inference_time_seconds': inference_time / n_trials,
         'batch_size': batch_size,
+        'device': device,
+        'is_cpu_optimized': is_cpu_optimized,
         'prompt_length': prompt_length,
         'num_tokens_to_generate': num_tokens_to_generate,
     }
@@ -139,6 +151,12 @@ def main():
     # Define the output CSV file path
     device = args.device
     model = args.model
+    if args.is_cpu_optimized:
+        assert device == 'cpu', f"Error -- `--is_cpu_optimized` requires `--device cpu`, not `{device}`"
+        # Mamba + Hyena rely on CUDA kernels, so only benchmark GPT/Llama on CPU
+        checkpoint_paths = [ckpt for ckpt in checkpoint_paths if 'gpt' in ckpt or 'llama' in ckpt]
+    if device == 'cpu':
+        set_cpu_threads(args.n_threads)
     output_csv = f'inference_times_{model}.csv'
 
     # Limit to specific model
@@ -154,9 +172,11 @@ def main():
     # Process each checkpoint
     for ckpt_path in checkpoint_paths:
         print(f"Processing checkpoint: {ckpt_path}")
+        # Read the ckpt once, and reuse it across batch sizes
+        ckpt_handle = CheckpointHandle(ckpt_path)
         for batch_size in [1, 2, 4, 8, 16, 32, 64, 128]:
             try:
-                result = process_checkpoint(ckpt_path, device, batch_size, n_trials=N_TRIALS)
+                result = process_checkpoint(ckpt_handle, device, batch_size, n_trials=N_TRIALS, is_cpu_optimized=args.is_cpu_optimized)
                 results.append(result)
             except Exception as e:
                 print(f"Error w/ model {model} @ batch size {batch_size}: {e}")
@@ -0,0 +1,38 @@
+"""
+Usage:
+    python export_onnx.py \
+        --path_to_ckpt /share/pi/nigam/mwornow/hf_ehr/cache/runs/gpt2-base-clmbr/ckpts/train-tokens-total_nonPAD-ckpt_val=2000000000-persist.ckpt \
+        --path_to_output_dir /share/pi/nigam/mwornow/hf_ehr/cache/exports/gpt2-base-clmbr-onnx/ \
+        --format onnx
+
+Purpose:
+    Export a model ckpt (GPT / Llama / BERT / T5) to ONNX or TorchScript with dynamic batch + sequence axes, alongside its
+    config + tokenizer config. The export is then reloaded and checked against the eager model's outputs (see `hf_ehr/models/export.py`).
+"""
+
+import argparse
+from loguru import logger
+from hf_ehr.models.export import export_ckpt, EXPORT_FORMATS
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export a model ckpt to ONNX / TorchScript")
+    parser.add_argument("--path_to_ckpt", required=True, type=str, help="Path to model .ckpt (or safetensors export)")
+    parser.add_argument("--path_to_output_dir", required=True, type=str, help="Path to directory where the exported model + configs will be saved")
+    parser.add_argument("--format", type=str, default="onnx", choices=EXPORT_FORMATS, help="Export format")
+    parser.add_argument("--opset_version", type=int, default=17, help="ONNX opset version (only used if `--format onnx`)")
+    parser.add_argument("--atol", type=float, default=1e-3, help="Max abs diff allowed between eager and exported outputs")
+    parser.add_argument("--is_skip_verify", action="store_true", default=False, help="If TRUE, skip reloading the exported model to check its outputs")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logger.info(f"Exporting `{args.path_to_ckpt}` to `{args.path_to_output_dir}` as {args.format}")
+    metadata = export_ckpt(args.path_to_ckpt, args.path_to_output_dir, format=args.format, opset_version=args.opset_version,
+                           is_check_parity=not args.is_skip_verify, atol=args.atol)
+    if not args.is_skip_verify:
+        assert metadata['parity']['is_match'], f"Error -- Exported model doesn't match eager model (atol={args.atol}): {metadata['parity']['max_abs_diffs']}"
+        logger.info(f"Verified exported outputs match eager outputs | max_abs_diffs={metadata['parity']['max_abs_diffs']}")
+    logger.success(f"Done! Saved export to `{args.path_to_output_dir}`")
+
+if __name__ == "__main__":
+    main()
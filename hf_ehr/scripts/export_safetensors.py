@@ -0,0 +1,41 @@
+"""
+Usage:
+    python export_safetensors.py \
+        --path_to_ckpt /share/pi/nigam/mwornow/hf_ehr/cache/runs/gpt2-base-clmbr/ckpts/train-tokens-total_nonPAD-ckpt_val=2000000000-persist.ckpt \
+        --path_to_output_dir /share/pi/nigam/mwornow/hf_ehr/cache/exports/gpt2-base-clmbr/
+
+Purpose:
+    Export the model weights (i.e. no optimizer state) of a Lightning ckpt as sharded safetensors + config + tokenizer config.
+    The output directory can be passed anywhere a ckpt path is accepted (e.g. `load_model_from_path()`, `CheckpointHandle`).
+"""
+
+import argparse
+from loguru import logger
+from hf_ehr.utils import export_ckpt_to_safetensors, load_model_from_path
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export a model ckpt to sharded safetensors")
+    parser.add_argument("--path_to_ckpt", required=True, type=str, help="Path to model .ckpt")
+    parser.add_argument("--path_to_output_dir", required=True, type=str, help="Path to directory where safetensors + configs will be saved")
+    parser.add_argument("--max_shard_size_gb", type=float, default=2.0, help="Max size of each safetensors shard (in GB)")
+    parser.add_argument("--is_skip_verify", action="store_true", default=False, help="If TRUE, skip reloading the exported model to check its weights")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logger.info(f"Exporting `{args.path_to_ckpt}` to `{args.path_to_output_dir}`")
+    export_ckpt_to_safetensors(args.path_to_ckpt, args.path_to_output_dir, max_shard_size=int(args.max_shard_size_gb * 1024**3))
+    
+    if not args.is_skip_verify:
+        # Check that the export round-trips to the same weights
+        model_orig = load_model_from_path(args.path_to_ckpt)
+        model_export = load_model_from_path(args.path_to_output_dir)
+        state_dict_export = model_export.state_dict()
+        for key, val in model_orig.state_dict().items():
+            assert key in state_dict_export, f"Error -- `{key}` missing from exported model"
+            assert val.shape == state_dict_export[key].shape and (val == state_dict_export[key]).all(), f"Error -- `{key}` differs in exported model"
+        logger.info(f"Verified exported weights match original ckpt")
+    logger.success(f"Done! Saved export to `{args.path_to_output_dir}`")
+
+if __name__ == "__main__":
+    main()
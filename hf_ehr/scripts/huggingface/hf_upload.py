@@ -17,6 +17,7 @@ from transformers import GPT2LMHeadModel, GPT2Config, LlamaForCausalLM, LlamaCon
 from huggingface_hub import HfApi, create_repo, upload_folder
 from safetensors.torch import save_model
 from hf_ehr.scripts.huggingface.hf_readme import readme_text
+from hf_ehr.utils import CheckpointHandle
 
 def get_param_count(model) -> int:
     """Returns the number of parameters in the model."""
@@ -51,8 +52,9 @@ for model_name in tqdm(models):
     path_to_config: str = os.path.join(path_to_model, 'logs', 'artifacts', 'config.yaml')
     path_to_tokenizer: str = os.path.join(path_to_model, 'logs', 'artifacts', 'tokenizer_config.json')
 
-    # Load checkpoint
-    ckpt = torch.load(path_to_ckpt, map_location='cpu')
+    # Load checkpoint (memory-mapped, so optimizer state is never read into memory)
+    # NOTE: `path_to_ckpt` can also be a directory created by `hf_ehr/scripts/export_safetensors.py`
+    ckpt_handle = CheckpointHandle(path_to_ckpt)
 
     # Load config
     with open(path_to_config) as f:
@@ -91,7 +93,7 @@ for model_name in tqdm(models):
         config['model']['config_kwargs']['pad_vocab_size_multiple'] = 1
 
     # Instantiate model and load weights
-    new_state_dict = ckpt['state_dict']
+    new_state_dict = ckpt_handle.state_dict
     if 'gpt' in model_name:
         new_state_dict = {k.replace('model.', ''): v for k, v in new_state_dict.items()}
     elif 'hyena' in model_name:
@@ -1,4 +1,6 @@
 import os
+import json
+import time
 import shutil
 import hydra
 import wandb
@@ -7,6 +9,7 @@ import datetime
 import lightning.pytorch as pl
 from lightning.pytorch.loggers import WandbLogger, TensorBoardLogger, MLFlowLogger
 from lightning.pytorch.callbacks import ModelCheckpoint, Callback
+from lightning.pytorch.plugins.io import TorchCheckpointIO
 from lightning.pytorch.utilities import rank_zero_only
 
 from loguru import logger
@@ -25,23 +28,44 @@ from hf_ehr.models.t5 import T5LanguageModel
 from hf_ehr.trainer.loaders import load_datasets, load_dataloaders
 from hf_ehr.config import rewrite_paths_for_carina_from_config
 from hf_ehr.logger.reloggers import WandbRelogger
+from hf_ehr.models.modules import BaseModel
+from hf_ehr.trainer.memory_probe import MemoryProbe, get_memory_probe_signature, get_memory_probe_signature_key
+from hf_ehr.utils import save_ckpt_metadata, get_path_to_ckpt_metadata
+
+EFFECTIVE_BATCH_TOKENS: int = 65536 # Tokens per optimizer step, i.e. `max_tokens * accumulate_grad_batches`
 
 class GradNormCallback(Callback):
     """
     Source: https://github.com/Lightning-AI/lightning/issues/1462
+
+    NOTE: The norm is computed on-device in a single fused `torch._foreach_norm()` call and handed to the model, 
+    which logs it on its next metrics flush (see `BaseModel.flush_training_window()`), so this never forces a GPU->CPU sync.
     """
 
-    def gradient_norm(self, model):
-        total_norm = 0.0
-        for p in model.parameters():
-            if p.grad is not None:
-                param_norm = p.grad.detach().data.norm(2)
-                total_norm += param_norm.item() ** 2
-        total_norm = total_norm ** (1. / 2)
-        return total_norm
+    def gradient_norm(self, model) -> torch.Tensor:
+        grads: List[torch.Tensor] = [ p.grad.detach() for p in model.parameters() if p.grad is not None ]
+        if len(grads) == 0:
+            return torch.zeros((), device=model.device)
+        return torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads, 2)), 2)
 
     def on_before_optimizer_step(self, trainer, model, optimizer):
-        model.log("optim/grad_norm_raw", self.gradient_norm(model))
+        model.log_grad_norm(self.gradient_norm(model))
+
+class SidecarCheckpointIO(TorchCheckpointIO):
+    """
+    Writes a small JSON sidecar (step, tokens, epoch, wall time) next to every saved ckpt,
+    so that ckpts can be discovered/compared without loading them (see `get_most_recent_ckpt_from_output_dir()`)
+    """
+
+    def save_checkpoint(self, checkpoint: Dict[str, Any], path, storage_options: Optional[Any] = None) -> None:
+        super().save_checkpoint(checkpoint, path, storage_options=storage_options)
+        save_ckpt_metadata(str(path), checkpoint)
+
+    def remove_checkpoint(self, path) -> None:
+        super().remove_checkpoint(path)
+        path_to_metadata: str = get_path_to_ckpt_metadata(str(path))
+        if os.path.exists(path_to_metadata):
+            os.remove(path_to_metadata)
 
 def trigger_validation(trainer):
     """
@@ -91,8 +115,12 @@ class MetricBasedCheckpoint(pl.callbacks.Callback):
         self.last_ckpt_metric_value: Optional[Any] = None
         self.is_run_val: bool = is_run_val
 
-    def on_train_batch_end(self, trainer, *args, **kwargs):
-        metrics = trainer.callback_metrics
+    def on_train_batch_end(self, trainer, pl_module, *args, **kwargs):
+        # NOTE: Prefer the host-side copy of the last metrics flush (see `BaseModel.flush_training_window()`), 
+        # since values in `trainer.callback_metrics` live on the GPU and reading them every step forces a sync
+        metrics = getattr(pl_module, 'flushed_train_metrics', None)
+        if metrics is None:
+            metrics = trainer.callback_metrics
         metric_value = metrics.get(self.metric_name)
         
         if metric_value is not None:
@@ -139,7 +167,7 @@ def train_flops_metric_func(val: int, last_val: Optional[int], config) -> Tuple[
     if last_val is None:
         # Default to 0
         last_val = 0
-    interval: int = int(config.callbacks.model_checkpointing.every_n_flops)
+    interval: int = int(float(config.callbacks.model_checkpointing.every_n_flops)) # NOTE: `float()` so that YAML values like `5e16` work
     current: int = int(val // interval)
     last: int = int(last_val // interval)
     return last < current, int(val), current * interval
@@ -153,22 +181,96 @@ def train_token_metric_func(val: int, last_val: Optional[int], config) -> Tuple[
     last: int = int(last_val // interval)
     return last < current, int(val), current * interval
 
-@hydra.main(version_base=None, config_path='../configs/', config_name="config")
-def main(config: DictConfig) -> None:
-    # Rewrite paths for /local-scratch on certain partitions
-    config = rewrite_paths_for_carina_from_config(config)
-
+def set_accumulate_grad_batches(config: DictConfig) -> bool:
+    """Set `accumulate_grad_batches` so that each optimizer step sees `EFFECTIVE_BATCH_TOKENS` tokens. Returns FALSE on failure."""
     if 'trainer' in config and 'accumulate_grad_batches' in config.trainer:
         if config.trainer.accumulate_grad_batches == "__PLACEHOLDER__":
             try:
-                assert config.data.dataloader.approx_batch_sampler.max_tokens <= 65536, "config.data.dataloader.approx_batch_sampler.max_tokens must be <= 65536"
-                assert 65536 % config.data.dataloader.approx_batch_sampler.max_tokens == 0, "config.data.dataloader.approx_batch_sampler.max_tokens must be a factor of 65536"
-                config.trainer.accumulate_grad_batches = 65536 // config.data.dataloader.approx_batch_sampler.max_tokens
+                assert config.data.dataloader.approx_batch_sampler.max_tokens <= EFFECTIVE_BATCH_TOKENS, f"config.data.dataloader.approx_batch_sampler.max_tokens must be <= {EFFECTIVE_BATCH_TOKENS}"
+                assert EFFECTIVE_BATCH_TOKENS % config.data.dataloader.approx_batch_sampler.max_tokens == 0, f"config.data.dataloader.approx_batch_sampler.max_tokens must be a factor of {EFFECTIVE_BATCH_TOKENS}"
+                config.trainer.accumulate_grad_batches = EFFECTIVE_BATCH_TOKENS // config.data.dataloader.approx_batch_sampler.max_tokens
                 logger.info(f"Manually setting accumulate_grad_batches: {config.trainer.accumulate_grad_batches}")
             except (KeyError, ZeroDivisionError) as e:
                 logger.error(f"Failed to calculate accumulate_grad_batches: {e}")
-                return
+                return False
+    return True
+
+def get_path_to_autotune_decision(config: DictConfig) -> str:
+    return os.path.join(config.main.path_to_output_dir, 'autotune_max_tokens.json')
+
+def wait_for_autotune_decision(path_to_decision: str, decision_key: Dict[str, Any], timeout_s: float, poll_interval_s: float = 5.0) -> Optional[int]:
+    """Block until rank 0 has written its autotuned `max_tokens` (for this `decision_key`) to `path_to_decision`. Returns None if rank 0 couldn't fit anything."""
+    start: float = time.time()
+    while time.time() - start < timeout_s:
+        if os.path.exists(path_to_decision):
+            try:
+                with open(path_to_decision, 'r') as f:
+                    decision: Dict[str, Any] = json.load(f)
+                if all(decision.get(key) == val for key, val in decision_key.items()):
+                    return decision['max_tokens']
+            except (OSError, json.JSONDecodeError):
+                pass
+        time.sleep(poll_interval_s)
+    raise TimeoutError(f"Timed out after {timeout_s}s waiting for rank 0 to write its autotuned max_tokens to `{path_to_decision}` (expected {decision_key}). "
+                       f"If ranks run on different GPU types, then set `data.dataloader.approx_batch_sampler.max_tokens` explicitly.")
+
+def autotune_max_tokens(model: BaseModel, config: DictConfig, vocab_size: int, precision: str) -> int:
+    """
+        Find the largest `max_tokens` that fits in GPU memory (keeping `trainer.memory_probe.headroom` free) by running short 
+        forward/backward probes. Only considers factors of `EFFECTIVE_BATCH_TOKENS`, so that `accumulate_grad_batches` stays an integer.
+        Probe results are cached per model/hardware signature (see `hf_ehr/trainer/memory_probe.py`), so later launches are free.
+
+        NOTE: Only rank 0 probes. Its decision is written to `{path_to_output_dir}/autotune_max_tokens.json`, which every
+        other rank waits for (the process group doesn't exist yet), so all ranks use the same `max_tokens` + `accumulate_grad_batches`.
+    """
+    max_length: int = config.data.dataloader.max_length
+    memory_probe_config = getattr(config.trainer, 'memory_probe', None)
+    headroom: float = getattr(memory_probe_config, 'headroom', 0.1) if memory_probe_config is not None else 0.1
+    timeout_s: float = getattr(memory_probe_config, 'autotune_timeout_s', 3600) if memory_probe_config is not None else 3600
+    candidates: List[int] = [ 2 ** k for k in range(EFFECTIVE_BATCH_TOKENS.bit_length()) if max_length <= 2 ** k and EFFECTIVE_BATCH_TOKENS % (2 ** k) == 0 ]
+    assert len(candidates) > 0, f"Error -- No valid max_tokens for max_length={max_length} (must be <= {EFFECTIVE_BATCH_TOKENS})"
+    
+    # NOTE: Run on this process's GPU (PTL hasn't set up devices yet)
+    device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    signature_key: str = get_memory_probe_signature_key(get_memory_probe_signature(config, vocab_size, precision, device))
+    # NOTE: Keyed by signature, so a rank on a different GPU type (or a stale file from a different setup) never picks up rank 0's decision
+    decision_key: Dict[str, Any] = { 'signature_key' : signature_key, 'candidates' : candidates, 'headroom' : headroom }
+    path_to_decision: str = get_path_to_autotune_decision(config)
+    if rank_zero_only.rank == 0:
+        torch.cuda.set_device(device)
+        model.to(device)
+        probe = MemoryProbe(model, 
+                            config, 
+                            vocab_size, 
+                            precision=precision, 
+                            device=device, 
+                            path_to_cache=getattr(memory_probe_config, 'path_to_cache', None) if memory_probe_config is not None else None)
+        max_tokens: Optional[int] = probe.search_max_safe_max_tokens(candidates, headroom=headroom)
+        probe.save()
+        model.cpu()
+        torch.cuda.empty_cache()
+        # Atomically write decision (even if nothing fit, so that other ranks fail too instead of hanging)
+        path_to_tmp: str = f"{path_to_decision}.{os.getpid()}.tmp"
+        with open(path_to_tmp, 'w') as f:
+            json.dump({ **decision_key, 'max_tokens' : max_tokens, 'timestamp' : time.time() }, f, indent=2)
+        os.replace(path_to_tmp, path_to_decision)
+    else:
+        logger.info(f"Waiting for rank 0 to autotune max_tokens (signature=`{signature_key}`)")
+        max_tokens: Optional[int] = wait_for_autotune_decision(path_to_decision, decision_key, timeout_s)
+    if max_tokens is None:
+        raise ValueError(f"Autotuner couldn't fit even a single sequence of max_length={max_length} with headroom={headroom} (signature=`{signature_key}`)")
+    logger.info(f"Autotuned max_tokens={max_tokens} (headroom={headroom}, signature=`{signature_key}`)")
+    return max_tokens
+
+@hydra.main(version_base=None, config_path='../configs/', config_name="config")
+def main(config: DictConfig) -> None:
+    # Rewrite paths for /local-scratch on certain partitions
+    config = rewrite_paths_for_carina_from_config(config)
 
+    # NOTE: If `max_tokens` is "auto", then `accumulate_grad_batches` is set after autotuning (once the model is loaded)
+    is_autotune_max_tokens: bool = str(config.data.dataloader.approx_batch_sampler.max_tokens) == 'auto'
+    if not is_autotune_max_tokens and not set_accumulate_grad_batches(config):
+        return
 
     # Load config
     print(config)
@@ -182,6 +284,9 @@ def main(config: DictConfig) -> None:
     seed: int = config.main.seed
     is_force_restart: bool = config.main.is_force_restart
 
+    # NOTE: Must match the precision used by `MemoryProbe` signatures, so that autotuning results are reused by `BaseModel.on_train_start()`
+    precision: str = "bf16-mixed" if torch.cuda.is_bf16_supported() else "16-mixed"
+
     # Random seed
     pl.seed_everything(seed, workers=True)
 
@@ -357,6 +462,17 @@ def main(config: DictConfig) -> None:
     else:
         raise ValueError(f"Model `{config.model.name}` not supported.")
     logger.info(f"Parameter count of model = {model.get_param_count()}")
+
+    # Autotune `max_tokens` (and therefore `accumulate_grad_batches`)
+    if is_autotune_max_tokens:
+        assert config.data.dataloader.mode == 'approx', f"Error -- `max_tokens=auto` requires `data.dataloader.mode=approx`, not `{config.data.dataloader.mode}`"
+        config.data.dataloader.approx_batch_sampler.max_tokens = autotune_max_tokens(model, config, tokenizer.vocab_size, precision)
+        if not set_accumulate_grad_batches(config):
+            return
+        if run is not None:
+            run.config.update({ 'autotuned_max_tokens' : config.data.dataloader.approx_batch_sampler.max_tokens, 
+                                'autotuned_accumulate_grad_batches' : config.trainer.accumulate_grad_batches }, allow_val_change=True)
+    logger.info(f"Training FLOPs per token of model @ context length {config.data.dataloader.max_length} = {model.flops_per_token:,}")
     
     # Datasets
     logger.info(f"Loading `{config.data.dataset.name}` datasets...")
@@ -430,16 +546,16 @@ def main(config: DictConfig) -> None:
             ),
         ]
     if getattr(config.callbacks.model_checkpointing, 'every_n_flops', None) not in [None, "None"]:
-        logger.error(f"Skipping FLOPs checkpoint b/c incorrectly calculated")
         # Save checkpoint every `every_n_flops` FLOPs; persists all models
-        # callbacks += [ 
-        #     MetricBasedCheckpoint(
-        #         dirpath=path_to_ckpt_dir,
-        #         metric_name="train/total_flops",
-        #         is_valid_metric_func=lambda x,y: train_flops_metric_func(x, y, config),
-        #         is_run_val=config.callbacks.model_checkpointing.is_run_eval_on_checkpoint,
-        #     ),
-        # ]
+        logger.critical("Adding MetricBasedCheckpoint for FLOPs...")
+        callbacks += [ 
+            MetricBasedCheckpoint(
+                dirpath=path_to_ckpt_dir,
+                metric_name="train/total_flops",
+                is_valid_metric_func=lambda x,y: train_flops_metric_func(x, y, config),
+                is_run_val=config.callbacks.model_checkpointing.is_run_eval_on_checkpoint,
+            ),
+        ]
         
     if is_log_grad_norm:
         callbacks += [ GradNormCallback() ]
@@ -453,13 +569,14 @@ def main(config: DictConfig) -> None:
     trainer = pl.Trainer(
         logger=loggers,
         callbacks=callbacks,
+        plugins=[ SidecarCheckpointIO() ],
         accelerator='gpu',
         devices=config.trainer.devices,
         strategy=config.trainer.distributed_backend,
         limit_train_batches=config.trainer.limit_train_batches,
         limit_val_batches=config.trainer.limit_val_batches,
         log_every_n_steps=config.logging.log_every_n_steps,
-        precision="bf16" if torch.cuda.is_bf16_supported() else 16,
+        precision=precision,
         val_check_interval=config.trainer.val_check_interval, # check val set every 10% of training batches (useful for large training datasets, rather than wait for full epoch to finish)
         check_val_every_n_epoch=config.trainer.check_val_every_n_epoch, # log val PPL at end of every epoch
         max_epochs=config.trainer.max_epochs,
@@ -0,0 +1,173 @@
+"""
+Usage:
+    python load_generator.py \
+        --url http://127.0.0.1:8000 \
+        --endpoint embed \
+        --concurrency 16 \
+        --n_requests 2000 \
+        --path_to_output load_test.json
+
+Purpose:
+    Measure throughput + latency of a running `server.py` with synthetic patients.
+    Each of `--concurrency` clients sends requests back-to-back (closed loop) until `--n_requests` have been sent in total.
+    Each request contains `--patients_per_request` timelines of random token IDs, with lengths drawn log-uniformly
+    from [`--min_length`, `max_length` of the served model] (EHR timeline lengths are heavy-tailed).
+"""
+
+import json
+import time
+import argparse
+import threading
+import urllib.request
+import urllib.error
+import numpy as np
+from typing import Dict, Any, List, Optional
+from loguru import logger
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load generator for the inference server")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000", help="Base URL of the server")
+    parser.add_argument("--endpoint", type=str, default="embed", choices=[ 'embed', 'next_token' ], help="Endpoint to hit")
+    parser.add_argument("--concurrency", type=int, default=16, help="# of concurrent clients")
+    parser.add_argument("--n_requests", type=int, default=1000, help="Total # of requests to send")
+    parser.add_argument("--patients_per_request", type=int, default=1, help="# of timelines per request")
+    parser.add_argument("--min_length", type=int, default=16, help="Min # of tokens per synthetic timeline")
+    parser.add_argument("--max_length", type=int, default=None, help="Max # of tokens per synthetic timeline (defaults to the model's `max_length`)")
+    parser.add_argument("--top_k", type=int, default=10, help="`top_k` for `/next_token` requests")
+    parser.add_argument("--n_warmup_requests", type=int, default=10, help="# of requests to send (and ignore) before measuring")
+    parser.add_argument("--timeout_s", type=float, default=300.0, help="Timeout per request")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic patients")
+    parser.add_argument("--target_p99_ms", type=float, default=None, help="If specified, check that p99 latency (in ms) is at most this")
+    parser.add_argument("--target_requests_per_second", type=float, default=None, help="If specified, check that throughput (requests/sec) is at least this")
+    parser.add_argument("--path_to_output", type=str, default=None, help="If specified, save results as JSON here")
+    return parser.parse_args()
+
+def get_json(url: str, timeout_s: float) -> Dict[str, Any]:
+    with urllib.request.urlopen(url, timeout=timeout_s) as response:
+        return json.loads(response.read())
+
+def post_json(url: str, body: Dict[str, Any], timeout_s: float) -> Dict[str, Any]:
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'), headers={ 'Content-Type' : 'application/json' }, method='POST')
+    with urllib.request.urlopen(request, timeout=timeout_s) as response:
+        return json.loads(response.read())
+
+def make_synthetic_patients(n_patients: int, min_length: int, max_length: int, vocab_size: int, pad_token_id: int, rng: np.random.Generator) -> List[List[int]]:
+    """Random timelines (no PAD tokens), with log-uniform lengths in [min_length, max_length]."""
+    lengths: np.ndarray = np.exp(rng.uniform(np.log(min_length), np.log(max_length), size=n_patients)).astype(int)
+    patients: List[List[int]] = []
+    for length in lengths:
+        tokens: np.ndarray = rng.integers(0, vocab_size, size=int(length))
+        tokens[tokens == pad_token_id] = (pad_token_id + 1) % vocab_size
+        patients.append(tokens.tolist())
+    return patients
+
+def make_body(args: argparse.Namespace, patients: List[List[int]]) -> Dict[str, Any]:
+    body: Dict[str, Any] = { 'input_ids' : patients }
+    if args.endpoint == 'next_token':
+        body['top_k'] = args.top_k
+    return body
+
+def main():
+    args = parse_args()
+    health: Dict[str, Any] = get_json(f"{args.url}/health", args.timeout_s)
+    logger.info(f"Server: {health['model_name']} | vocab_size={health['vocab_size']} | max_length={health['max_length']}")
+    max_length: int = args.max_length if args.max_length is not None else health['max_length']
+    assert args.min_length <= max_length, f"Error -- min_length={args.min_length} must be <= max_length={max_length}"
+    url: str = f"{args.url}/{args.endpoint}"
+
+    # Pre-generate all requests, so that generating them isn't part of the measurement
+    rng = np.random.default_rng(args.seed)
+    n_total: int = args.n_warmup_requests + args.n_requests
+    bodies: List[Dict[str, Any]] = [
+        make_body(args, make_synthetic_patients(args.patients_per_request, args.min_length, max_length, health['vocab_size'], health['pad_token_id'], rng))
+        for _ in range(n_total)
+    ]
+    n_tokens_per_request: List[int] = [ sum(len(p) for p in body['input_ids']) for body in bodies ]
+
+    # Warmup
+    for body in bodies[:args.n_warmup_requests]:
+        post_json(url, body, args.timeout_s)
+
+    # Run clients
+    next_idx: List[int] = [ args.n_warmup_requests ]
+    lock = threading.Lock()
+    latencies: List[Optional[float]] = [ None ] * n_total
+    errors: List[str] = []
+
+    def client() -> None:
+        while True:
+            with lock:
+                idx: int = next_idx[0]
+                next_idx[0] += 1
+            if idx >= n_total:
+                return
+            start: float = time.perf_counter()
+            try:
+                post_json(url, bodies[idx], args.timeout_s)
+                latencies[idx] = time.perf_counter() - start
+            except (urllib.error.URLError, OSError) as e:
+                with lock:
+                    errors.append(str(e))
+
+    stats_before: Dict[str, Any] = get_json(f"{args.url}/health", args.timeout_s)['stats']
+    start: float = time.perf_counter()
+    threads: List[threading.Thread] = [ threading.Thread(target=client) for _ in range(args.concurrency) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_s: float = time.perf_counter() - start
+    stats_after: Dict[str, Any] = get_json(f"{args.url}/health", args.timeout_s)['stats']
+
+    # Summarize
+    measured: np.ndarray = np.array([ x for x in latencies[args.n_warmup_requests:] if x is not None ], dtype=np.float64)
+    n_ok: int = measured.shape[0]
+    n_tokens: int = sum(n for n, x in zip(n_tokens_per_request[args.n_warmup_requests:], latencies[args.n_warmup_requests:]) if x is not None)
+    n_batches: int = stats_after['n_batches'] - stats_before['n_batches']
+    n_padded_tokens: int = stats_after['n_padded_tokens'] - stats_before['n_padded_tokens']
+    results: Dict[str, Any] = {
+        'url' : url,
+        'model_name' : health['model_name'],
+        'concurrency' : args.concurrency,
+        'patients_per_request' : args.patients_per_request,
+        'min_length' : args.min_length,
+        'max_length' : max_length,
+        'n_requests' : args.n_requests,
+        'n_ok' : n_ok,
+        'n_errors' : len(errors),
+        'elapsed_s' : elapsed_s,
+        'requests_per_second' : n_ok / elapsed_s,
+        'patients_per_second' : n_ok * args.patients_per_request / elapsed_s,
+        'tokens_per_second' : n_tokens / elapsed_s,
+        'latency_ms' : {
+            'mean' : float(measured.mean() * 1000) if n_ok > 0 else None,
+            **{ f"p{q}" : float(np.percentile(measured, q) * 1000) if n_ok > 0 else None for q in [ 50, 90, 95, 99 ] },
+            'max' : float(measured.max() * 1000) if n_ok > 0 else None,
+        },
+        'server' : {
+            'n_batches' : n_batches,
+            'mean_batch_size' : (stats_after['n_timelines'] - stats_before['n_timelines']) / n_batches if n_batches > 0 else None,
+            'padding_efficiency' : (stats_after['n_tokens'] - stats_before['n_tokens']) / n_padded_tokens if n_padded_tokens > 0 else None,
+        },
+    }
+    results['targets'] = {
+        'p99_ms' : args.target_p99_ms,
+        'requests_per_second' : args.target_requests_per_second,
+        'is_met' : (
+            len(errors) == 0
+            and (args.target_p99_ms is None or (n_ok > 0 and results['latency_ms']['p99'] <= args.target_p99_ms))
+            and (args.target_requests_per_second is None or results['requests_per_second'] >= args.target_requests_per_second)
+        ),
+    }
+    if len(errors) > 0:
+        logger.warning(f"{len(errors)} requests failed, e.g.: {errors[0]}")
+    logger.info(json.dumps(results, indent=2))
+    if args.path_to_output is not None:
+        with open(args.path_to_output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.success(f"Saved results to `{args.path_to_output}`")
+    if not results['targets']['is_met']:
+        logger.critical(f"Missed targets | p99={results['latency_ms']['p99']}ms (target={args.target_p99_ms}) | requests/sec={results['requests_per_second']:.1f} (target={args.target_requests_per_second}) | errors={len(errors)}")
+
+if __name__ == "__main__":
+    main()
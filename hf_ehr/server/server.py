@@ -0,0 +1,369 @@
+"""
+Usage:
+    python server.py \
+        --path_to_ckpt /share/pi/nigam/suhana/hf_ehr/cache/runs_backup/gpt-base-1024--clmbr/ckpts/train-tokens-total_nonPAD-ckpt_val=2000000000-persist.ckpt \
+        --device cuda:0 \
+        --port 8000
+
+Purpose:
+    Local inference server that keeps one model + tokenizer resident, so downstream consumers don't each load their own copy.
+    Concurrent requests are split into timelines and dynamically batched by a token budget (`--max_tokens`, incl. PAD).
+
+Endpoints (JSON):
+    GET  /health      => { status, model_name, vocab_size, max_length, pad_token_id, stats }
+    POST /embed       { "input_ids" : [[int]] } or { "events" : [[{ code, value, unit, start, end, omop_table }]] }, "embed_strat" : "last" | "mean"
+                      => { "embeddings" : [[float]] }
+    POST /next_token  { "input_ids" | "events" : ..., "top_k" : int } (top_k=-1 => full distribution)
+                      => { "top_k_ids" : [[int]], "top_k_log_probs" : [[float]], "top_k_tokens" : [[str]] }
+
+    Each timeline is truncated to its last `max_length` tokens (same as `chunk_strat='last'` in `hf_ehr/eval/ehrshot.py`).
+
+See `load_generator.py` for measuring throughput + latency with synthetic patients.
+"""
+
+import time
+import json
+import queue
+import datetime
+import argparse
+import threading
+import torch
+import numpy as np
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, List, Optional, Tuple
+from jaxtyping import Float
+from loguru import logger
+from hf_ehr.config import Event
+from hf_ehr.utils import CheckpointHandle, load_model_from_path
+from hf_ehr.models.hyena import hyena_forward
+
+EMBED_STRATS = [ 'last', 'mean' ]
+# Model families that can't be served (Based has no HF model; T5 is encoder-decoder)
+SERVER_UNSUPPORTED_MODELS = [ 'based', 't5' ]
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Local batching inference server for patient embeddings + next-token scores")
+    parser.add_argument("--path_to_ckpt", required=True, type=str, help="Path to model .ckpt (or safetensors export)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind to")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind to")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to run inference on")
+    parser.add_argument("--max_tokens", type=int, default=16_384, help="Max tokens per batch (incl. PAD)")
+    parser.add_argument("--max_batch_size", type=int, default=64, help="Max timelines per batch")
+    parser.add_argument("--max_wait_ms", type=float, default=5.0, help="Max time to wait for more requests before running a partially filled batch")
+    parser.add_argument("--request_timeout_s", type=float, default=300.0, help="Max time a request waits for its results")
+    parser.add_argument("--is_cpu_optimized", action="store_true", default=False, help="If TRUE, serve an int8-quantized SDPA version of the model on CPU (GPT/Llama/BERT only). Requires `--device cpu`")
+    parser.add_argument("--n_threads", type=int, default=None, help="If specified, # of CPU threads used by torch (only relevant if `--device cpu`)")
+    return parser.parse_args()
+
+class TimelineRequest:
+    """One timeline waiting to be batched. `future` is resolved with a dict of results for this timeline."""
+
+    def __init__(self, input_ids: List[int], is_next_token: bool, embed_strat: str = 'last', top_k: int = 10) -> None:
+        self.input_ids: List[int] = input_ids
+        self.is_next_token: bool = is_next_token
+        self.embed_strat: str = embed_strat
+        self.top_k: int = top_k
+        self.future: Future = Future()
+        self.enqueue_time: float = time.perf_counter()
+
+class DynamicBatcher:
+    """
+        Background thread that groups queued timelines into batches of at most `max_tokens` (incl. PAD) and `max_batch_size` rows,
+        waiting at most `max_wait_ms` after the first timeline arrives. Timelines are left-padded to the longest one in the batch.
+
+        NOTE: Requests are served FIFO. A timeline that doesn't fit into the current batch is carried over to start the next one.
+    """
+
+    def __init__(self, model, config, tokenizer, device: str, max_tokens: int = 16_384, max_batch_size: int = 64, max_wait_ms: float = 5.0) -> None:
+        self.model = model
+        self.model_name: str = config['model']['name']
+        self.tokenizer = tokenizer
+        self.pad_token_id: int = tokenizer.pad_token_id
+        self.max_length: int = config.data.dataloader.max_length
+        self.device: str = device
+        self.max_tokens: int = max_tokens
+        self.max_batch_size: int = max_batch_size
+        self.max_wait_s: float = max_wait_ms / 1000
+        assert max_tokens >= self.max_length, f"Error -- max_tokens={max_tokens} must be >= max_length={self.max_length}"
+        self.is_causal: bool = 'bert' not in self.model_name
+        self.idx_2_token: Dict[int, str] = { idx: token for token, idx in tokenizer.get_vocab().items() }
+        self.queue: queue.Queue = queue.Queue()
+        self.carry: Optional[TimelineRequest] = None
+        self.is_running: bool = False
+        self.thread: Optional[threading.Thread] = None
+        self.stats_lock = threading.Lock()
+        self.stats: Dict[str, float] = { 'n_timelines' : 0, 'n_batches' : 0, 'n_tokens' : 0, 'n_padded_tokens' : 0, 'n_errors' : 0, 'model_time_s' : 0.0, 'queue_time_s' : 0.0 }
+
+    def start(self) -> None:
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name='DynamicBatcher', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.is_running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, request: TimelineRequest) -> Future:
+        self.queue.put(request)
+        return request.future
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            stats: Dict[str, Any] = dict(self.stats)
+        stats['queue_size'] = self.queue.qsize()
+        stats['padding_efficiency'] = stats['n_tokens'] / stats['n_padded_tokens'] if stats['n_padded_tokens'] > 0 else None
+        stats['mean_batch_size'] = stats['n_timelines'] / stats['n_batches'] if stats['n_batches'] > 0 else None
+        return stats
+
+    def next_batch(self) -> List[TimelineRequest]:
+        """Block until at least one timeline is queued, then fill the batch until it is full or `max_wait_ms` has passed."""
+        if self.carry is not None:
+            first, self.carry = self.carry, None
+        else:
+            first = self.queue.get(timeout=0.1)
+        batch: List[TimelineRequest] = [ first ]
+        longest: int = len(first.input_ids)
+        deadline: float = time.perf_counter() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining: float = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request: TimelineRequest = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if (len(batch) + 1) * max(longest, len(request.input_ids)) > self.max_tokens:
+                self.carry = request
+                break
+            batch.append(request)
+            longest = max(longest, len(request.input_ids))
+        return batch
+
+    def run(self) -> None:
+        while self.is_running:
+            try:
+                batch: List[TimelineRequest] = self.next_batch()
+            except queue.Empty:
+                continue
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                logger.error(f"Error running batch of {len(batch)} timelines: {e}")
+                with self.stats_lock:
+                    self.stats['n_errors'] += len(batch)
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def forward(self, input_ids: Float[torch.Tensor, 'B L'], attention_mask: Float[torch.Tensor, 'B L'], is_next_token: bool) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Returns (last layer hidden states, logits at the last position -- or None if not `is_next_token`)."""
+        hf_model = self.model.model
+        if 'hyena' in self.model_name:
+            # Hyena's HF model ignores `attention_mask`, so use `hyena_forward()` to skip the left padding
+            # NOTE: Skip `lm_head` over the full sequence, and only project the last position onto the vocab (as below)
+            outputs = hyena_forward(hf_model, input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True, return_dict=True, is_compute_logits=False)
+            hidden_states: Float[torch.Tensor, 'B L H'] = outputs.hidden_states[-1]
+            return hidden_states, (hf_model.lm_head(hidden_states[:, -1, :]).float() if is_next_token else None)
+        if self.is_causal:
+            # NOTE: Only project the last position onto the vocab (left padding => last position is the last real token)
+            hidden_states: Float[torch.Tensor, 'B L H'] = hf_model.base_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            return hidden_states, (hf_model.get_output_embeddings()(hidden_states[:, -1, :]) if is_next_token else None)
+        outputs = hf_model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+        return outputs.hidden_states[-1], None
+
+    def run_batch(self, batch: List[TimelineRequest]) -> None:
+        start: float = time.perf_counter()
+        longest: int = max(len(r.input_ids) for r in batch)
+        input_ids: Float[torch.Tensor, 'B L'] = torch.full((len(batch), longest), self.pad_token_id, dtype=torch.long)
+        for b, request in enumerate(batch):
+            input_ids[b, longest - len(request.input_ids):] = torch.tensor(request.input_ids, dtype=torch.long) # left padding
+        input_ids = input_ids.to(self.device, non_blocking=True)
+        attention_mask: Float[torch.Tensor, 'B L'] = (input_ids != self.pad_token_id).int()
+        is_next_token: bool = any(r.is_next_token for r in batch)
+
+        with torch.inference_mode():
+            hidden_states, logits = self.forward(input_ids, attention_mask, is_next_token)
+            mask: Float[torch.Tensor, 'B L 1'] = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+            embeds_last: np.ndarray = hidden_states[:, -1, :].float().cpu().numpy()
+            embeds_mean: np.ndarray = ((hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)).float().cpu().numpy()
+            log_probs: Optional[torch.Tensor] = torch.log_softmax(logits.float(), dim=-1) if logits is not None else None
+
+        for b, request in enumerate(batch):
+            if request.is_next_token:
+                k: int = log_probs.shape[-1] if request.top_k < 0 else min(request.top_k, log_probs.shape[-1])
+                top_log_probs, top_ids = torch.topk(log_probs[b], k)
+                top_ids: List[int] = top_ids.cpu().tolist()
+                request.future.set_result({
+                    'top_k_ids' : top_ids,
+                    'top_k_log_probs' : top_log_probs.cpu().tolist(),
+                    'top_k_tokens' : [ self.idx_2_token.get(idx) for idx in top_ids ],
+                })
+            else:
+                request.future.set_result({ 'embedding' : (embeds_last[b] if request.embed_strat == 'last' else embeds_mean[b]).tolist() })
+
+        with self.stats_lock:
+            self.stats['n_timelines'] += len(batch)
+            self.stats['n_batches'] += 1
+            self.stats['n_tokens'] += sum(len(r.input_ids) for r in batch)
+            self.stats['n_padded_tokens'] += len(batch) * longest
+            self.stats['model_time_s'] += time.perf_counter() - start
+            self.stats['queue_time_s'] += sum(start - r.enqueue_time for r in batch)
+
+def parse_event(raw: Dict[str, Any]) -> Event:
+    """JSON dict => `Event` (`start` / `end` are ISO 8601 strings)."""
+    return Event(
+        code=raw['code'],
+        value=raw.get('value'),
+        unit=raw.get('unit'),
+        start=datetime.datetime.fromisoformat(raw['start']) if raw.get('start') else None,
+        end=datetime.datetime.fromisoformat(raw['end']) if raw.get('end') else None,
+        omop_table=raw.get('omop_table'),
+    )
+
+def make_handler(batcher: DynamicBatcher, request_timeout_s: float):
+    """Returns a request handler class bound to `batcher`."""
+
+    class InferenceRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive, so clients can reuse connections
+
+        def log_message(self, format: str, *args: Any) -> None:
+            # Silence per-request logging
+            pass
+
+        def send_json(self, status: int, body: Dict[str, Any]) -> None:
+            data: bytes = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_body(self) -> bytes:
+            """Read the full request body, so nothing is left over to be parsed as the next request on this keep-alive connection."""
+            try:
+                n_bytes: int = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                # Can't tell where the body ends, so don't reuse this connection
+                self.close_connection = True
+                raise ValueError("Invalid `Content-Length` header")
+            return self.rfile.read(n_bytes) if n_bytes > 0 else b''
+
+        def get_timelines(self, body: Dict[str, Any]) -> List[List[int]]:
+            """Token IDs for each timeline in `body`, truncated to their last `max_length` tokens."""
+            if 'input_ids' in body:
+                timelines: List[List[int]] = [ [ int(x) for x in timeline ] for timeline in body['input_ids'] ]
+                vocab_size: int = len(batcher.idx_2_token)
+                for timeline in timelines:
+                    if any(x < 0 or x >= vocab_size for x in timeline):
+                        raise ValueError(f"`input_ids` must be in [0, {vocab_size})")
+            elif 'events' in body:
+                timelines = [
+                    batcher.tokenizer([ parse_event(e) for e in events ], add_special_tokens=False)['input_ids'][0] if len(events) > 0 else []
+                    for events in body['events']
+                ]
+                timelines = [ [ int(x) for x in timeline ] for timeline in timelines ]
+            else:
+                raise ValueError("Request must have either `input_ids` or `events`")
+            if any(len(timeline) == 0 for timeline in timelines):
+                raise ValueError("Every timeline must have at least one token")
+            # NOTE: A patient whose codes are all unknown to the tokenizer tokenizes to only PADs
+            if any(all(x == batcher.pad_token_id for x in timeline) for timeline in timelines):
+                raise ValueError("Every timeline must have at least one non-PAD token (i.e. at least one code known to the tokenizer)")
+            return [ timeline[-batcher.max_length:] for timeline in timelines ]
+
+        def do_GET(self) -> None:
+            if self.path == '/health':
+                self.send_json(200, {
+                    'status' : 'ok',
+                    'model_name' : batcher.model_name,
+                    'vocab_size' : len(batcher.idx_2_token),
+                    'max_length' : batcher.max_length,
+                    'pad_token_id' : batcher.pad_token_id,
+                    'stats' : batcher.get_stats(),
+                })
+            else:
+                self.send_json(404, { 'error' : f"Unknown endpoint: {self.path}" })
+
+        def do_POST(self) -> None:
+            try:
+                raw_body: bytes = self.read_body()
+            except ValueError as e:
+                self.send_json(400, { 'error' : str(e) })
+                return
+            if self.path not in [ '/embed', '/next_token' ]:
+                self.send_json(404, { 'error' : f"Unknown endpoint: {self.path}" })
+                return
+            try:
+                body: Dict[str, Any] = json.loads(raw_body or b'{}')
+                timelines: List[List[int]] = self.get_timelines(body)
+                is_next_token: bool = self.path == '/next_token'
+                embed_strat: str = body.get('embed_strat', 'last')
+                if embed_strat not in EMBED_STRATS:
+                    raise ValueError(f"`embed_strat` must be one of {EMBED_STRATS}")
+                top_k: int = body.get('top_k', 10)
+                if not isinstance(top_k, int) or isinstance(top_k, bool) or (top_k < 1 and top_k != -1):
+                    raise ValueError(f"`top_k` must be an int >= 1 (or -1 for the full distribution), not `{top_k}`")
+                if is_next_token and not batcher.is_causal:
+                    raise ValueError(f"`/next_token` requires a causal model, not `{batcher.model_name}`")
+            except (ValueError, KeyError, TypeError, json.JSONDecodeError) as e:
+                self.send_json(400, { 'error' : str(e) })
+                return
+
+            # Submit each timeline separately, so that a large request can be spread across batches
+            futures: List[Future] = [
+                batcher.submit(TimelineRequest(timeline, is_next_token, embed_strat=embed_strat, top_k=top_k))
+                for timeline in timelines
+            ]
+            try:
+                results: List[Dict[str, Any]] = [ future.result(timeout=request_timeout_s) for future in futures ]
+            except Exception as e:
+                self.send_json(500, { 'error' : str(e) })
+                return
+            if is_next_token:
+                self.send_json(200, { key : [ r[key] for r in results ] for key in [ 'top_k_ids', 'top_k_log_probs', 'top_k_tokens' ] })
+            else:
+                self.send_json(200, { 'embeddings' : [ r['embedding'] for r in results ] })
+
+    return InferenceRequestHandler
+
+def main():
+    args = parse_args()
+    ckpt_handle = CheckpointHandle(args.path_to_ckpt)
+    config = ckpt_handle.config
+    tokenizer = ckpt_handle.tokenizer
+    model_name: str = config['model']['name']
+    if any(x in model_name.lower() for x in SERVER_UNSUPPORTED_MODELS):
+        raise ValueError(f"Model `{model_name}` can't be served")
+
+    # Load model
+    if args.device == 'cpu':
+        from hf_ehr.models.cpu_inference import set_cpu_threads
+        set_cpu_threads(args.n_threads)
+    if args.is_cpu_optimized:
+        assert args.device == 'cpu', f"Error -- `--is_cpu_optimized` requires `--device cpu`, not `{args.device}`"
+        from hf_ehr.models.cpu_inference import load_cpu_model_from_path
+        model = load_cpu_model_from_path(ckpt_handle, is_quantize=True)
+    else:
+        model = load_model_from_path(ckpt_handle, device=args.device)
+    model.eval()
+    logger.info(f"Loaded `{model_name}` from `{args.path_to_ckpt}` onto `{args.device}`")
+
+    # Start server
+    batcher = DynamicBatcher(model, config, tokenizer, args.device, max_tokens=args.max_tokens, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    batcher.start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, args.request_timeout_s))
+    server.daemon_threads = True
+    logger.success(f"Serving on http://{args.host}:{args.port} | max_tokens={args.max_tokens} | max_batch_size={args.max_batch_size} | max_wait_ms={args.max_wait_ms}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+        logger.info(f"Stopped server | stats={batcher.get_stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -77,6 +77,7 @@ from hf_ehr.config import (
     PATH_TO_TOKENIZER_CLMBR_v8_DIR
 )
 from hf_ehr.config import PATH_TO_FEMR_EXTRACT_v8
+from hf_ehr.tokenizers.sketches import KLLSketch
 
 # Path to original CLMBR dictionary
 PATH_TO_CLMBR_JSON: str = os.path.join(PATH_TO_TOKENIZER_CLMBR_v8_DIR, 'clmbr_v8_original_dictionary.json')
@@ -97,7 +98,7 @@ print(f"Loaded n={len(pids)} patients from FEMRDataset using extract at: `{PATH_
 
 # Collect lab values with progress bar (binning)
 n_bins: int = 10
-numericals = collections.defaultdict(list)
+numericals = collections.defaultdict(KLLSketch) # code => quantile sketch of values (constant memory per code)
 for p_idx, pid in enumerate(tqdm(pids, desc="Processing patients")):
     patient = femr_db[pid]  # Retrieve patient by ID from femr_db
     if not hasattr(patient, 'events'):
@@ -105,12 +106,12 @@ for p_idx, pid in enumerate(tqdm(pids, desc="Processing patients")):
     
     for event in patient.events:
         if event.value is not None and (isinstance(event.value, float) or isinstance(event.value, int)):  # Numeric
-            numericals[event.code].append(event.value)
+            numericals[event.code].update(event.value)
 
 # Bin the lab values (using quantiles)
 binned_numericals = {}
-for code, values in tqdm(numericals.items(), desc="Binning lab values"):
-    quantiles = np.percentile(values, np.linspace(0, 100, n_bins + 1))
+for code, sketch in tqdm(numericals.items(), desc="Binning lab values"):
+    quantiles = sketch.quantiles(np.linspace(0, 1, n_bins + 1))
     binned_numericals[code] = quantiles.tolist()  # Convert ndarray to list
 
 # Create the tokenizer config
@@ -6,6 +6,7 @@ import numpy as np
 from tqdm import tqdm
 from hf_ehr.data.datasets import FEMRDataset
 from hf_ehr.config import PATH_TO_FEMR_EXTRACT_v8
+from hf_ehr.tokenizers.sketches import KLLSketch
 import time
 
 # Load the FEMR dataset and PatientDatabase
@@ -19,7 +20,8 @@ pids = dataset.get_pids().tolist()
 print(f"Loaded n={len(pids)} patients from FEMRDataset using extract at: `{PATH_TO_FEMR_EXTRACT_v8}`")
 
 # Collect lab values with progress bar
-numericals = collections.defaultdict(list)
+numericals = collections.defaultdict(KLLSketch) # code => quantile sketch of values (constant memory per code)
+numericals_total_weight = collections.defaultdict(float) # code => sum of weights of values
 
 # Iterate over patient IDs and access the patient events using femr_db
 for p_idx, pid in enumerate(tqdm(pids, desc="Processing patients")):
@@ -37,15 +39,16 @@ for p_idx, pid in enumerate(tqdm(pids, desc="Processing patients")):
             event.value is not None  # `value` is not None
             and (isinstance(event.value, float) or isinstance(event.value, int))  # `value` is numeric
         ):
-            numericals[event.code].append((event.value, weight))
+            numericals[event.code].update(event.value)
+            numericals_total_weight[event.code] += weight
 
 # Bin lab values with progress bar
 n_bins: int = 5
 output_data = []
 
-for n_idx, (code, values) in enumerate(tqdm(numericals.items(), desc="Binning lab values")):
-    quantiles = np.percentile([x[0] for x in values], np.linspace(0, 100, n_bins + 1))
-    total_weight = np.sum([x[1] for x in values])
+for n_idx, (code, sketch) in enumerate(tqdm(numericals.items(), desc="Binning lab values")):
+    quantiles = sketch.quantiles(np.linspace(0, 1, n_bins + 1))
+    total_weight = numericals_total_weight[code]
     weight_per_bucket = total_weight / n_bins
 
     for i in range(n_bins):
@@ -2,18 +2,21 @@ import os
 import argparse
 import time
 from typing import Any, Callable, Dict, List
-from utils import add_numerical_range_codes, add_unique_codes, add_occurrence_count_to_codes, remove_codes_belonging_to_vocabs, add_categorical_codes
+from utils import add_numerical_range_codes, add_unique_codes, add_occurrence_count_to_codes, remove_codes_belonging_to_vocabs, add_categorical_codes, add_patient_count_to_codes, build_vocab_single_pass
 from hf_ehr.data.datasets import FEMRDataset
 from hf_ehr.config import PATH_TO_FEMR_EXTRACT_v8, PATH_TO_FEMR_EXTRACT_v9, PATH_TO_FEMR_EXTRACT_MIMIC4, PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG, load_tokenizer_config_and_metadata_from_path, PATH_TO_TOKENIZER_COOKBOOK_DEBUG_v8_CONFIG
 from hf_ehr.tokenizers.utils import call_func_with_logging
+from hf_ehr.tokenizers.sketches import DEFAULT_KLL_K, get_kll_k_for_error
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser('Generate statistics about dataset')
     parser.add_argument('--dataset', choices=['v8', 'v9', 'mimic4', ], default='v8', help='FEMR dataset version to use: v8 or v9')
     parser.add_argument('--n_procs', type=int, default=5, help='Number of processes to use')
-    parser.add_argument('--chunk_size', type=int, default=None, help='Number of pids per process')
+    parser.add_argument('--chunk_size', type=int, default=None, help='Average # of pids per chunk (chunks are capped at 2x this)')
     parser.add_argument('--is_force_refresh', action='store_true', default=False, help='If specified, will force refresh the tokenizer config')
     parser.add_argument('--is_debug', action='store_true', default=False, help='If specified, only do 1000 patients')
+    parser.add_argument('--numerical_sketch_error', type=float, default=None, help=f'Max rank error of the quantile sketches used to bin numerical values (default: k={DEFAULT_KLL_K}, i.e. ~{1.65 / DEFAULT_KLL_K:.2%})')
+    parser.add_argument('--is_single_pass', action='store_true', default=False, help='If specified, build the whole vocab (codes, categoricals, numerical ranges, counts) in one pass over the dataset')
     return parser.parse_args()
 
 def check_add_unique_codes(tokenizer_config):
@@ -41,6 +44,11 @@ def check_add_occurrence_count_to_codes(tokenizer_config):
     codes_with_counts = [entry for entry in tokenizer_config if any(stat.type == 'count_occurrences' for stat in getattr(entry, 'stats', []))]
     assert len(codes_with_counts) > 0, "No occurrence counts were added."
     print(f"Check passed: Occurrence counts added to {len(codes_with_counts)} codes.")
+
+def check_add_patient_count_to_codes(tokenizer_config):
+    codes_with_counts = [entry for entry in tokenizer_config if any(stat.type == 'count_patients' for stat in getattr(entry, 'stats', []))]
+    assert len(codes_with_counts) > 0, "No patient counts were added."
+    print(f"Check passed: Patient counts added to {len(codes_with_counts)} codes.")
     
 def main():
     start_total = time.time()
@@ -88,10 +96,27 @@ def main():
         print(f"Running in debug mode with only 10000 patients")
 
     # Hparams
-    chunk_size: int = args.chunk_size if args.chunk_size else len(pids) // args.n_procs
+    # NOTE: Smaller chunks => less to recompute when patients are added (each chunk's stats are cached, see `split_pids_into_chunks()`)
+    # Chunks are capped at 2x `chunk_size`, so by default they have at most 10k pids and every proc gets >= 1 chunk
+    chunk_size: int = args.chunk_size if args.chunk_size else max(1, min(5_000, len(pids) // (2 * args.n_procs)))
     excluded_vocabs = ['STANFORD_OBS']
+    sketch_k: int = get_kll_k_for_error(args.numerical_sketch_error) if args.numerical_sketch_error else DEFAULT_KLL_K
     print(f"Running with n_procs={args.n_procs}, chunk_size={chunk_size}")
 
+    if args.is_single_pass:
+        # Fuses all of the steps below into one scan over the dataset (+ a cheap scan over numeric values for exact `numerical_range` counts)
+        call_func_with_logging(build_vocab_single_pass, 'build_vocab_single_pass', PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG, path_to_femr_extract, pids=pids, N=10, sketch_k=sketch_k, excluded_vocabs=excluded_vocabs, dataset=args.dataset, split='train', n_procs=args.n_procs, chunk_size=chunk_size)
+        tokenizer_config, _ = load_tokenizer_config_and_metadata_from_path(PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG)
+        check_add_unique_codes(tokenizer_config)
+        check_add_categorical_codes(tokenizer_config)
+        check_add_numerical_range_codes(tokenizer_config)
+        check_remove_codes_belonging_to_vocabs(tokenizer_config, excluded_vocabs)
+        check_add_occurrence_count_to_codes(tokenizer_config)
+        check_add_patient_count_to_codes(tokenizer_config)
+        print(f"Total time taken: {round(time.time() - start_total, 2)}s")
+        print("Done!")
+        return
+
     # With `n_procs=5`, should take ~25 mins
     call_func_with_logging(add_unique_codes, 'add_unique_codes', PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG, path_to_femr_extract, pids=pids, n_procs=args.n_procs, chunk_size=chunk_size)
     tokenizer_config, _ = load_tokenizer_config_and_metadata_from_path(PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG)
@@ -103,7 +128,7 @@ def main():
     check_add_categorical_codes(tokenizer_config)
     
     # With `n_procs=5`, should take ~XXXX mins
-    call_func_with_logging(add_numerical_range_codes, 'add_numerical_range_codes', PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG, path_to_femr_db=path_to_femr_extract, pids=pids, N=10)
+    call_func_with_logging(add_numerical_range_codes, 'add_numerical_range_codes', PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG, path_to_femr_db=path_to_femr_extract, pids=pids, N=10, sketch_k=sketch_k)
     tokenizer_config, _ = load_tokenizer_config_and_metadata_from_path(PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG)
     check_add_numerical_range_codes(tokenizer_config)
     
@@ -117,6 +142,11 @@ def main():
     tokenizer_config, _ = load_tokenizer_config_and_metadata_from_path(PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG)
     check_add_occurrence_count_to_codes(tokenizer_config)
     
+    # With `n_procs=5`, should take about as long as `add_occurrence_count_to_codes`
+    call_func_with_logging(add_patient_count_to_codes, 'add_patient_count_to_codes', PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG, path_to_femr_extract, pids=pids, dataset=args.dataset, split='train', n_procs=args.n_procs, chunk_size=chunk_size)
+    tokenizer_config, _ = load_tokenizer_config_and_metadata_from_path(PATH_TO_TOKENIZER_COOKBOOK_v8_CONFIG)
+    check_add_patient_count_to_codes(tokenizer_config)
+    
     print(f"Total time taken: {round(time.time() - start_total, 2)}s")
     print("Done!")
 
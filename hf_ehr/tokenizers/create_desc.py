@@ -2,7 +2,7 @@ import os
 import argparse
 import time
 from typing import List
-from hf_ehr.scripts.create_vocab.utils import add_unique_codes, add_description_to_codes
+from hf_ehr.tokenizers.utils import add_unique_codes, add_description_to_codes
 from hf_ehr.data.datasets import FEMRDataset
 from hf_ehr.config import PATH_TO_FEMR_EXTRACT_v8, PATH_TO_FEMR_EXTRACT_v9, PATH_TO_TOKENIZER_DESC_v8_CONFIG
 from hf_ehr.tokenizers.utils import call_func_with_logging
@@ -0,0 +1,181 @@
+"""
+Derive a top-K vocabulary from one base tokenizer config, without rebuilding it from the dataset.
+
+Tokens are ranked by a stat stored in the base config (e.g. `count_occurrences`), and the top `k` are kept
+(in their original order). Pretokenized timelines (e.g. from `eval/ehrshot.py`) can then be remapped from the
+base vocab to the pruned vocab with a single lookup-table pass, without re-reading any patient data.
+
+Usage:
+    # Create an 8k vocab from the full CLMBR vocab
+    python3 prune_vocab.py --path_to_base_config /path/to/clmbr_v8/tokenizer_config.json --k 8000 --stat order --path_to_output_dir /path/to/clmbr_v8_8k/
+
+    # ...and remap EHRSHOT's pretokenized timelines to it
+    python3 prune_vocab.py --path_to_base_config /path/to/clmbr_v8/tokenizer_config.json --k 8000 --stat order --path_to_output_dir /path/to/clmbr_v8_8k/ \\
+        --tokenizer CLMBRTokenizer --path_to_tokenized_timelines_dir /path/to/timelines/ --path_to_output_tokenized_timelines_dir /path/to/timelines_8k/
+"""
+import os
+import argparse
+import datetime
+import glob
+import json
+import time
+import numpy as np
+from tqdm import tqdm
+from typing import Any, Dict, List, Optional
+from hf_ehr.config import TokenizerConfigEntry, load_tokenizer_config_and_metadata_from_path, save_tokenizer_config_to_path
+
+STATS = [ 'order', 'count_occurrences', 'count_patients', 'ppl' ]
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser('Prune a tokenizer config to its top-K tokens')
+    parser.add_argument('--path_to_base_config', type=str, required=True, help='Path to the base `tokenizer_config.json` to prune')
+    parser.add_argument('--k', type=int, required=True, help='Number of (non-special) tokens to keep')
+    parser.add_argument('--stat', type=str, choices=STATS, default='count_occurrences', help="Stat to rank tokens by. `order` keeps the first `k` tokens of the base config (i.e. same as `create_clmbr_k.py`)")
+    parser.add_argument('--is_ascending', action='store_true', default=False, help='If specified, keep the tokens with the LOWEST values of `stat` (e.g. lowest `ppl`)')
+    parser.add_argument('--path_to_output_dir', type=str, required=True, help='Folder to write the pruned `tokenizer_config.json` to')
+    parser.add_argument('--tokenizer', type=str, choices=[ 'CookbookTokenizer', 'CLMBRTokenizer', 'CEHRTokenizer' ], default='CookbookTokenizer', help='Tokenizer class (needed to map token IDs when remapping pretokenized timelines)')
+    parser.add_argument('--path_to_tokenized_timelines_dir', type=str, default=None, help='If specified, remap every .npy/.npz of tokenized timelines in this folder from the base vocab to the pruned vocab')
+    parser.add_argument('--path_to_output_tokenized_timelines_dir', type=str, default=None, help='Where to write the remapped tokenized timelines')
+    parser.add_argument('--pad_token_id', type=int, default=None, help='PAD token ID of the base tokenizer (default: read from tokenizer)')
+    return parser.parse_args()
+
+def get_stat_values(tokenizer_config: List[TokenizerConfigEntry], stat: str) -> np.ndarray:
+    """Value of `stat` for every entry (NaN if the entry doesn't have it)."""
+    if stat == 'order':
+        # Earlier in config => higher rank
+        return -np.arange(len(tokenizer_config), dtype=np.float64)
+    values: np.ndarray = np.full(len(tokenizer_config), np.nan, dtype=np.float64)
+    for idx, entry in enumerate(tokenizer_config):
+        for s in entry.stats:
+            if s.type != stat:
+                continue
+            value = s.ppl if stat == 'ppl' else s.count
+            if value is not None:
+                # If multiple stats of the same type (e.g. from different splits), use the first
+                values[idx] = float(value)
+                break
+    return values
+
+def get_top_k_mask(values: np.ndarray, k: int, is_ascending: bool = False) -> np.ndarray:
+    """Boolean mask of the `k` entries with the highest (or lowest, if `is_ascending`) `values`. NaNs are ranked last; ties are broken by original order."""
+    scores: np.ndarray = values if is_ascending else -values
+    scores = np.where(np.isnan(scores), np.inf, scores)
+    keep: np.ndarray = np.zeros(len(values), dtype=bool)
+    keep[np.argsort(scores, kind='stable')[:k]] = True
+    return keep
+
+def prune_tokenizer_config(tokenizer_config: List[TokenizerConfigEntry], k: int, stat: str = 'count_occurrences', is_ascending: bool = False) -> List[TokenizerConfigEntry]:
+    """Keep the top `k` entries of `tokenizer_config` ranked by `stat`, in their original order."""
+    assert stat in STATS, f"Error -- stat={stat} must be one of {STATS}"
+    values: np.ndarray = get_stat_values(tokenizer_config, stat)
+    if stat != 'order' and np.isnan(values).sum() > 0:
+        print(f"WARNING - {np.isnan(values).sum()} / {len(values)} entries have no `{stat}` stat, so will be ranked last")
+    keep: np.ndarray = get_top_k_mask(values, k, is_ascending=is_ascending)
+    return [ entry for entry, is_keep in zip(tokenizer_config, keep) if is_keep ]
+
+################################################
+# Remapping between vocabs
+################################################
+def get_token_id_remap(old_vocab: Dict[str, int], new_vocab: Dict[str, int]) -> np.ndarray:
+    """Array mapping each token ID in `old_vocab` => its token ID in `new_vocab` (-1 if the token was pruned)."""
+    remap: np.ndarray = np.full(max(old_vocab.values()) + 1, -1, dtype=np.int64)
+    for token, old_idx in old_vocab.items():
+        if token in new_vocab:
+            remap[old_idx] = new_vocab[token]
+    return remap
+
+def remap_tokenized_timelines(tokenized_timelines: np.ndarray, remap: np.ndarray, old_pad_token_id: int, new_pad_token_id: int) -> np.ndarray:
+    """
+        Remap a left-padded array of token IDs of shape (N, L) from the old => new vocab. Pruned tokens are dropped,
+        and each row is re-left-padded so the remaining tokens stay right-aligned (and in order).
+
+        NOTE: If a timeline was truncated to L tokens under the old vocab, then under the new vocab it would have
+        room for some earlier tokens that weren't stored, so remapped rows may be shorter than re-tokenizing from scratch.
+    """
+    new_ids: np.ndarray = remap[tokenized_timelines]
+    is_keep: np.ndarray = (tokenized_timelines != old_pad_token_id) & (new_ids >= 0)
+    # Stable sort on `is_keep` moves dropped tokens to the front of each row, w/o reordering kept tokens
+    order: np.ndarray = np.argsort(is_keep, axis=1, kind='stable')
+    new_ids = np.take_along_axis(new_ids, order, axis=1)
+    is_keep = np.take_along_axis(is_keep, order, axis=1)
+    return np.where(is_keep, new_ids, new_pad_token_id).astype(tokenized_timelines.dtype)
+
+def remap_tokenized_timelines_dir(path_to_input_dir: str, path_to_output_dir: str, remap: np.ndarray, old_pad_token_id: int, new_pad_token_id: int):
+    """Remap every .npy/.npz file of tokenized timelines in `path_to_input_dir` (e.g. from `eval/ehrshot.py`), and copy over any metadata."""
+    from hf_ehr.eval.ehrshot import load_tokenized_timelines
+    os.makedirs(path_to_output_dir, exist_ok=True)
+    for path_to_file in tqdm(sorted(glob.glob(os.path.join(path_to_input_dir, '*'))), desc='Remapping tokenized timelines'):
+        filename: str = os.path.basename(path_to_file)
+        if path_to_file.endswith('.npy') or path_to_file.endswith('.npz'):
+            tokenized_timelines: np.ndarray = remap_tokenized_timelines(np.asarray(load_tokenized_timelines(path_to_file)), remap, old_pad_token_id, new_pad_token_id)
+            if path_to_file.endswith('.npy'):
+                np.save(os.path.join(path_to_output_dir, filename), tokenized_timelines)
+            else:
+                # Keep any other arrays (e.g. `start_idx`, `end_idx`) as is
+                data: Dict[str, np.ndarray] = dict(np.load(path_to_file))
+                data['tokenized_timelines'] = tokenized_timelines
+                np.savez_compressed(os.path.join(path_to_output_dir, filename), **data)
+        elif filename.endswith('.json'):
+            # Batch metadata points at files in the input dir, so rewrite paths to point at the output dir
+            metadata = json.load(open(path_to_file, 'r'))
+            json.dump(rewrite_paths(metadata, path_to_input_dir, path_to_output_dir), open(os.path.join(path_to_output_dir, filename), 'w'), indent=2)
+
+def rewrite_paths(obj: Any, path_to_input_dir: str, path_to_output_dir: str) -> Any:
+    """Recursively replace any path to a file in `path_to_input_dir` with the same file in `path_to_output_dir`."""
+    if isinstance(obj, dict):
+        return { key: rewrite_paths(val, path_to_input_dir, path_to_output_dir) for key, val in obj.items() }
+    elif isinstance(obj, list):
+        return [ rewrite_paths(val, path_to_input_dir, path_to_output_dir) for val in obj ]
+    elif isinstance(obj, str) and os.path.dirname(os.path.abspath(obj)) == os.path.abspath(path_to_input_dir):
+        return os.path.join(path_to_output_dir, os.path.basename(obj))
+    return obj
+
+def load_code_tokenizer(name: str, path_to_tokenizer_config: str, metadata: Optional[Dict[str, Any]] = None):
+    from hf_ehr.data.tokenization import CookbookTokenizer, CLMBRTokenizer, CEHRTokenizer
+    if name == 'CLMBRTokenizer':
+        return CLMBRTokenizer(path_to_tokenizer_config)
+    elif name == 'CookbookTokenizer':
+        return CookbookTokenizer(path_to_tokenizer_config, metadata=metadata or {})
+    elif name == 'CEHRTokenizer':
+        return CEHRTokenizer(path_to_tokenizer_config, metadata=metadata or {})
+    raise ValueError(f"Tokenizer `{name}` not supported.")
+
+def main():
+    start_total = time.time()
+    args = parse_args()
+
+    # Prune
+    tokenizer_config, metadata = load_tokenizer_config_and_metadata_from_path(args.path_to_base_config)
+    pruned_config: List[TokenizerConfigEntry] = prune_tokenizer_config(tokenizer_config, args.k, stat=args.stat, is_ascending=args.is_ascending)
+    print(f"Pruned vocab from {len(tokenizer_config)} => {len(pruned_config)} tokens using stat=`{args.stat}`")
+
+    # Save
+    os.makedirs(args.path_to_output_dir, exist_ok=True)
+    path_to_output_config: str = os.path.join(args.path_to_output_dir, 'tokenizer_config.json')
+    metadata = dict(metadata)
+    metadata['pruned_from'] = {
+        'path_to_base_config' : os.path.abspath(args.path_to_base_config),
+        'k' : args.k,
+        'stat' : args.stat,
+        'is_ascending' : args.is_ascending,
+        'timestamp' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    save_tokenizer_config_to_path(path_to_output_config, pruned_config, metadata)
+    print(f"Saved pruned tokenizer config to: `{path_to_output_config}`")
+
+    # Remap pretokenized timelines
+    if args.path_to_tokenized_timelines_dir is not None:
+        assert args.path_to_output_tokenized_timelines_dir is not None, "Error -- Must specify `--path_to_output_tokenized_timelines_dir`"
+        tokenizer_metadata: Dict[str, Any] = { key: val for key, val in metadata.items() if key not in [ 'is_already_run', 'pruned_from' ] }
+        old_tokenizer = load_code_tokenizer(args.tokenizer, args.path_to_base_config, tokenizer_metadata)
+        new_tokenizer = load_code_tokenizer(args.tokenizer, path_to_output_config, tokenizer_metadata)
+        remap: np.ndarray = get_token_id_remap(old_tokenizer.get_vocab(), new_tokenizer.get_vocab())
+        old_pad_token_id: int = args.pad_token_id if args.pad_token_id is not None else old_tokenizer.pad_token_id
+        remap_tokenized_timelines_dir(args.path_to_tokenized_timelines_dir, args.path_to_output_tokenized_timelines_dir, remap, old_pad_token_id, new_tokenizer.pad_token_id)
+        print(f"Remapped tokenized timelines to: `{args.path_to_output_tokenized_timelines_dir}`")
+
+    print(f"Total time taken: {round(time.time() - start_total, 2)}s")
+    print("Done!")
+
+if __name__ == '__main__':
+    main()
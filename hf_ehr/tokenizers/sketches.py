@@ -0,0 +1,140 @@
+"""
+Mergeable streaming quantile sketches, used to bin numerical lab values into `numerical_range` tokens
+without keeping every observed value in memory.
+
+Usage:
+    sketch = KLLSketch(k=200)
+    for value in values:
+        sketch.update(value)
+    sketch.merge(other_sketch) # e.g. from another worker
+    quantiles = sketch.quantiles(np.linspace(0, 1, N + 1))
+"""
+import math
+import numpy as np
+from typing import Iterable, List, Optional, Union
+
+# Rank error of a KLL sketch is ~1.65 / k (i.e. k=200 => ~0.8% error in rank)
+DEFAULT_KLL_K: int = 200
+
+def get_kll_k_for_error(error: float) -> int:
+    """Smallest `k` for which a KLL sketch has (approximately) at most `error` normalized rank error."""
+    assert 0 < error < 1, f"Error -- error={error} must be in (0, 1)"
+    return max(8, math.ceil(1.65 / error))
+
+class KLLSketch():
+    """
+        KLL quantile sketch (Karnin, Lang, Liberty 2016).
+
+        Keeps a stack of "compactors", where every item at level `h` stands for 2^h original values.
+        When a level is full, it is sorted and every other item (random offset) is promoted to the next level.
+        Memory is O(k) regardless of the number of values seen, and two sketches (with the same `k`) can be merged cheaply.
+
+        NOTE: Until the first compaction (i.e. for the first ~k values), the sketch is exact and `quantiles()`
+        returns the same results as `np.percentile()` over all values.
+    """
+
+    def __init__(self, k: int = DEFAULT_KLL_K, c: float = 2 / 3, seed: Optional[int] = 0):
+        assert k >= 8, f"Error -- k={k} must be >= 8"
+        self.k: int = k
+        self.c: float = c
+        self.rng: np.random.Generator = np.random.default_rng(seed)
+        self.levels: List[List[float]] = [ [] ]
+        self.n: int = 0 # total # of values seen
+        self.min: float = math.inf
+        self.max: float = -math.inf
+        self.is_exact: bool = True # True until the first compaction
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __repr__(self) -> str:
+        return f"KLLSketch(k={self.k}, n={self.n}, n_retained={self.get_n_retained()}, is_exact={self.is_exact})"
+
+    def get_n_retained(self) -> int:
+        return sum(len(level) for level in self.levels)
+
+    def get_capacity(self, h: int) -> int:
+        """Capacity of level `h` -- top level holds `k` items, each level below holds a factor of `c` less."""
+        depth: int = len(self.levels) - h - 1
+        return max(2, int(math.ceil(self.k * (self.c ** depth))))
+
+    def update(self, value: float):
+        value = float(value)
+        self.levels[0].append(value)
+        self.n += 1
+        if value < self.min: self.min = value
+        if value > self.max: self.max = value
+        if len(self.levels[0]) >= self.get_capacity(0):
+            self.compress()
+
+    def update_many(self, values: Union[Iterable[float], np.ndarray]):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.shape[0] == 0:
+            return
+        self.levels[0].extend(values.tolist())
+        self.n += values.shape[0]
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.compress()
+
+    def compress(self):
+        """Compact every level that is over capacity (bottom-up), adding a new top level if needed."""
+        h: int = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) >= self.get_capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append([])
+                items: List[float] = sorted(self.levels[h])
+                # If odd # of items, then keep one behind at this level
+                leftover: List[float] = [ items.pop() ] if len(items) % 2 == 1 else []
+                offset: int = int(self.rng.integers(0, 2))
+                self.levels[h + 1].extend(items[offset::2])
+                self.levels[h] = leftover
+                self.is_exact = False
+            h += 1
+
+    def merge(self, other: 'KLLSketch') -> 'KLLSketch':
+        """Merge `other` into this sketch (in place). Returns `self`."""
+        assert self.k == other.k, f"Error -- Can't merge KLL sketches with different k ({self.k} != {other.k})"
+        if other.n == 0:
+            return self
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for h, level in enumerate(other.levels):
+            self.levels[h].extend(level)
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.is_exact = self.is_exact and other.is_exact
+        self.compress()
+        return self
+
+    def get_weighted_items(self):
+        """Returns (sorted items, weight of each item)."""
+        items: np.ndarray = np.concatenate([ np.asarray(level, dtype=np.float64) for level in self.levels ])
+        weights: np.ndarray = np.concatenate([ np.full(len(level), 2 ** h, dtype=np.float64) for h, level in enumerate(self.levels) ])
+        order: np.ndarray = np.argsort(items, kind='stable')
+        return items[order], weights[order]
+
+    def quantiles(self, qs: Union[Iterable[float], np.ndarray]) -> np.ndarray:
+        """Approximate quantiles at `qs` (each in [0, 1]). Exact (same as `np.percentile`) if `self.is_exact`."""
+        qs = np.asarray(qs, dtype=np.float64)
+        assert self.n > 0, "Error -- Can't calculate quantiles of an empty sketch"
+        if self.is_exact:
+            return np.percentile(self.levels[0], qs * 100)
+        items, weights = self.get_weighted_items()
+        # Place each item at the midpoint of the rank interval it stands for, then linearly interpolate
+        cdf: np.ndarray = (np.cumsum(weights) - weights / 2) / self.n
+        results: np.ndarray = np.interp(qs, cdf, items)
+        results[qs <= 0] = self.min
+        results[qs >= 1] = self.max
+        return results
+
+    def count_less_equal(self, values: Union[Iterable[float], np.ndarray]) -> np.ndarray:
+        """Approximate # of values seen that are <= each of `values`. Exact if `self.is_exact`."""
+        values = np.asarray(values, dtype=np.float64)
+        if self.n == 0:
+            return np.zeros(values.shape, dtype=np.int64)
+        items, weights = self.get_weighted_items()
+        cum_weights: np.ndarray = np.concatenate([ [0], np.cumsum(weights) ])
+        return cum_weights[np.searchsorted(items, values, side='right')].astype(np.int64)
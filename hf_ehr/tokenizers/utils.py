@@ -1,9 +1,15 @@
 import os
 import collections
 import datetime
+import hashlib
+import json
 import multiprocessing
 import pickle
+import shutil
+import re
+import tempfile
 import time
+import uuid
 import numpy as np
 from tqdm import tqdm
 from typing import Callable, List, Dict, Optional, Set, Tuple, Any
@@ -12,12 +18,14 @@ from hf_ehr.config import (
     CodeTCE, 
     CategoricalTCE,
     CountOccurrencesTCEStat, 
+    CountPatientsTCEStat,
     NumericalRangeTCE,
     TokenizerConfigEntry, 
     load_tokenizer_config_and_metadata_from_path,
     save_tokenizer_config_to_path
 )
 from hf_ehr.data.tokenization import CookbookTokenizer
+from hf_ehr.tokenizers.sketches import KLLSketch, DEFAULT_KLL_K
 import time
 
 PATH_TO_CACHE_DIR: str = '/share/pi/nigam/mwornow/hf_ehr/cache/create_cookbook/'
@@ -40,6 +48,184 @@ def save_results_to_cache(results: Any, path_to_cache_dir: Optional[str], filena
     print(f"Saving results of length={len(results)} to cached file at: `{path_to_cache_file}`")
     pickle.dump(results, open(path_to_cache_file, 'wb'))
 
+def get_path_to_npy(path_to_cache_dir: Optional[str], filename: str) -> str:
+    """Path to .npy file for array results -- doubles as the cache file (if cache dir is provided), otherwise is a temp file."""
+    if path_to_cache_dir is None:
+        return os.path.join(tempfile.gettempdir(), f"hf_ehr_{os.getpid()}_{filename}.npy")
+    return os.path.join(path_to_cache_dir, filename + ".npy")
+
+################################################
+# Incremental (per-chunk) caching
+################################################
+# Every `calc_*` function caches its result for each chunk of pids under a signature that covers exactly what the result
+# depends on: the pids in the chunk, the FEMR extract version, and any additional args (e.g. sketch size, tokenizer vocab).
+# Chunks are content-defined (see `split_pids_into_chunks()`), so when patients are added to / removed from the dataset,
+# only the chunks containing those patients get recomputed -- all other chunks are reused, and then everything is re-merged.
+# Chunks cached for an older extract are reused for a newer one via the manifest (see `reuse_cached_chunks_across_extracts()`).
+PATH_TO_CHUNK_MANIFEST: str = 'manifest.json'
+
+def get_extract_version(path_to_femr_db: str) -> str:
+    """FEMR extracts are versioned by their folder name (e.g. `..._extract_v8`)."""
+    return os.path.basename(os.path.normpath(path_to_femr_db))
+
+def get_chunk_signature(args: Tuple) -> str:
+    """Cache key for one task of a `calc_*` function, i.e. `args` = (path_to_cache_dir, path_to_femr_db, pids, *additional_args)."""
+    path_to_femr_db: str = args[1]
+    pids: List[int] = args[2]
+    pids_hash: str = hashlib.sha256(np.asarray(pids, dtype=np.int64).tobytes()).hexdigest()[:12]
+    signature: str = f"start={pids[0]}_end={pids[-1]}_len={len(pids)}_pids={pids_hash}_extract={get_extract_version(path_to_femr_db)}"
+    if len(args) > 3:
+        signature += f"_args={hashlib.sha256(repr(args[3:]).encode('utf-8')).hexdigest()[:12]}"
+    return signature
+
+def get_chunk_content_key(signature: str) -> str:
+    """`signature` w/o its extract version, i.e. only the pids + additional args -- identical across FEMR extracts for an unchanged chunk."""
+    return re.sub(r"_extract=.*?(?=_args=|$)", "", signature)
+
+def get_tokenizer_vocab_signature(path_to_tokenizer_config: str) -> str:
+    """Hash of the tokenizer's vocab, for `calc_*` functions whose results are indexed by token ID."""
+    vocab: List[str] = sorted(get_cookbook_tokenizer(path_to_tokenizer_config).get_vocab().items(), key=lambda x: x[1])
+    return hashlib.sha256('\n'.join([ token for token, __ in vocab ]).encode('utf-8')).hexdigest()[:12]
+
+def is_chunk_cached(path_to_cache_dir: Optional[str], signature: str) -> bool:
+    if path_to_cache_dir is None:
+        return False
+    return any(os.path.exists(os.path.join(path_to_cache_dir, signature + ext)) for ext in [ '.pkl', '.npy' ])
+
+def split_pids_into_chunks(pids: List[int], chunk_size: int) -> List[List[int]]:
+    """
+        Content-defined chunking: sort `pids`, then end a chunk after every pid whose hash is 0 mod `chunk_size`.
+        Chunks average at most `chunk_size` pids, and (unlike fixed-size chunks) adding/removing a pid only changes the chunk it falls in.
+
+        NOTE: Chunks are capped at 2x `chunk_size` pids. Any longer run between hash boundaries is split every 2x `chunk_size`
+        pids (counted from the start of the run), so adding/removing a pid still only changes chunks within that run.
+    """
+    pids: np.ndarray = np.sort(np.asarray(pids, dtype=np.int64))
+    if len(pids) == 0:
+        return []
+    chunk_size = max(1, chunk_size)
+    max_chunk_size: int = 2 * chunk_size
+    # Fibonacci hashing (uint64 multiplication wraps around)
+    hashes: np.ndarray = (pids.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+    boundaries: np.ndarray = np.flatnonzero(hashes % np.uint64(chunk_size) == 0) + 1
+    # Force boundaries inside runs that are longer than `max_chunk_size`
+    starts: np.ndarray = np.concatenate([ [ 0 ], boundaries ])
+    ends: np.ndarray = np.concatenate([ boundaries, [ len(pids) ] ])
+    forced_boundaries: List[np.ndarray] = [ np.arange(start + max_chunk_size, end, max_chunk_size) for start, end in zip(starts, ends) if end - start > max_chunk_size ]
+    boundaries = np.sort(np.concatenate([ boundaries ] + forced_boundaries)).astype(np.int64)
+    return [ chunk.tolist() for chunk in np.split(pids, boundaries) if len(chunk) > 0 ]
+
+def load_chunk_manifest(path_to_cache_dir: str) -> Dict[str, Dict[str, Any]]:
+    path_to_manifest: str = os.path.join(path_to_cache_dir, PATH_TO_CHUNK_MANIFEST)
+    if not os.path.exists(path_to_manifest):
+        return {}
+    with open(path_to_manifest, 'r') as f:
+        return json.load(f)
+
+def save_chunk_manifest(path_to_cache_dir: str, manifest: Dict[str, Dict[str, Any]]):
+    """Atomically write `manifest` (so an interrupted run never leaves a partially written cache index)."""
+    path_to_tmp: str = os.path.join(path_to_cache_dir, f"{PATH_TO_CHUNK_MANIFEST}.{os.getpid()}.tmp")
+    with open(path_to_tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path_to_tmp, os.path.join(path_to_cache_dir, PATH_TO_CHUNK_MANIFEST))
+
+def update_chunk_manifest(path_to_cache_dir: Optional[str], tasks: List[Tuple]):
+    """Record the pid range + extract version of each chunk's cached result, so chunks can be found (and invalidated) later."""
+    if path_to_cache_dir is None:
+        return
+    manifest: Dict[str, Dict[str, Any]] = load_chunk_manifest(path_to_cache_dir)
+    for task in tasks:
+        signature: str = get_chunk_signature(task)
+        if signature not in manifest:
+            manifest[signature] = {
+                'pid_start' : int(task[2][0]),
+                'pid_end' : int(task[2][-1]),
+                'n_pids' : len(task[2]),
+                'extract_version' : get_extract_version(task[1]),
+                'timestamp' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+    save_chunk_manifest(path_to_cache_dir, manifest)
+
+def invalidate_cached_chunks(path_to_cache_dir: str, pids: List[int], extract_version: Optional[str] = None) -> int:
+    """
+        Delete the cached result of every chunk whose pid range contains any of `pids` (e.g. patients whose data changed),
+        so it gets recomputed on the next run. Optionally limited to chunks from `extract_version`. Returns # of chunks deleted.
+    """
+    pids: np.ndarray = np.sort(np.asarray(pids, dtype=np.int64))
+    manifest: Dict[str, Dict[str, Any]] = load_chunk_manifest(path_to_cache_dir)
+    n_invalidated: int = 0
+    for signature, chunk in list(manifest.items()):
+        if extract_version is not None and chunk['extract_version'] != extract_version:
+            continue
+        # Any pid in [pid_start, pid_end]?
+        if np.searchsorted(pids, chunk['pid_end'], side='right') > np.searchsorted(pids, chunk['pid_start'], side='left'):
+            for ext in [ '.pkl', '.npy' ]:
+                if os.path.exists(os.path.join(path_to_cache_dir, signature + ext)):
+                    os.remove(os.path.join(path_to_cache_dir, signature + ext))
+            manifest.pop(signature)
+            n_invalidated += 1
+    save_chunk_manifest(path_to_cache_dir, manifest)
+    return n_invalidated
+
+def reuse_cached_chunks_across_extracts(path_to_cache_dir: Optional[str], tasks: List[Tuple]) -> int:
+    """
+        For every task w/o a cached result, reuse the cached result of an identical chunk (same pids + additional args) 
+        from another FEMR extract version in the manifest, so moving to a newer extract only recomputes new/changed chunks.
+        Returns # of chunks reused.
+
+        NOTE: Assumes a patient's data is unchanged across extracts -- call `invalidate_cached_chunks()` on patients whose data changed.
+    """
+    if path_to_cache_dir is None:
+        return 0
+    content_key_2_signature: Dict[str, str] = {}
+    for signature in load_chunk_manifest(path_to_cache_dir):
+        if is_chunk_cached(path_to_cache_dir, signature):
+            content_key_2_signature.setdefault(get_chunk_content_key(signature), signature)
+    n_reused: int = 0
+    for task in tasks:
+        signature: str = get_chunk_signature(task)
+        source_signature: Optional[str] = content_key_2_signature.get(get_chunk_content_key(signature))
+        if source_signature is None or is_chunk_cached(path_to_cache_dir, signature):
+            continue
+        for ext in [ '.pkl', '.npy' ]:
+            path_to_source: str = os.path.join(path_to_cache_dir, source_signature + ext)
+            if not os.path.exists(path_to_source):
+                continue
+            # Hard link (or copy) under this extract's signature, then atomically move into place
+            path_to_tmp: str = os.path.join(path_to_cache_dir, f"{signature}{ext}.{os.getpid()}.tmp")
+            try:
+                os.link(path_to_source, path_to_tmp)
+            except OSError:
+                shutil.copyfile(path_to_source, path_to_tmp)
+            os.replace(path_to_tmp, os.path.join(path_to_cache_dir, signature + ext))
+        n_reused += 1
+    return n_reused
+
+################################################
+# Worker-local state
+################################################
+# Set once per worker process (see `init_worker()`), so tasks don't reopen the FEMR extract / reload the tokenizer for every chunk
+_WORKER_FEMR_DBS: Dict[str, Any] = {}
+_WORKER_TOKENIZERS: Dict[Tuple[str, float], CookbookTokenizer] = {}
+
+def init_worker(path_to_femr_db: str):
+    """`multiprocessing.Pool` initializer -- opens the FEMR extract once per worker."""
+    get_femr_db(path_to_femr_db)
+
+def get_femr_db(path_to_femr_db: str):
+    if path_to_femr_db not in _WORKER_FEMR_DBS:
+        _WORKER_FEMR_DBS[path_to_femr_db] = femr.datasets.PatientDatabase(path_to_femr_db)
+    return _WORKER_FEMR_DBS[path_to_femr_db]
+
+def get_cookbook_tokenizer(path_to_tokenizer_config: str) -> CookbookTokenizer:
+    # NOTE: Keyed on mtime b/c the tokenizer config gets rewritten between steps (and `n_procs=1` runs in the parent process)
+    key: Tuple[str, float] = (path_to_tokenizer_config, os.path.getmtime(path_to_tokenizer_config))
+    if key not in _WORKER_TOKENIZERS:
+        _WORKER_TOKENIZERS.clear()
+        __, metadata = load_tokenizer_config_and_metadata_from_path(path_to_tokenizer_config)
+        _WORKER_TOKENIZERS[key] = CookbookTokenizer(path_to_tokenizer_config, metadata=metadata)
+    return _WORKER_TOKENIZERS[key]
+
 ################################################
 # Get all categorical codes in dataset
 ################################################
@@ -48,10 +234,10 @@ def calc_categorical_codes(args: Tuple) -> Set[Tuple[str, List[str]]]:
     path_to_cache_dir: Optional[str] = args[0]
     path_to_femr_db: str = args[1]
     pids: List[int] = args[2]
-    femr_db = femr.datasets.PatientDatabase(path_to_femr_db)
+    femr_db = get_femr_db(path_to_femr_db)
 
     # Load from cached file (if exists)
-    signature: str = f"start={pids[0]}_end={pids[-1]}_len={len(pids)}"
+    signature: str = get_chunk_signature(args)
     if (cache := load_results_from_cache(path_to_cache_dir, signature)) is not None:
         return cache
 
@@ -81,20 +267,21 @@ def merge_categorical_codes(results: List[Set[Tuple[str, List[str]]]]) -> Set[Tu
 ################################################
 # Get all numerical_range codes in dataset
 ################################################
-def calc_numerical_range_codes(args: Tuple) -> Set[Tuple[str, List[str]]]:
-    """Return all (code, start_range, end_range) in dataset."""
+def calc_numerical_range_codes(args: Tuple) -> Dict[Tuple[str, str], KLLSketch]:
+    """Return a quantile sketch of all numerical values for each (code, unit) in dataset."""
     path_to_cache_dir: Optional[str] = args[0]
     path_to_femr_db: str = args[1]
     pids: List[int] = args[2]
-    femr_db = femr.datasets.PatientDatabase(path_to_femr_db)
+    sketch_k: int = args[3] if len(args) > 3 else DEFAULT_KLL_K
+    femr_db = get_femr_db(path_to_femr_db)
 
     # Load from cached file (if exists)
-    signature: str = f"start={pids[0]}_end={pids[-1]}_len={len(pids)}"
+    signature: str = get_chunk_signature(args)
     if (cache := load_results_from_cache(path_to_cache_dir, signature)) is not None:
         return cache
 
     # Run function
-    results: Dict[str, List[float]] = {}
+    results: Dict[Tuple[str, str], KLLSketch] = {}
     for pid in pids:
         for event in femr_db[pid].events:
             if (
@@ -107,22 +294,22 @@ def calc_numerical_range_codes(args: Tuple) -> Set[Tuple[str, List[str]]]:
                 unit = event.unit if event.unit is not None else "None"
                 key = (event.code, unit)
                 if key not in results:
-                    results[key] = []
-                results[key].append(float(event.value))  # Ensure values are stored as float
+                    results[key] = KLLSketch(k=sketch_k)
+                results[key].update(event.value)
                 
     # Save to cached file (if applicable)
     save_results_to_cache(results, path_to_cache_dir, signature)
 
     return results
 
-def merge_numerical_range_codes(results: List[Dict[Tuple[str, str], List[float]]]) -> Dict[Tuple[str, str], List[float]]:
+def merge_numerical_range_codes(results: List[Dict[Tuple[str, str], KLLSketch]]) -> Dict[Tuple[str, str], KLLSketch]:
     """Merge results from `calc_numerical_range_codes`."""
-    merged: Dict[Tuple[str, str], List[float]] = {}
+    merged: Dict[Tuple[str, str], KLLSketch] = {}
     for r in tqdm(results, total=len(results), desc='merge_numerical_range_codes()'):
-        for key, values in r.items():
+        for key, sketch in r.items():
             if key not in merged:
-                merged[key] = []
-            merged[key].extend(values)
+                merged[key] = KLLSketch(k=sketch.k)
+            merged[key].merge(sketch)
     return merged
 
 ################################################
@@ -133,10 +320,10 @@ def calc_unique_codes(args: Tuple) -> Set[str]:
     path_to_cache_dir: Optional[str] = args[0]
     path_to_femr_db: str = args[1]
     pids: List[int] = args[2]
-    femr_db = femr.datasets.PatientDatabase(path_to_femr_db)
+    femr_db = get_femr_db(path_to_femr_db)
     
     # Load from cached file (if exists)
-    signature: str = f"start={pids[0]}_end={pids[-1]}_len={len(pids)}"
+    signature: str = get_chunk_signature(args)
     if (cache := load_results_from_cache(path_to_cache_dir, signature)) is not None:
         return cache
 
@@ -162,106 +349,269 @@ def merge_unique_codes(results: List[Set[str]]) -> Set[str]:
 ################################################
 # Code unique patient count
 ################################################
-def calc_code_2_unique_patient_count(args: Tuple) -> Dict:
-    # TODO
-    """Given a code, count # of unique patients have it."""
+def calc_code_2_unique_patient_count(args: Tuple) -> str:
+    """
+        Given a list of patient IDs, count the # of unique patients with each token using CookbookTokenizer.
+        Returns the path to a .npy array of counts indexed by token ID (i.e. `tokenizer.get_vocab()`).
+        
+        NOTE: Tokens are deduplicated within each patient in one vectorized `np.unique` over (patient, token ID) keys
+        for the whole chunk, rather than building a Python set per patient.
+    """
     path_to_cache_dir: Optional[str] = args[0]
     path_to_femr_db: str = args[1]
     pids: List[int] = args[2]
-    path_to_tokenizer_config = args[3] # TODO -- need to take direct tokenizer config entry, then check if numerical_range / categorical code matches this code
-    femr_db = femr.datasets.PatientDatabase(path_to_femr_db)
-    results: Dict[str, int] = collections.defaultdict(int)
-    for pid in pids:
-        counted = set()
+    path_to_tokenizer_config = args[3]
+
+    # Load from cached file (if exists)
+    signature: str = get_chunk_signature(args)
+    path_to_npy: str = get_path_to_npy(path_to_cache_dir, signature)
+    if path_to_cache_dir is not None and os.path.exists(path_to_npy):
+        return path_to_npy
+
+    tokenizer: CookbookTokenizer = get_cookbook_tokenizer(path_to_tokenizer_config)
+    token_2_idx: Dict[str, int] = tokenizer.get_vocab()
+    vocab_size: int = len(token_2_idx)
+    femr_db = get_femr_db(path_to_femr_db)
+
+    # Collect (patient, token ID) for every event
+    token_idxs: List[int] = []
+    patient_idxs: List[int] = []
+    for p_idx, pid in enumerate(pids):
         for event in femr_db[pid].events:
-            if event.code not in counted:
-                counted.add(event.code)
-                results[event.code] += 1
-    return dict(results)
-
-def merge_code_2_unique_patient_count(results: List[Dict[str, int]]) -> Dict:
-    """Merge results from `calc_code_2_unique_patient_count`."""
-    merged: Dict[str, int] = collections.defaultdict(int)
-    for r in results:
-        for code, count in r.items():
-            merged[code] += count
-    return dict(merged)
+            token = tokenizer.convert_event_to_token(event)
+            if token is not None:
+                token_idxs.append(token_2_idx[token])
+                patient_idxs.append(p_idx)
+
+    # Dedupe (patient, token ID) pairs, then count patients per token ID
+    keys: np.ndarray = np.asarray(patient_idxs, dtype=np.int64) * vocab_size + np.asarray(token_idxs, dtype=np.int64)
+    unique_token_idxs: np.ndarray = np.unique(keys) % vocab_size
+    counts: np.ndarray = np.bincount(unique_token_idxs, minlength=vocab_size).astype(np.int64)
+
+    # Save to cached file (this is also how results get back to the parent process)
+    np.save(path_to_npy, counts)
+    return path_to_npy
+
+def merge_code_2_unique_patient_count(results: List[str]) -> np.ndarray:
+    """Merge results from `calc_code_2_unique_patient_count` (normally already reduced to one array by `calc_parallelize`)."""
+    merged: Optional[np.ndarray] = None
+    for path_to_npy in results:
+        counts: np.ndarray = np.load(path_to_npy)
+        merged = counts if merged is None else merged + counts
+    return merged
 
 ################################################
 # Code occurrence count
 ################################################
-def calc_code_2_occurrence_count(args: Tuple) -> Dict[str, int]:
-    """Given a list of patient IDs, count the occurrences of each token using CookbookTokenizer."""
+def calc_code_2_occurrence_count(args: Tuple) -> str:
+    """
+        Given a list of patient IDs, count the occurrences of each token using CookbookTokenizer.
+        Returns the path to a .npy array of counts indexed by token ID (i.e. `tokenizer.get_vocab()`).
+    """
     path_to_cache_dir: Optional[str] = args[0]
     path_to_femr_db: str = args[1]
     pids: List[int] = args[2]
     path_to_tokenizer_config = args[3]
     
     # Load from cached file (if exists)
-    signature: str = f"start={pids[0]}_end={pids[-1]}_len={len(pids)}"
-    if (cache := load_results_from_cache(path_to_cache_dir, signature)) is not None:
-        return cache
+    signature: str = get_chunk_signature(args)
+    path_to_npy: str = get_path_to_npy(path_to_cache_dir, signature)
+    if path_to_cache_dir is not None and os.path.exists(path_to_npy):
+        return path_to_npy
 
-    # Adding the print statement to indicate the start of the function
-    print(f"\nStarting calc_code_2_occurrence_count() with path_to_femr_db: {path_to_femr_db}, pids: {len(pids)}, and path_to_tokenizer_config: {path_to_tokenizer_config}")
-    
-    print("Start | Loading tokenizer metadata")
-    start_time = datetime.datetime.now()
-    __, metadata = load_tokenizer_config_and_metadata_from_path(path_to_tokenizer_config)
-    print(f"Finish | Loading tokenizer metadata | Time= {datetime.datetime.now() - start_time}s")
-
-    print("Loading CookbookTokenizer")
-    start_time = datetime.datetime.now()
-    tokenizer = CookbookTokenizer(path_to_tokenizer_config, metadata=metadata)
-    print(f"Finish | CookbookTokenizer | Time= {datetime.datetime.now() - start_time}s")
-
-    print("Loading FEMR PatientDatabase")
-    start_time = datetime.datetime.now()
-    femr_db = femr.datasets.PatientDatabase(path_to_femr_db)
-    print(f"Finish | FEMR PatientDatabase | Time= {datetime.datetime.now() - start_time}s")
+    tokenizer: CookbookTokenizer = get_cookbook_tokenizer(path_to_tokenizer_config)
+    token_2_idx: Dict[str, int] = tokenizer.get_vocab()
+    femr_db = get_femr_db(path_to_femr_db)
 
     # Process events
-    print("Start | Processing events")
-    start_time = datetime.datetime.now()
-    results: Dict[str, int] = collections.defaultdict(int)
-    for pid in tqdm(pids, total=len(pids), desc='pids'):
+    token_idxs: List[int] = []
+    for pid in pids:
         for event in femr_db[pid].events:
             token = tokenizer.convert_event_to_token(event)
             if token is not None:
-                results[token] += 1
-    print(f"Finish | Processing events | Time= {datetime.datetime.now() - start_time}s")
+                token_idxs.append(token_2_idx[token])
+    counts: np.ndarray = np.bincount(np.asarray(token_idxs, dtype=np.int64), minlength=len(token_2_idx)).astype(np.int64)
     
+    # Save to cached file (this is also how results get back to the parent process)
+    np.save(path_to_npy, counts)
+    return path_to_npy
+
+def merge_code_2_occurrence_count(results: List[str]) -> np.ndarray:
+    """Merge results from `calc_code_2_occurrence_count` (normally already reduced to one array by `calc_parallelize`)."""
+    merged: Optional[np.ndarray] = None
+    for path_to_npy in results:
+        counts: np.ndarray = np.load(path_to_npy)
+        merged = counts if merged is None else merged + counts
+    return merged
+
+################################################
+# Single-pass vocab stats
+################################################
+def calc_vocab_stats(args: Tuple) -> Dict[str, Any]:
+    """
+        In one scan over `pids`, collect everything needed to build a tokenizer config:
+            - `unique_codes`: every code in dataset
+            - `code_2_*`: occurrence / patient counts of events that get tokenized as their raw code (i.e. have no value)
+            - `categorical_2_*`: occurrence / patient counts of each (code, textual value)
+            - `numerical_2_sketch`: a quantile sketch of all numerical values for each (code, unit)
+        
+        NOTE: Which token an event maps to only depends on the event itself (numeric value => `numerical_range`, 
+        textual value => `categorical`, no value => `code`), so counts can be collected before the vocab exists.
+    """
+    path_to_cache_dir: Optional[str] = args[0]
+    path_to_femr_db: str = args[1]
+    pids: List[int] = args[2]
+    sketch_k: int = args[3] if len(args) > 3 else DEFAULT_KLL_K
+    femr_db = get_femr_db(path_to_femr_db)
+
+    # Load from cached file (if exists)
+    signature: str = get_chunk_signature(args)
+    if (cache := load_results_from_cache(path_to_cache_dir, signature)) is not None:
+        return cache
+
+    # Run function
+    unique_codes: Set[str] = set()
+    code_2_occurrence_count: Dict[str, int] = collections.defaultdict(int)
+    code_2_patient_count: Dict[str, int] = collections.defaultdict(int)
+    categorical_2_occurrence_count: Dict[Tuple[str, str], int] = collections.defaultdict(int)
+    categorical_2_patient_count: Dict[Tuple[str, str], int] = collections.defaultdict(int)
+    numerical_2_sketch: Dict[Tuple[str, str], KLLSketch] = {}
+    for pid in pids:
+        seen_codes: Set[str] = set()
+        seen_categoricals: Set[Tuple[str, str]] = set()
+        for event in femr_db[pid].events:
+            unique_codes.add(event.code)
+            if (
+                event.value is not None  # `value` is not None
+                and (  # `value` is numeric
+                    isinstance(event.value, float)
+                    or isinstance(event.value, int)
+                )
+            ):
+                key = (event.code, event.unit if event.unit is not None else "None")
+                if key not in numerical_2_sketch:
+                    numerical_2_sketch[key] = KLLSketch(k=sketch_k)
+                numerical_2_sketch[key].update(event.value)
+            elif (
+                event.value is not None # `value` is not None
+                and event.value != '' # `value` is not blank
+                and isinstance(event.value, str) # `value` is textual
+            ):
+                key = (event.code, event.value)
+                categorical_2_occurrence_count[key] += 1
+                if key not in seen_categoricals:
+                    seen_categoricals.add(key)
+                    categorical_2_patient_count[key] += 1
+            else:
+                code_2_occurrence_count[event.code] += 1
+                if event.code not in seen_codes:
+                    seen_codes.add(event.code)
+                    code_2_patient_count[event.code] += 1
+
+    results: Dict[str, Any] = {
+        'unique_codes' : unique_codes,
+        'code_2_occurrence_count' : dict(code_2_occurrence_count),
+        'code_2_patient_count' : dict(code_2_patient_count),
+        'categorical_2_occurrence_count' : dict(categorical_2_occurrence_count),
+        'categorical_2_patient_count' : dict(categorical_2_patient_count),
+        'numerical_2_sketch' : numerical_2_sketch,
+    }
+
     # Save to cached file (if applicable)
     save_results_to_cache(results, path_to_cache_dir, signature)
-    
-    print("Ending calc_code_2_occurrence_count")
-    return dict(results)
 
-def merge_code_2_occurrence_count(results: List[Dict[str, int]]) -> Dict[str, int]:
-    """Merge results from `calc_code_2_occurrence_count`."""
-    print("Starting merge_code_2_occurrence_count")
-    merged: Dict[str, int] = collections.defaultdict(int)
-    start_time = datetime.datetime.now()
-    for r in results:
-        for token, count in r.items():
-            merged[token] += count
-    print(f"Finished merging, time taken: {datetime.datetime.now() - start_time}")
-    
-    print("Ending merge_code_2_occurrence_count")
-    return dict(merged)
+    return results
+
+def merge_vocab_stats(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge results from `calc_vocab_stats`."""
+    merged: Dict[str, Any] = {
+        'unique_codes' : set(),
+        'code_2_occurrence_count' : collections.defaultdict(int),
+        'code_2_patient_count' : collections.defaultdict(int),
+        'categorical_2_occurrence_count' : collections.defaultdict(int),
+        'categorical_2_patient_count' : collections.defaultdict(int),
+        'numerical_2_sketch' : {},
+    }
+    for r in tqdm(results, total=len(results), desc='merge_vocab_stats()'):
+        merged['unique_codes'].update(r['unique_codes'])
+        for field in [ 'code_2_occurrence_count', 'code_2_patient_count', 'categorical_2_occurrence_count', 'categorical_2_patient_count' ]:
+            for key, count in r[field].items():
+                merged[field][key] += count
+        for key, sketch in r['numerical_2_sketch'].items():
+            if key not in merged['numerical_2_sketch']:
+                merged['numerical_2_sketch'][key] = KLLSketch(k=sketch.k)
+            merged['numerical_2_sketch'][key].merge(sketch)
+    return merged
+
+def calc_numerical_range_counts(args: Tuple) -> str:
+    """
+        Given a list of patient IDs, count the occurrences + unique patients of each `numerical_range` token using CookbookTokenizer
+        (i.e. a second, cheap pass once `build_vocab_single_pass` has fixed the ranges -- only events with numeric values get tokenized).
+        Returns the path to a .npy array of shape (2, vocab size), with occurrence counts in row 0 and patient counts in row 1.
+    """
+    path_to_cache_dir: Optional[str] = args[0]
+    path_to_femr_db: str = args[1]
+    pids: List[int] = args[2]
+    path_to_tokenizer_config = args[3]
+
+    # Load from cached file (if exists)
+    signature: str = get_chunk_signature(args)
+    path_to_npy: str = get_path_to_npy(path_to_cache_dir, signature)
+    if path_to_cache_dir is not None and os.path.exists(path_to_npy):
+        return path_to_npy
+
+    tokenizer: CookbookTokenizer = get_cookbook_tokenizer(path_to_tokenizer_config)
+    token_2_idx: Dict[str, int] = tokenizer.get_vocab()
+    vocab_size: int = len(token_2_idx)
+    femr_db = get_femr_db(path_to_femr_db)
+
+    # Collect (patient, token ID) for every event with a numeric value
+    token_idxs: List[int] = []
+    patient_idxs: List[int] = []
+    for p_idx, pid in enumerate(pids):
+        for event in femr_db[pid].events:
+            if not (isinstance(event.value, float) or isinstance(event.value, int)):
+                continue
+            token = tokenizer.convert_event_to_token(event)
+            if token is not None:
+                token_idxs.append(token_2_idx[token])
+                patient_idxs.append(p_idx)
+
+    # Occurrences, then dedupe (patient, token ID) pairs for patients
+    token_idxs: np.ndarray = np.asarray(token_idxs, dtype=np.int64)
+    keys: np.ndarray = np.asarray(patient_idxs, dtype=np.int64) * vocab_size + token_idxs
+    counts: np.ndarray = np.stack([
+        np.bincount(token_idxs, minlength=vocab_size),
+        np.bincount(np.unique(keys) % vocab_size, minlength=vocab_size),
+    ]).astype(np.int64)
+
+    # Save to cached file (this is also how results get back to the parent process)
+    np.save(path_to_npy, counts)
+    return path_to_npy
+
+def merge_numerical_range_counts(results: List[str]) -> np.ndarray:
+    """Merge results from `calc_numerical_range_counts` (normally already reduced to one array by `calc_parallelize`)."""
+    merged: Optional[np.ndarray] = None
+    for path_to_npy in results:
+        counts: np.ndarray = np.load(path_to_npy)
+        merged = counts if merged is None else merged + counts
+    return merged
 
 ################################################
 #
 # Discrete modifiers of tokenizer_config.json
 #
 ################################################
-def add_numerical_range_codes(path_to_tokenizer_config: str, path_to_femr_db: str, pids: List[int], N: int, **kwargs):
-    """For each unique (code, numerical range) in dataset, add NumericalRangeTCEs to tokenizer config."""
+def add_numerical_range_codes(path_to_tokenizer_config: str, path_to_femr_db: str, pids: List[int], N: int, sketch_k: int = DEFAULT_KLL_K, **kwargs):
+    """
+        For each unique (code, numerical range) in dataset, add NumericalRangeTCEs to tokenizer config.
+        Ranges are the `N` quantile bins of each (code, unit)'s values, estimated with a KLL sketch of size `sketch_k` (see `sketches.py`).
+    """
     path_to_cache_dir: str = os.path.join(PATH_TO_CACHE_DIR, "add_numerical_range_codes")
     os.makedirs(path_to_cache_dir, exist_ok=True)
     
-    # Step 1: Collect all numerical values for each code
-    results = run_helper(calc_numerical_range_codes, merge_numerical_range_codes, path_to_femr_db, pids, path_to_cache_dir, **kwargs)
+    # Step 1: Collect a quantile sketch of all numerical values for each code
+    results = run_helper(calc_numerical_range_codes, merge_numerical_range_codes, path_to_femr_db, pids, path_to_cache_dir, additional_args=(sketch_k,), **kwargs)
 
     # Step 2: Calculate the range for each code and update the tokenizer config
     tokenizer_config, metadata = load_tokenizer_config_and_metadata_from_path(path_to_tokenizer_config)
@@ -271,9 +621,9 @@ def add_numerical_range_codes(path_to_tokenizer_config: str, path_to_femr_db: st
         if t.type == 'numerical_range'
     ])
 
-    for (code, unit), values in tqdm(results.items(), total=len(results), desc='add_numerical_range_codes() | Calculating ranges and adding to tokenizer_config...'):
+    for (code, unit), sketch in tqdm(results.items(), total=len(results), desc='add_numerical_range_codes() | Calculating ranges and adding to tokenizer_config...'):
         # Step 3: Calculate percentiles for bucketing
-        percentiles = np.percentile(values, np.linspace(0, 100, N + 1))
+        percentiles = sketch.quantiles(np.linspace(0, 1, N + 1))
 
         # Step 4: Create NumericalRangeTCE for each quantile range
         for idx in range(len(percentiles) - 1):
@@ -358,9 +708,13 @@ def add_occurrence_count_to_codes(path_to_tokenizer_config: str, path_to_femr_db
     # Run function in parallel   
     print("Running run_helper") 
     start_time = datetime.datetime.now()
-    results = run_helper(calc_code_2_occurrence_count, merge_code_2_occurrence_count, path_to_femr_db, pids, path_to_cache_dir, additional_args=(path_to_tokenizer_config,), **kwargs)
+    results = run_helper(calc_code_2_occurrence_count, merge_code_2_occurrence_count, path_to_femr_db, pids, path_to_cache_dir, additional_args=(path_to_tokenizer_config, get_tokenizer_vocab_signature(path_to_tokenizer_config)), **kwargs)
     print(f"Finished run_helper, time taken: {datetime.datetime.now() - start_time}")
 
+    # Map token IDs => tokens
+    token_2_idx: Dict[str, int] = get_cookbook_tokenizer(path_to_tokenizer_config).get_vocab()
+    results: Dict[str, int] = { token: int(results[idx]) for token, idx in token_2_idx.items() if results[idx] > 0 }
+
     # Add stats to tokenizer config
     tokenizer_config, metadata = load_tokenizer_config_and_metadata_from_path(path_to_tokenizer_config)
 
@@ -393,7 +747,41 @@ def add_occurrence_count_to_codes(path_to_tokenizer_config: str, path_to_femr_db
 
     print("Completed add_occurrence_count_to_codes function")
 
-    
+
+def add_patient_count_to_codes(path_to_tokenizer_config: str, path_to_femr_db: str, pids: List[int], dataset: str = "v8", split: str = "train", **kwargs):
+    """Add # of unique patients with each token (i.e. a CountPatientsTCEStat) to each entry in tokenizer config."""
+    path_to_cache_dir: str = os.path.join(PATH_TO_CACHE_DIR, split, "add_patient_count_to_codes")
+    os.makedirs(path_to_cache_dir, exist_ok=True)
+
+    # Run function in parallel
+    results = run_helper(calc_code_2_unique_patient_count, merge_code_2_unique_patient_count, path_to_femr_db, pids, path_to_cache_dir, additional_args=(path_to_tokenizer_config, get_tokenizer_vocab_signature(path_to_tokenizer_config)), **kwargs)
+
+    # Map token IDs => tokens
+    token_2_idx: Dict[str, int] = get_cookbook_tokenizer(path_to_tokenizer_config).get_vocab()
+    results: Dict[str, int] = { token: int(results[idx]) for token, idx in token_2_idx.items() if results[idx] > 0 }
+
+    # Add stats to tokenizer config
+    tokenizer_config, metadata = load_tokenizer_config_and_metadata_from_path(path_to_tokenizer_config)
+    for entry in tqdm(tokenizer_config, total=len(tokenizer_config), desc='add_patient_count_to_codes() | Adding patient counts to tokenizer_config...'):
+        token: str = entry.to_token()
+        if token not in results:
+            continue
+        patient_stat = CountPatientsTCEStat(
+            type="count_patients",
+            dataset=dataset,
+            split=split,
+            count=results[token]
+        )
+        if hasattr(entry, 'stats') and isinstance(entry.stats, list):
+            entry.stats.append(patient_stat)
+        else:
+            entry.stats = [patient_stat]
+
+    # Save updated tokenizer config
+    if 'is_already_run' not in metadata: metadata['is_already_run'] = {}
+    metadata['is_already_run']['add_patient_count_to_codes'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    save_tokenizer_config_to_path(path_to_tokenizer_config, tokenizer_config, metadata)
+
 def add_description_to_codes(path_to_tokenizer_config: str, path_to_femr_db: str, **kwargs):
     femr_db = femr.datasets.PatientDatabase(path_to_femr_db)
     
@@ -427,27 +815,187 @@ def remove_codes_belonging_to_vocabs(path_to_tokenizer_config: str, excluded_voc
 
 
 
+def build_vocab_single_pass(path_to_tokenizer_config: str, 
+                            path_to_femr_db: str, 
+                            pids: List[int], 
+                            N: int = 10, 
+                            sketch_k: int = DEFAULT_KLL_K,
+                            excluded_vocabs: Optional[List[str]] = None, 
+                            dataset: str = "v8", 
+                            split: str = "train", 
+                            **kwargs):
+    """
+        Fused version of `add_unique_codes`, `add_categorical_codes`, `add_numerical_range_codes`, 
+        `remove_codes_belonging_to_vocabs` and `add_occurrence_count_to_codes` (+ patient counts).
+        Scans the dataset once (with `calc_vocab_stats`), then once more over only numeric events (with `calc_numerical_range_counts`)
+        to get exact counts for the `numerical_range` tokens, instead of scanning the dataset 5x and rewriting the config 6x.
+    """
+    path_to_cache_dir: str = os.path.join(PATH_TO_CACHE_DIR, split, "build_vocab_single_pass")
+    os.makedirs(path_to_cache_dir, exist_ok=True)
+
+    # Step 1: Collect all stats in one parallel pass
+    results = run_helper(calc_vocab_stats, merge_vocab_stats, path_to_femr_db, pids, path_to_cache_dir, additional_args=(sketch_k,), **kwargs)
+
+    # Step 2: Add new entries to tokenizer config (same entries + order as running each `add_*` function in sequence)
+    tokenizer_config, metadata = load_tokenizer_config_and_metadata_from_path(path_to_tokenizer_config)
+    existing_codes: Set[str] = set([ t.code for t in tokenizer_config if t.type == 'code' ])
+    existing_categoricals: Set[Tuple[str, Tuple[str, ...]]] = set([ (t.code, tuple(t.tokenization['categories'])) for t in tokenizer_config if t.type == 'categorical' ])
+    existing_numericals: Set[Tuple[str, str]] = set([ (t.code, t.tokenization['unit']) for t in tokenizer_config if t.type == 'numerical_range' ])
+    
+    for code in tqdm(results['unique_codes'], total=len(results['unique_codes']), desc='build_vocab_single_pass() | Adding code entries to tokenizer_config...'):
+        if code in existing_codes:
+            continue
+        tokenizer_config.append(CodeTCE(code=code))
+
+    for (code, value) in tqdm(results['categorical_2_occurrence_count'], total=len(results['categorical_2_occurrence_count']), desc='build_vocab_single_pass() | Adding categorical entries to tokenizer_config...'):
+        if (code, (value,)) in existing_categoricals:
+            continue
+        tokenizer_config.append(CategoricalTCE(code=code, tokenization={ 'categories' : (value,) }))
+
+    # Token => count, for every token whose count can be calculated from `results`
+    token_2_occurrence_count: Dict[str, int] = collections.defaultdict(int)
+    token_2_patient_count: Dict[str, int] = collections.defaultdict(int)
+    for code, count in results['code_2_occurrence_count'].items():
+        token_2_occurrence_count[CodeTCE(code=code).to_token()] += count
+        token_2_patient_count[CodeTCE(code=code).to_token()] += results['code_2_patient_count'][code]
+    for (code, value), count in results['categorical_2_occurrence_count'].items():
+        token: str = CategoricalTCE(code=code, tokenization={ 'categories' : (value,) }).to_token()
+        token_2_occurrence_count[token] += count
+        token_2_patient_count[token] += results['categorical_2_patient_count'][(code, value)]
+
+    for (code, unit), sketch in tqdm(results['numerical_2_sketch'].items(), total=len(results['numerical_2_sketch']), desc='build_vocab_single_pass() | Calculating ranges and adding to tokenizer_config...'):
+        percentiles = sketch.quantiles(np.linspace(0, 1, N + 1))
+        entries: List[NumericalRangeTCE] = [
+            NumericalRangeTCE(
+                code=code,
+                tokenization={
+                    "unit": unit,
+                    "range_start": percentiles[idx],
+                    "range_end": percentiles[idx + 1],
+                }
+            )
+            for idx in range(len(percentiles) - 1)
+        ]
+        if (code, unit) not in existing_numericals:
+            tokenizer_config.extend(entries)
+    
+    # Step 3: Remove all codes that belong to a vocab in `excluded_vocabs`
+    if excluded_vocabs:
+        excluded_vocabs = set([ x.lower() for x in excluded_vocabs ])
+        tokenizer_config = [ entry for entry in tokenizer_config if entry.code.split("/")[0].lower() not in excluded_vocabs ]
+
+    # Step 4: Exact occurrence + patient counts of `numerical_range` tokens, by tokenizing every numeric value with the final ranges
+    # NOTE: Same counts as the multi-pass path (i.e. `CookbookTokenizer.convert_event_to_token()`), so the config is saved first
+    save_tokenizer_config_to_path(path_to_tokenizer_config, tokenizer_config, metadata)
+    path_to_numerical_cache_dir: str = os.path.join(PATH_TO_CACHE_DIR, split, "build_vocab_single_pass_numerical_range_counts")
+    os.makedirs(path_to_numerical_cache_dir, exist_ok=True)
+    numerical_counts: np.ndarray = run_helper(calc_numerical_range_counts, merge_numerical_range_counts, path_to_femr_db, pids, path_to_numerical_cache_dir, additional_args=(path_to_tokenizer_config, get_tokenizer_vocab_signature(path_to_tokenizer_config)), **kwargs)
+    token_2_idx: Dict[str, int] = get_cookbook_tokenizer(path_to_tokenizer_config).get_vocab()
+    for entry in tokenizer_config:
+        if entry.type != 'numerical_range' or entry.to_token() not in token_2_idx:
+            continue
+        token: str = entry.to_token()
+        if numerical_counts[0, token_2_idx[token]] > 0:
+            token_2_occurrence_count[token] += int(numerical_counts[0, token_2_idx[token]])
+            token_2_patient_count[token] += int(numerical_counts[1, token_2_idx[token]])
+
+    # Step 5: Add occurrence + patient counts to tokenizer config
+    for entry in tqdm(tokenizer_config, total=len(tokenizer_config), desc='build_vocab_single_pass() | Adding counts to tokenizer_config...'):
+        token: str = entry.to_token()
+        if token not in token_2_occurrence_count:
+            continue
+        if not (hasattr(entry, 'stats') and isinstance(entry.stats, list)):
+            entry.stats = []
+        entry.stats.append(CountOccurrencesTCEStat(type="count_occurrences", dataset=dataset, split=split, count=token_2_occurrence_count[token]))
+        entry.stats.append(CountPatientsTCEStat(type="count_patients", dataset=dataset, split=split, count=token_2_patient_count[token]))
+
+    # Save updated tokenizer config
+    if 'is_already_run' not in metadata: metadata['is_already_run'] = {}
+    timestamp: str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for func_name in [ 'add_unique_codes', 'add_categorical_codes', 'add_numerical_range_codes', 'remove_codes_belonging_to_vocabs', 'add_occurrence_count_to_codes', 'add_patient_count_to_codes', 'build_vocab_single_pass' ]:
+        metadata['is_already_run'][func_name] = timestamp
+    save_tokenizer_config_to_path(path_to_tokenizer_config, tokenizer_config, metadata)
+
+
 ################################################
 #
 # General callers / parallelization helpers
 #
 ################################################
 
+def sum_npy_arrays(args: Tuple[List[str], str, List[str]]) -> str:
+    """Sum the .npy arrays at `paths_to_npy`, save to `path_to_output`, then delete any of `paths_to_delete` (i.e. intermediate results)."""
+    paths_to_npy, path_to_output, paths_to_delete = args
+    merged: np.ndarray = np.load(paths_to_npy[0])
+    for path_to_npy in paths_to_npy[1:]:
+        merged += np.load(path_to_npy, mmap_mode='r')
+    np.save(path_to_output, merged)
+    for path in paths_to_delete:
+        os.remove(path)
+    return path_to_output
+
+def tree_reduce_npy_arrays(paths_to_npy: List[str], pool: Optional['multiprocessing.pool.Pool'], fan_in: int = 4, is_delete_inputs: bool = False) -> str:
+    """
+        Sum .npy arrays in parallel, `fan_in` at a time, until one is left. Returns path to the final array.
+        Intermediate arrays are deleted once consumed (inputs too if `is_delete_inputs`, i.e. they aren't cache files).
+    """
+    paths_to_intermediates: Set[str] = set(paths_to_npy) if is_delete_inputs else set()
+    level: int = 0
+    while len(paths_to_npy) > 1:
+        tasks = []
+        for start in range(0, len(paths_to_npy), fan_in):
+            group: List[str] = paths_to_npy[start:start + fan_in]
+            path_to_output: str = os.path.join(os.path.dirname(group[0]), f"reduce_level={level}_{uuid.uuid4().hex}.npy")
+            tasks.append((group, path_to_output, [ p for p in group if p in paths_to_intermediates ]))
+        paths_to_npy = pool.map(sum_npy_arrays, tasks) if pool is not None else [ sum_npy_arrays(t) for t in tasks ]
+        paths_to_intermediates.update(paths_to_npy)
+        level += 1
+    return paths_to_npy[0]
+
+def reduce_npy_results(paths_to_npy: List[str], pool: Optional['multiprocessing.pool.Pool'], path_to_cache_dir: Optional[str]) -> Tuple[List[str], List[str]]:
+    """
+        Tree reduce the .npy results of `calc_parallelize()` into one array. Returns `([path_to_final], paths_to_delete)`, where 
+        `paths_to_delete` is the final array unless it is one of the cache files (i.e. the single-chunk case), to be deleted once merged.
+    """
+    is_delete_inputs: bool = path_to_cache_dir is None
+    path_to_final: str = tree_reduce_npy_arrays(paths_to_npy, pool, is_delete_inputs=is_delete_inputs)
+    is_cache_file: bool = path_to_final in paths_to_npy and not is_delete_inputs
+    return [ path_to_final ], ([] if is_cache_file else [ path_to_final ])
+
 def calc_parallelize(path_to_femr_db: str, func: Callable, merger: Callable, pids: List[int], path_to_cache_dir: Optional[str], n_procs: int = 5, chunk_size: int = 10000, additional_args: Tuple = ()):
+    """
+        Run `func` over chunks of `pids` on `n_procs` long-lived workers (which each open the FEMR extract once), then `merger` the results.
+        
+        NOTE: If `func` returns paths to .npy arrays (e.g. counts indexed by token ID), the arrays are summed by a 
+        parallel tree reduction on the same workers, and `merger` gets a list with the path to the single final array.
+    """
     # Set up parallel tasks
-    tasks = [(path_to_cache_dir, path_to_femr_db, pids[start:start+chunk_size]) + additional_args for start in range(0, len(pids), chunk_size)]
+    tasks = [(path_to_cache_dir, path_to_femr_db, chunk) + additional_args for chunk in split_pids_into_chunks(pids, chunk_size)]
 
     # Debugging info
-    print(f"calc_parallelize: {len(tasks)} tasks created")
+    n_reused: int = reuse_cached_chunks_across_extracts(path_to_cache_dir, tasks)
+    n_cached: int = sum([ is_chunk_cached(path_to_cache_dir, get_chunk_signature(task)) for task in tasks ])
+    print(f"calc_parallelize: {len(tasks)} tasks created ({n_cached} already cached, incl. {n_reused} reused from other extracts, {len(tasks) - n_cached} to compute)")
 
     # Run `func` in parallel and merge results
+    paths_to_delete: List[str] = []
+    desc: str = f"Running {func.__name__}() | n_procs={n_procs} | chunk_size={chunk_size} | n_pids={len(pids)}"
     if n_procs == 1:
-        results: List = [func(task) for task in tqdm(tasks, total=len(tasks), desc=f"Running {func.__name__}() | n_procs={n_procs} | chunk_size={chunk_size} | n_pids={len(pids)}")]
+        init_worker(path_to_femr_db)
+        results: List = [func(task) for task in tqdm(tasks, total=len(tasks), desc=desc)]
+        if len(results) > 0 and all(isinstance(r, str) and r.endswith('.npy') for r in results):
+            results, paths_to_delete = reduce_npy_results(results, None, path_to_cache_dir)
     else:
-        with multiprocessing.Pool(processes=n_procs) as pool:
-            results: List = list(tqdm(pool.imap(func, tasks), total=len(tasks), desc=f"Running {func.__name__}() | n_procs={n_procs} | chunk_size={chunk_size} | n_pids={len(pids)}"))
+        with multiprocessing.Pool(processes=n_procs, initializer=init_worker, initargs=(path_to_femr_db,)) as pool:
+            results: List = list(tqdm(pool.imap(func, tasks), total=len(tasks), desc=desc))
+            if len(results) > 0 and all(isinstance(r, str) and r.endswith('.npy') for r in results):
+                results, paths_to_delete = reduce_npy_results(results, pool, path_to_cache_dir)
+    update_chunk_manifest(path_to_cache_dir, tasks)
 
-    return merger(results)
+    merged = merger(results)
+    for path in paths_to_delete:
+        os.remove(path)
+    return merged
 
 def run_helper(calc_func: Callable, merge_func: Callable, path_to_femr_db: str, pids: List[int], path_to_cache_dir: Optional[str], additional_args: Tuple = (), **kwargs):
     print(f"Running {calc_func.__name__} for {len(pids)} patients")
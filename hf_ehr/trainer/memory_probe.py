@@ -0,0 +1,201 @@
+"""
+Preflight GPU memory probe.
+
+Runs a fake full-size batch (forward + backward) through a model to detect OOMs before training starts, and records
+the peak memory of every probe in a local JSON cache keyed by a signature of everything that affects memory use
+(model, context length, precision, strategy, GPU). Restarts with an identical setup skip the probe entirely, and
+the recorded probes are reused to choose `max_tokens` automatically (see `autotune_max_tokens()` in `hf_ehr/scripts/run.py`).
+
+Usage:
+    probe = MemoryProbe(model, config, vocab_size, precision='bf16-mixed', device=device) # `model` is a `BaseModel`
+    if not probe.is_known_to_fit(max_tokens):
+        max_safe_max_tokens = probe.search_max_safe_max_tokens(candidates)
+        probe.save()
+"""
+import os
+import json
+import time
+import hashlib
+import torch
+from omegaconf import DictConfig, OmegaConf
+from typing import Dict, List, Any, Optional
+from loguru import logger
+
+from hf_ehr.config import PATH_TO_CACHE_DIR
+
+PATH_TO_MEMORY_PROBE_CACHE: str = os.path.join(PATH_TO_CACHE_DIR, 'memory_probe.json')
+
+def get_memory_probe_signature(config: DictConfig, vocab_size: int, precision: str, device: torch.device) -> Dict[str, Any]:
+    """Everything (other than the number of tokens per batch) that determines peak memory of a training step."""
+    config_kwargs = config.model.config_kwargs if 'config_kwargs' in config.model else {}
+    return {
+        'model_name' : config.model.name,
+        'hf_name' : getattr(config.model, 'hf_name', None),
+        'config_kwargs' : OmegaConf.to_container(config_kwargs, resolve=True) if isinstance(config_kwargs, DictConfig) else dict(config_kwargs),
+        'vocab_size' : vocab_size,
+        'max_length' : config.data.dataloader.max_length,
+        'is_use_rope' : getattr(config.data.dataloader, 'is_use_rope', False),
+        'loss_chunk_size' : getattr(config.trainer, 'loss_chunk_size', 2048),
+        'precision' : str(precision),
+        'strategy' : str(config.trainer.distributed_backend),
+        'device_name' : torch.cuda.get_device_name(device) if device.type == 'cuda' else str(device),
+        'device_total_memory' : torch.cuda.get_device_properties(device).total_memory if device.type == 'cuda' else None,
+        'torch_version' : torch.__version__,
+    }
+
+def get_memory_probe_signature_key(signature: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(signature, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+def load_memory_probe_cache(path_to_cache: str) -> Dict[str, Any]:
+    if not os.path.exists(path_to_cache):
+        return {}
+    try:
+        with open(path_to_cache, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"Failed to read memory probe cache at `{path_to_cache}`, so ignoring it: {e}")
+        return {}
+
+def save_memory_probe_cache(path_to_cache: str, cache: Dict[str, Any]) -> None:
+    """Atomically write `cache` to `path_to_cache` (so concurrent jobs never see a partially written file)."""
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path_to_cache)), exist_ok=True)
+        path_to_tmp: str = f"{path_to_cache}.{os.getpid()}.tmp"
+        with open(path_to_tmp, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(path_to_tmp, path_to_cache)
+    except OSError as e:
+        logger.warning(f"Failed to write memory probe cache at `{path_to_cache}`: {e}")
+
+def make_fake_batch(n_rows: int, max_length: int, device: torch.device) -> Dict[str, torch.Tensor]:
+    """Fake full (no PAD) batch of shape (n_rows, max_length), with the same keys the collator feeds to `BaseModel.compute_loss()`."""
+    return {
+        'input_ids' : torch.ones((n_rows, max_length), dtype=torch.long, device=device),
+        'attention_mask' : torch.ones((n_rows, max_length), dtype=torch.long, device=device),
+        'labels' : torch.ones((n_rows, max_length), dtype=torch.long, device=device),
+    }
+
+def get_autocast_dtype(precision: str) -> Optional[torch.dtype]:
+    """Map a PTL precision string (e.g. 'bf16-mixed', '16-mixed', '32-true') to the dtype used by autocast."""
+    precision = str(precision)
+    if 'bf16' in precision:
+        return torch.bfloat16
+    elif '16' in precision:
+        return torch.float16
+    return None
+
+def run_memory_probe(model: torch.nn.Module, max_tokens: int, max_length: int, device: torch.device, precision: str) -> Optional[int]:
+    """
+        Run one forward + backward pass of `model.compute_loss()` (i.e. the same chunked loss / custom forward as training) 
+        on a fake batch of `max_tokens` tokens, where `model` is a `BaseModel`.
+        Returns the peak memory (in bytes) of the step, or None if it OOMs.
+
+        NOTE: Adam's optimizer states (2x params) aren't allocated until the first real step, so they are added on analytically.
+    """
+    n_rows: int = max_tokens // max_length
+    assert n_rows >= 1, f"Error -- max_tokens={max_tokens} must be >= max_length={max_length}"
+    autocast_dtype: Optional[torch.dtype] = get_autocast_dtype(precision)
+    optimizer_state_bytes: int = 2 * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+
+    model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    peak_memory_bytes: Optional[int] = None
+    try:
+        fake_batch: Dict[str, torch.Tensor] = make_fake_batch(n_rows, max_length, device)
+        with torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            loss: torch.Tensor = model.compute_loss(fake_batch)
+        loss.backward()
+        torch.cuda.synchronize(device)
+        peak_memory_bytes = torch.cuda.max_memory_allocated(device) + optimizer_state_bytes
+    except torch.cuda.OutOfMemoryError:
+        peak_memory_bytes = None
+    finally:
+        loss = fake_batch = None
+        model.zero_grad(set_to_none=True)
+        torch.cuda.empty_cache()
+    return peak_memory_bytes
+
+class MemoryProbe():
+    """
+        Runs (or looks up) memory probes for one signature. Probe results are stored per `max_tokens` as:
+            cache[signature_key] = { 'signature' : {...}, 'probes' : { '16384' : { 'peak_memory_bytes' : int | None, 'is_oom' : bool, 'timestamp' : float } } }
+
+        NOTE: Assumes peak memory is monotonic in `max_tokens`, i.e. if `N` tokens fit then so does anything smaller.
+    """
+
+    def __init__(self,
+                 model: torch.nn.Module,
+                 config: DictConfig,
+                 vocab_size: int,
+                 precision: str,
+                 device: torch.device,
+                 path_to_cache: Optional[str] = None):
+        self.model = model
+        self.model_name: str = config.model.name
+        self.max_length: int = config.data.dataloader.max_length
+        self.precision: str = str(precision)
+        self.device: torch.device = device
+        self.path_to_cache: str = path_to_cache or PATH_TO_MEMORY_PROBE_CACHE
+        self.signature: Dict[str, Any] = get_memory_probe_signature(config, vocab_size, precision, device)
+        self.signature_key: str = get_memory_probe_signature_key(self.signature)
+        self.total_memory_bytes: Optional[int] = self.signature['device_total_memory']
+        self.cache: Dict[str, Any] = load_memory_probe_cache(self.path_to_cache)
+        self.probes: Dict[str, Dict[str, Any]] = self.cache.get(self.signature_key, {}).get('probes', {})
+
+    def is_fits(self, peak_memory_bytes: Optional[int], headroom: float = 0.0) -> bool:
+        """True if a probe with `peak_memory_bytes` fits while keeping `headroom` (fraction of total memory) free."""
+        if peak_memory_bytes is None:
+            return False
+        if self.total_memory_bytes is None:
+            return True
+        return peak_memory_bytes <= (1 - headroom) * self.total_memory_bytes
+
+    def is_known_to_fit(self, max_tokens: int, headroom: float = 0.0) -> bool:
+        """True if a cached probe at >= `max_tokens` already fit."""
+        return any(int(key) >= max_tokens and self.is_fits(probe['peak_memory_bytes'], headroom) for key, probe in self.probes.items())
+
+    def is_known_to_not_fit(self, max_tokens: int, headroom: float = 0.0) -> bool:
+        """True if a cached probe at <= `max_tokens` already didn't fit."""
+        return any(int(key) <= max_tokens and not self.is_fits(probe['peak_memory_bytes'], headroom) for key, probe in self.probes.items())
+
+    def probe(self, max_tokens: int) -> Optional[int]:
+        """Run (or look up) a probe at `max_tokens`. Returns peak memory in bytes, or None if OOM."""
+        if str(max_tokens) in self.probes:
+            return self.probes[str(max_tokens)]['peak_memory_bytes']
+        start: float = time.time()
+        peak_memory_bytes: Optional[int] = run_memory_probe(self.model, max_tokens, self.max_length, self.device, self.precision)
+        logger.info(f"Memory probe | max_tokens={max_tokens} | peak_memory={'OOM' if peak_memory_bytes is None else f'{peak_memory_bytes / 1e9:.2f}GB'} | total_memory={(self.total_memory_bytes or 0) / 1e9:.2f}GB | time={time.time() - start:.1f}s")
+        self.probes[str(max_tokens)] = {
+            'peak_memory_bytes' : peak_memory_bytes,
+            'is_oom' : peak_memory_bytes is None,
+            'timestamp' : time.time(),
+        }
+        return peak_memory_bytes
+
+    def search_max_safe_max_tokens(self, candidates: List[int], headroom: float = 0.0) -> Optional[int]:
+        """
+            Binary search for the largest of `candidates` that fits (with `headroom`). Returns None if none fit.
+            The largest candidate is tried first, so a setup that fits only costs one probe.
+        """
+        candidates = sorted(set(candidates))
+        if len(candidates) == 0:
+            return None
+        if self.is_fits(self.probe(candidates[-1]), headroom):
+            return candidates[-1]
+        # Invariant: candidates[hi] doesn't fit; candidates[lo - 1] fits (or lo == 0)
+        lo, hi = 0, len(candidates) - 1
+        while lo < hi:
+            mid: int = (lo + hi) // 2
+            if self.is_known_to_fit(candidates[mid], headroom) or (not self.is_known_to_not_fit(candidates[mid], headroom) and self.is_fits(self.probe(candidates[mid]), headroom)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return candidates[lo - 1] if lo > 0 else None
+
+    def save(self):
+        """Merge this signature's probes into the on-disk cache (re-read first, in case another job wrote to it)."""
+        cache: Dict[str, Any] = load_memory_probe_cache(self.path_to_cache)
+        entry: Dict[str, Any] = cache.setdefault(self.signature_key, { 'signature' : self.signature, 'probes' : {} })
+        entry['probes'].update(self.probes)
+        save_memory_probe_cache(self.path_to_cache, cache)
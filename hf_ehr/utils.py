@@ -1,10 +1,13 @@
 from functools import partial
 import os
+import json
+import time
 from pathlib import Path
-from typing import List, Tuple, Any, Dict, Optional
+from typing import List, Tuple, Any, Dict, Optional, Union
 import torch
 import uuid
 import hashlib
+from loguru import logger
 from hf_ehr.config import PATH_TO_TOKENIZER_CLMBR_v8_CONFIG
 
 def convert_lab_value_to_token_from_ranges(code: str, unit: str, value: float, ranges: List[Tuple[float, float]], is_tokenize_out_of_range: bool = False) -> Optional[str]:
@@ -185,17 +188,13 @@ def load_tokenizer_old_from_path(path_to_ckpt: str):
     config: Dict[str, Any] = load_config_from_ckpt(ckpt)
     return load_tokenizer_old_from_config(config)
 
-def load_tokenizer_from_path(path_to_ckpt: str):
-    """Given a path to a model checkpoint, load the tokenizer."""
-    ckpt: Dict[str, Any] = torch.load(path_to_ckpt, map_location='cpu', weights_only=False)
-    config: Dict[str, Any] = load_config_from_ckpt(ckpt)
-    return load_tokenizer_from_config(config)
+def load_tokenizer_from_path(path_to_ckpt: Union[str, 'CheckpointHandle']):
+    """Given a path to a model checkpoint (or an open `CheckpointHandle`), load the tokenizer."""
+    return get_ckpt_handle(path_to_ckpt).tokenizer
 
-def load_config_from_path(path_to_ckpt: str) -> Dict[str, Any]:
-    """Given a path to a model checkpoint, load the config."""
-    ckpt: Dict[str, Any] = torch.load(path_to_ckpt, map_location='cpu', weights_only=False)
-    config: Dict[str, Any] = load_config_from_ckpt(ckpt)
-    return config
+def load_config_from_path(path_to_ckpt: Union[str, 'CheckpointHandle']) -> Dict[str, Any]:
+    """Given a path to a model checkpoint (or an open `CheckpointHandle`), load the config."""
+    return get_ckpt_handle(path_to_ckpt).config
 
 
 def load_model_old_from_path(path_to_ckpt: str) -> torch.nn.Module:
@@ -232,13 +231,20 @@ def load_model_old_from_path(path_to_ckpt: str) -> torch.nn.Module:
     model.load_state_dict(ckpt['state_dict'])
     return model
 
-def load_ckpt(path_to_ckpt: str) -> Dict[str, Any]:
-    """Given a path to a model checkpoint, load the checkpoint."""
-    ckpt = torch.load(path_to_ckpt, map_location='cpu', weights_only=False)
+def load_ckpt(path_to_ckpt: str, is_mmap: bool = False, is_weights_only: bool = False) -> Dict[str, Any]:
+    """Given a path to a model checkpoint, load the checkpoint.
+    If `is_mmap`, tensors are memory-mapped from disk rather than read into RAM (falls back to a normal load for legacy non-zipfile ckpts)."""
+    if is_mmap:
+        try:
+            return torch.load(path_to_ckpt, map_location='cpu', weights_only=is_weights_only, mmap=True)
+        except RuntimeError as e:
+            # NOTE: Only ckpts saved with torch's zipfile serialization (the default since torch 1.6) can be mmap'd
+            logger.warning(f"Could not mmap ckpt @ `{path_to_ckpt}`, so falling back to loading it into memory: {e}")
+    ckpt = torch.load(path_to_ckpt, map_location='cpu', weights_only=is_weights_only)
     return ckpt
 
-def load_model_from_path(path_to_ckpt: str) -> torch.nn.Module:
-    """Given a path to a model checkpoint, load the model."""
+def get_model_class(model_name: str):
+    """Given `config.model.name`, return the corresponding `BaseModel` subclass."""
     from hf_ehr.models.gpt import GPTLanguageModel
     from hf_ehr.models.bert import BERTLanguageModel
     from hf_ehr.models.hyena import HyenaLanguageModel
@@ -246,13 +252,6 @@ def load_model_from_path(path_to_ckpt: str) -> torch.nn.Module:
     from hf_ehr.models.llama import LlamaLanguageModel
     from hf_ehr.models.t5 import T5LanguageModel
 
-    # Load checkpoint
-    ckpt: Dict[str, Any] = load_ckpt(path_to_ckpt)
-    config = load_config_from_ckpt(ckpt)
-    
-    # Load tokenizer
-    tokenizer = load_tokenizer_from_path(path_to_ckpt)
-
     # Determine type of model based on config.model.name
     model_map = {
         'bert': BERTLanguageModel,
@@ -262,17 +261,215 @@ def load_model_from_path(path_to_ckpt: str) -> torch.nn.Module:
         'llama': LlamaLanguageModel,
         't5': T5LanguageModel
     }
-    model_name: str = config['model']['name']
     model_class = next((m for k, m in model_map.items() if k in model_name), None)
     if not model_class: raise ValueError(f"Model `{model_name}` not supported.")
+    return model_class
 
-    # Load model
-    model = model_class(**ckpt['hyper_parameters'], vocab_size=tokenizer.vocab_size, pad_token_id=tokenizer.pad_token_id)
-    model.load_state_dict(ckpt['state_dict'])
-    return model
+SAFETENSORS_INDEX_FILE: str = 'model.safetensors.index.json'
+SAFETENSORS_CONFIG_FILE: str = 'config.yaml'
+SAFETENSORS_TOKENIZER_CONFIG_FILE: str = 'tokenizer_config.json'
+
+def is_safetensors_export_dir(path: str) -> bool:
+    """True if `path` is a directory created by `export_ckpt_to_safetensors()`"""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, SAFETENSORS_INDEX_FILE))
+
+class CheckpointHandle:
+    """Reads a model checkpoint from disk once, then serves its config, tokenizer, and model from that single read.
+    `path_to_ckpt` can be a Lightning .ckpt or a directory created by `export_ckpt_to_safetensors()`.
+
+    Usage:
+        handle = CheckpointHandle(path_to_ckpt)
+        config, tokenizer, model = handle.config, handle.tokenizer, handle.load_model()
+    """
+    def __init__(self, path_to_ckpt: str, is_mmap: bool = True, is_weights_only: bool = False) -> None:
+        self.path_to_ckpt: str = path_to_ckpt
+        self.is_mmap: bool = is_mmap
+        # NOTE: Lightning ckpts pickle the Hydra config, so `is_weights_only=True` only works for ckpts without it
+        self.is_weights_only: bool = is_weights_only
+        self.is_safetensors: bool = is_safetensors_export_dir(path_to_ckpt)
+        self._ckpt: Optional[Dict[str, Any]] = None
+        self._config: Optional[Dict[str, Any]] = None
+        self._tokenizer = None
+
+    @property
+    def ckpt(self) -> Dict[str, Any]:
+        if self.is_safetensors:
+            raise ValueError(f"`{self.path_to_ckpt}` is a safetensors export, so it has no Lightning ckpt. Use `.config` / `.state_dict` instead.")
+        if self._ckpt is None:
+            self._ckpt = load_ckpt(self.path_to_ckpt, is_mmap=self.is_mmap, is_weights_only=self.is_weights_only)
+        return self._ckpt
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        if self._config is None:
+            if self.is_safetensors:
+                self._config = load_config_from_safetensors_dir(self.path_to_ckpt)
+            else:
+                self._config = load_config_from_ckpt(self.ckpt)
+        return self._config
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = load_tokenizer_from_config(self.config)
+        return self._tokenizer
+
+    @property
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        if self.is_safetensors:
+            return load_state_dict_from_safetensors_dir(self.path_to_ckpt)
+        return self.ckpt['state_dict']
+
+    def load_model(self, device: Optional[Union[str, torch.device]] = None) -> torch.nn.Module:
+        """Build the model and load its weights. With `is_mmap` (or a safetensors export), weights are paged in from disk as they are copied.
+        If `device` is specified, the model is moved there before its weights are loaded (so safetensors go straight from disk to `device`)."""
+        model_class = get_model_class(self.config['model']['name'])
+        with skip_weight_init():
+            model = model_class(config=self.config, vocab_size=self.tokenizer.vocab_size, pad_token_id=self.tokenizer.pad_token_id)
+        if device is not None:
+            model.to(device)
+        if self.is_safetensors:
+            model.load_state_dict(load_state_dict_from_safetensors_dir(self.path_to_ckpt, device=device if device is not None else 'cpu'))
+        else:
+            model.load_state_dict(self.state_dict)
+        return model
+
+def skip_weight_init():
+    """Context manager that skips HF's random weight init (wasted work if we load a state dict right after). No-op if unavailable."""
+    try:
+        from transformers.modeling_utils import no_init_weights
+        return no_init_weights()
+    except ImportError:
+        import contextlib
+        return contextlib.nullcontext()
+
+def export_ckpt_to_safetensors(path_to_ckpt: Union[str, CheckpointHandle], path_to_output_dir: str, max_shard_size: int = 2 * 1024**3) -> str:
+    """
+    Write a ckpt's model weights (i.e. no optimizer/scheduler state) to `path_to_output_dir` as sharded safetensors, 
+    alongside its config + tokenizer config, in the same layout as HF's `model.safetensors.index.json`.
+    """
+    from omegaconf import OmegaConf
+    from safetensors.torch import save_file
+    import shutil
+
+    ckpt_handle: CheckpointHandle = get_ckpt_handle(path_to_ckpt)
+    config = ckpt_handle.config
+    tokenizer = ckpt_handle.tokenizer
+    state_dict: Dict[str, torch.Tensor] = ckpt_handle.state_dict
+    os.makedirs(path_to_output_dir, exist_ok=True)
+
+    # Dedupe tied weights (e.g. GPT2's `lm_head` + `wte`), since safetensors can't store shared tensors
+    tied_weights: Dict[str, str] = {}
+    storage_2_key: Dict[Tuple[int, Tuple[int, ...]], str] = {}
+    unique_state_dict: Dict[str, torch.Tensor] = {}
+    for key, tensor in state_dict.items():
+        storage_key = (tensor.untyped_storage().data_ptr() + tensor.storage_offset() * tensor.element_size(), tuple(tensor.shape))
+        if storage_key in storage_2_key:
+            tied_weights[key] = storage_2_key[storage_key]
+            continue
+        storage_2_key[storage_key] = key
+        unique_state_dict[key] = tensor
+
+    # Split into shards of at most `max_shard_size` bytes
+    shards: List[Dict[str, torch.Tensor]] = [ {} ]
+    shard_size: int = 0
+    total_size: int = 0
+    for key, tensor in unique_state_dict.items():
+        n_bytes: int = tensor.numel() * tensor.element_size()
+        if shard_size > 0 and shard_size + n_bytes > max_shard_size:
+            shards.append({})
+            shard_size = 0
+        shards[-1][key] = tensor.contiguous()
+        shard_size += n_bytes
+        total_size += n_bytes
+
+    # Save shards
+    weight_map: Dict[str, str] = {}
+    for idx, shard in enumerate(shards):
+        shard_file: str = f"model-{idx + 1:05d}-of-{len(shards):05d}.safetensors"
+        save_file(shard, os.path.join(path_to_output_dir, shard_file), metadata={ 'format': 'pt' })
+        weight_map.update({ key: shard_file for key in shard.keys() })
+    with open(os.path.join(path_to_output_dir, SAFETENSORS_INDEX_FILE), 'w') as f:
+        json.dump({
+            'metadata' : {
+                'total_size' : total_size,
+                'tied_weights' : tied_weights,
+                'vocab_size' : tokenizer.vocab_size,
+                'pad_token_id' : tokenizer.pad_token_id,
+                'path_to_ckpt' : os.path.abspath(ckpt_handle.path_to_ckpt),
+            },
+            'weight_map' : weight_map,
+        }, f, indent=2)
+
+    # Save config + tokenizer
+    OmegaConf.save(config=config, f=os.path.join(path_to_output_dir, SAFETENSORS_CONFIG_FILE))
+    shutil.copy(tokenizer.path_to_tokenizer_config, os.path.join(path_to_output_dir, SAFETENSORS_TOKENIZER_CONFIG_FILE))
+    return path_to_output_dir
+
+def load_config_from_safetensors_dir(path_to_dir: str) -> Dict[str, Any]:
+    """Load the config saved by `export_ckpt_to_safetensors()`, pointing its tokenizer at the exported tokenizer config."""
+    from omegaconf import OmegaConf
+    config = OmegaConf.load(os.path.join(path_to_dir, SAFETENSORS_CONFIG_FILE))
+    OmegaConf.set_struct(config, False)
+    config.data.tokenizer.path_to_config = os.path.join(path_to_dir, SAFETENSORS_TOKENIZER_CONFIG_FILE)
+    return config
+
+def load_state_dict_from_safetensors_dir(path_to_dir: str, device: Union[str, torch.device] = 'cpu') -> Dict[str, torch.Tensor]:
+    """Load the state dict saved by `export_ckpt_to_safetensors()`. Each shard is memory-mapped and copied directly onto `device`."""
+    from safetensors.torch import load_file
+    with open(os.path.join(path_to_dir, SAFETENSORS_INDEX_FILE), 'r') as f:
+        index: Dict[str, Any] = json.load(f)
+    state_dict: Dict[str, torch.Tensor] = {}
+    for shard_file in sorted(set(index['weight_map'].values())):
+        state_dict.update(load_file(os.path.join(path_to_dir, shard_file), device=str(device)))
+    # Restore tied weights
+    for key, tied_key in index['metadata'].get('tied_weights', {}).items():
+        state_dict[key] = state_dict[tied_key]
+    return state_dict
+
+def get_ckpt_handle(path_to_ckpt: Union[str, CheckpointHandle]) -> CheckpointHandle:
+    """Wrap a path in a `CheckpointHandle` (no-op if already a handle)."""
+    if isinstance(path_to_ckpt, CheckpointHandle):
+        return path_to_ckpt
+    return CheckpointHandle(path_to_ckpt)
+
+def load_model_from_path(path_to_ckpt: Union[str, CheckpointHandle], device: Optional[Union[str, torch.device]] = None) -> torch.nn.Module:
+    """Given a path to a model checkpoint / safetensors export (or an open `CheckpointHandle`), load the model."""
+    return get_ckpt_handle(path_to_ckpt).load_model(device=device)
+
+def get_path_to_ckpt_metadata(path_to_ckpt: str) -> str:
+    """Path to the sidecar metadata file saved alongside a ckpt"""
+    return f"{path_to_ckpt}.meta.json"
+
+def save_ckpt_metadata(path_to_ckpt: str, checkpoint: Dict[str, Any]) -> None:
+    """Write a small sidecar file (step, tokens, FLOPs, epoch, wall time) next to a ckpt, so that the ckpt can be discovered without loading it."""
+    def to_python(x: Any) -> Any:
+        return x.item() if isinstance(x, torch.Tensor) else x
+    metadata: Dict[str, Any] = {
+        'path_to_ckpt' : os.path.basename(path_to_ckpt),
+        'global_step' : to_python(checkpoint.get('global_step')),
+        'epoch' : to_python(checkpoint.get('epoch')),
+        'batch_idx' : to_python(checkpoint.get('batch_idx')),
+        'train_total_examples' : to_python(checkpoint.get('train_total_examples')),
+        'train_total_tokens_PAD' : to_python(checkpoint.get('train_total_tokens_PAD')),
+        'train_total_tokens_nonPAD' : to_python(checkpoint.get('train_total_tokens_nonPAD')),
+        'train_total_flops' : to_python(checkpoint.get('train_total_flops')),
+        'wall_time' : time.time(),
+    }
+    with open(get_path_to_ckpt_metadata(path_to_ckpt), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+def load_ckpt_metadata(path_to_ckpt: str) -> Optional[Dict[str, Any]]:
+    """Load the sidecar metadata file for a ckpt. Returns None if it doesn't exist (i.e. ckpt was saved before sidecars were added)."""
+    path_to_metadata: str = get_path_to_ckpt_metadata(path_to_ckpt)
+    if not os.path.exists(path_to_metadata):
+        return None
+    with open(path_to_metadata, 'r') as f:
+        return json.load(f)
 
 def get_most_recent_ckpt_from_output_dir(path_to_output_dir: str) -> Optional[str]:
-    """NOTE: Not used currently, but could be a useful helper function"""
+    """Return the ckpt in `{path_to_output_dir}/ckpts/` that has seen the most non-PAD training tokens.
+    Only reads each ckpt's sidecar metadata file; ckpts without one (i.e. legacy) are memory-mapped to read their counters."""
     path_to_ckpts = os.path.join(path_to_output_dir, 'ckpts')
     if os.path.exists(path_to_ckpts):
         # Loop through all ckpt files, choose most recent one
@@ -281,10 +478,17 @@ def get_most_recent_ckpt_from_output_dir(path_to_output_dir: str) -> Optional[st
             max_ckpt, max_tokens = None, None
             for ckpt_file in ckpt_files:
                 path_to_ckpt = os.path.join(path_to_ckpts, ckpt_file)
-                ckpt = torch.load(path_to_ckpt, map_location='cpu', weights_only=False)
-                if max_tokens is None or ckpt['train_total_tokens_nonPAD'] > max_tokens:
+                metadata: Optional[Dict[str, Any]] = load_ckpt_metadata(path_to_ckpt)
+                if metadata is not None:
+                    n_tokens = metadata['train_total_tokens_nonPAD']
+                else:
+                    logger.warning(f"No sidecar metadata file found for ckpt @ `{path_to_ckpt}`, so loading ckpt to read its counters")
+                    n_tokens = load_ckpt(path_to_ckpt, is_mmap=True)['train_total_tokens_nonPAD']
+                if n_tokens is None:
+                    continue
+                if max_tokens is None or n_tokens > max_tokens:
                     max_ckpt = path_to_ckpt
-                    max_tokens = ckpt['train_total_tokens_nonPAD']
+                    max_tokens = n_tokens
             assert max_ckpt is not None, f"Error -- max_ckpt is None. Couldn't find most recent ckpt."
             return max_ckpt
-    return None
\ No newline at end of file
+    return None